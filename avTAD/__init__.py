@@ -15,5 +15,8 @@ A tool to extract and plot average TAD plots for cool and hiclib formats
 
 from ._version import __version__, __format_version__
 from . import tools
+from . import store
+from . import api
+from .api import Pileup, MapCache
 
 # Aliases and re-definitions
\ No newline at end of file
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import resource
+
+from ._logging import get_logger
+
+# Profiler of the current run, None if profiling is disabled:
+_profiler = None
+
+
+class _NullStage(object):
+    """ Stage returned when profiling is disabled: does nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def count(self, **counts):
+        pass
+
+_null_stage = _NullStage()
+
+
+def _cpu_time():
+    # CPU time of the process and of its finished child processes (e.g. workers of process pools):
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _max_rss():
+    # Peak resident set size in Mb of the process and of its largest finished child process:
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 2**10
+
+
+class Stage(object):
+    """ Measurement of one stage: wall time, CPU time, peak RSS and item counts. """
+
+    def __init__(self, profiler, name, counts):
+        self.profiler = profiler
+        self.record = {'stage': name, 'depth': len(profiler.stack)}
+        self.record.update(counts)
+
+    def count(self, **counts):
+        """ Add item counts (e.g. snips=100, bytes=2**20) to the record of the stage. """
+        for key, value in counts.items():
+            self.record[key] = self.record.get(key, 0) + value
+
+    def __enter__(self):
+        self.profiler.stack.append(self)
+        self.profiler.records.append(self.record)
+        self.rss = _max_rss()
+        self.cpu = _cpu_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.record['wall'] = time.perf_counter() - self.wall
+        self.record['cpu'] = _cpu_time() - self.cpu
+        self.record['max_rss_mb'] = _max_rss()
+        self.record['rss_increase_mb'] = self.record['max_rss_mb'] - self.rss
+        self.profiler.stack.pop()
+        return False
+
+
+class Profiler(object):
+    """
+    Records of pipeline stages in the order of their start. Nested stages have larger depth.
+    """
+
+    def __init__(self, trace=None):
+        self.trace = trace
+        self.records = []
+        self.stack = []
+
+    def table(self):
+        keys = ['wall', 'cpu', 'max_rss_mb', 'rss_increase_mb']
+        lines = [f"{'stage':<32}{'wall, s':>10}{'cpu, s':>10}{'max rss, Mb':>13}{'rss +, Mb':>11}  counts"]
+        for record in self.records:
+            counts = ', '.join(f'{key}={value}' for key, value in record.items() if not key in keys+['stage', 'depth'])
+            name = '  '*record['depth'] + record['stage']
+            lines.append(f"{name:<32}{record.get('wall', float('nan')):>10.3f}{record.get('cpu', float('nan')):>10.3f}"
+                         f"{record.get('max_rss_mb', float('nan')):>13.1f}{record.get('rss_increase_mb', float('nan')):>11.1f}  {counts}")
+        return '\n'.join(lines)
+
+    def report(self):
+        logger = get_logger(__name__)
+        logger.info(f"Profile of stages:\n{self.table()}")
+        if self.trace:
+            with open(self.trace, 'w') as f:
+                json.dump({'stages': self.records}, f, indent=2)
+            logger.info(f"Profile trace written to {self.trace}")
+
+
+def enable_profiling(trace=None):
+    """ Start recording stages of the run, with JSON trace written to trace file by report_profile if provided. """
+    global _profiler
+    _profiler = Profiler(trace=trace)
+    return _profiler
+
+
+def report_profile():
+    """ Log the summary table of recorded stages and write JSON trace. Profiling is disabled afterwards. """
+    global _profiler
+    if _profiler is not None:
+        _profiler.report()
+    _profiler = None
+
+
+def stage(name, **counts):
+    """
+    Context manager measuring the stage of the pipeline if profiling is enabled:
+
+        with stage('enrichment', tads=len(df)) as s:
+            ...
+            s.count(snips=n)
+
+    When profiling is disabled, returns a shared object that does nothing.
+    """
+    if _profiler is None:
+        return _null_stage
+    return Stage(_profiler, name, counts)
@@ -0,0 +1,179 @@
+import os
+import collections
+
+from .pipeline import HiCMap, bin_segmentation, max_window, enrich_segmentation, snip_segmentation, \
+    group_labels, group_modes, pileup_segmentation
+from ._logging import get_logger
+
+
+class MapCache(object):
+    """
+    In-memory cache of opened Hi-C maps (HiCMap) with their observed over expected maps, that can be shared by Pileup objects.
+    Maps are keyed by the file (path and modification time) and parameters of obs/exp calculation.
+    Least recently used maps are dropped when arrays kept by all maps (obs/exp maps and balancing weights,
+    see HiCMap.memory) take more than max_memory bytes.
+
+    Example:
+        maps = MapCache(max_memory=4*2**30)
+        p1 = Pileup('data/OSC_dm3.cool', maps=maps)
+        p2 = Pileup('data/OSC_dm3.cool', maps=maps) # the same map, obs/exp computed for p1 is reused
+    """
+
+    def __init__(self, max_memory=8*2**30):
+        self.max_memory = max_memory
+        self.maps = collections.OrderedDict()
+        self.logger = get_logger(__name__)
+
+    def key(self, fname, format='cool', balance=True, diagonals_to_remove=1, lazy=False):
+        fname = os.path.abspath(fname)
+        return (fname, os.path.getmtime(fname), format, bool(balance), int(diagonals_to_remove), bool(lazy))
+
+    def get(self, fname, format='cool', balance=True, diagonals_to_remove=1, lazy=False, cache=None):
+        """ Opened map, created if not in the cache yet. Marks the map as recently used and drops the others if needed. """
+        key = self.key(fname, format=format, balance=balance, diagonals_to_remove=diagonals_to_remove, lazy=lazy)
+        hic_map = self.maps.pop(key, None)
+        if hic_map is None:
+            hic_map = HiCMap(fname, format=format, balance=balance, diagonals_to_remove=diagonals_to_remove,
+                             lazy=lazy, cache=cache)
+        self.maps[key] = hic_map
+        self.evict(keep=[key])
+        return hic_map
+
+    def memory(self):
+        """ Memory in bytes taken by arrays kept by all maps. """
+        return sum(hic_map.memory() for hic_map in self.maps.values())
+
+    def evict(self, keep=()):
+        """ Drop least recently used maps (except keep) until they fit into max_memory. """
+        total = self.memory()
+        for key in list(self.maps):
+            if total <= self.max_memory:
+                break
+            if key in keep:
+                continue
+            hic_map = self.maps.pop(key)
+            self.logger.info(f"Dropping {hic_map.fname} ({hic_map.memory()/2**20:.1f} Mb) from memory")
+            total -= hic_map.memory()
+
+    def clear(self):
+        self.maps.clear()
+
+
+class Pileup(object):
+    """
+    Average TAD pipeline of a Hi-C map in the current process: segmentations are passed and results
+    are returned as dataframes and arrays, nothing is written unless requested by snip.
+    Segmentations are dataframes with ch, bgn, end (in bp) and any additional columns, as read by read_segmentation.
+
+    The opened map and its observed over expected maps are kept in maps (MapCache, a new one if not provided):
+    Pileup objects given the same MapCache do not read the same map again. If cache (ObsExpCache) is provided,
+    obs/exp computed by previous runs is also taken from disk. processes, threads and max_memory (bytes)
+    are used for computing obs/exp of chromosomes as in HiCMap.get_obsexp_maps, and processes also
+    for snips of shuffled segmentations.
+
+    Example:
+        from avTAD.api import Pileup
+        from avTAD.pipeline import read_segmentation
+        df_tads, _ = read_segmentation('data/OSC_TADS.bed')
+        p = Pileup('data/OSC_dm3.cool', diagonals_to_remove=2)
+        df = p.enrichment(df_tads, niter=2, seed=0)
+        df, averages = p.average(df_tads, niter=2, seed=0, split_by=['ch'], total=True, rescaled_size=100)
+        averages[''][''], averages['_shuf0']['.ch:chrX'] # all observed TADs, shuffled TADs of chrX
+    """
+
+    def __init__(self, map, format='cool', balance=True, diagonals_to_remove=1, lazy=False, window=1,
+                 cache=None, maps=None, processes=1, threads=1, max_memory=None):
+        self.maps = MapCache() if maps is None else maps
+        self.key = self.maps.key(map, format=format, balance=balance, diagonals_to_remove=diagonals_to_remove, lazy=lazy)
+        self.hic_map = self.maps.get(map, format=format, balance=balance, diagonals_to_remove=diagonals_to_remove,
+                                     lazy=lazy, cache=cache)
+        self.window = window
+        self.processes = processes
+        self.threads = threads
+        self.max_memory = max_memory
+        self.logger = get_logger(__name__)
+
+    @property
+    def chrms(self):
+        return self.hic_map.chrms
+
+    @property
+    def resolution(self):
+        return self.hic_map.resolution
+
+    @property
+    def lengths(self):
+        return self.hic_map.lengths
+
+    def bin(self, df_segmentation):
+        """ Segmentation binned at the resolution of the map (see bin_segmentation). """
+        return bin_segmentation(df_segmentation, self.resolution)
+
+    def obsexp(self, df_segmentation, enrichment_only=False):
+        """
+        Observed over expected maps of the chromosomes of a binned segmentation, up to the widest window
+        of its TADs (or TADs only if enrichment_only). Least recently used maps are dropped from memory after.
+        """
+        chrms_used = set(df_segmentation.ch)
+        chrms = [ch for ch in self.chrms if ch in chrms_used]
+        self.logger.info(f"Selected chromosomes are: {chrms}")
+        dataset_obsexp = self.hic_map.get_obsexp_maps(chrms, max_window(df_segmentation, self.window, enrichment_only),
+                                                      processes=self.processes, threads=self.threads,
+                                                      max_memory=self.max_memory)
+        self.maps.evict(keep=[self.key])
+        return dataset_obsexp
+
+    def enrichment(self, df_segmentation, niter=0, seed=None, median=False, pvalue_niter=0, pvalue_hits=10, pvalue_batch=100):
+        """
+        TAD metadata as written by snip: binned TADs, niter shuffles and enrichment of observed and shuffled TADs,
+        and p-values with pvalue_niter (see enrich_segmentation).
+        """
+        df_segmentation = self.bin(df_segmentation)
+        dataset_obsexp = self.obsexp(df_segmentation, enrichment_only=True)
+        return enrich_segmentation(dataset_obsexp, df_segmentation, niter=niter, seed=seed, median=median,
+                                   pvalue_niter=pvalue_niter, pvalue_hits=pvalue_hits, pvalue_batch=pvalue_batch)
+
+    def snip(self, df_segmentation, output_prefix, add_columns=(), niter=0, seed=None, median=False, enrichment_only=False,
+             snip_dtype='float64', compression=None, metadata_format='tsv', pvalue_niter=0, pvalue_hits=10, pvalue_batch=100):
+        """ Write TAD metadata and snips files of observed and shuffled TADs as avTAD snip (see snip_segmentation). """
+        df_segmentation = self.bin(df_segmentation)
+        dataset_obsexp = self.obsexp(df_segmentation, enrichment_only=enrichment_only)
+        return snip_segmentation(dataset_obsexp, df_segmentation, output_prefix, add_columns=add_columns,
+                                 niter=niter, seed=seed, window=self.window, median=median,
+                                 enrichment_only=enrichment_only, processes=self.processes,
+                                 snip_dtype=snip_dtype, compression=compression, metadata_format=metadata_format,
+                                 pvalue_niter=pvalue_niter, pvalue_hits=pvalue_hits, pvalue_batch=pvalue_batch)
+
+    def pileup(self, df_segmentation, niter=0, seed=None, median=False, split_by=(), total=False, query=None,
+               rescaled_size=200, save_sum=True, order=1, pvalue_niter=0, pvalue_hits=10, pvalue_batch=100):
+        """
+        Snip, rescale and average observed and shuffled TADs without writing snips (see pileup_segmentation).
+        TADs selected by query are averaged in groups of split_by columns, and all together if total or no split_by.
+        Returns TAD metadata of all TADs (see enrichment), accumulators by segmentation ('' for observed,
+        '_shuf{i}' for shuffled) and modes of groups as (group, mode, column, name), see group_modes.
+        """
+        df_segmentation = self.bin(df_segmentation)
+        dataset_obsexp = self.obsexp(df_segmentation)
+        df_segmentation = enrich_segmentation(dataset_obsexp, df_segmentation, niter=niter, seed=seed, median=median,
+                                              pvalue_niter=pvalue_niter, pvalue_hits=pvalue_hits, pvalue_batch=pvalue_batch)
+        df_selected = df_segmentation.query(query) if query else df_segmentation
+        groupings, offsets, labels = group_labels(df_selected, split_by, total)
+
+        self.logger.info(f"Zooming snips of {len(df_selected)} TADs and {niter} shuffles to {rescaled_size}x{rescaled_size} "
+                         f"and averaging them in {offsets[-1]} groups ...")
+        accumulators = pileup_segmentation(df_selected, dataset_obsexp, labels, offsets[-1], niter=niter, window=self.window,
+                                           finalShape=(rescaled_size, rescaled_size), saveSum=save_sum, order=order,
+                                           processes=self.processes)
+        return df_segmentation, accumulators, group_modes(groupings, offsets)
+
+    def average(self, df_segmentation, operation='mean', **kwargs):
+        """
+        Average TADs as pileup with operation of PileupAccumulator. Returns TAD metadata and average matrices
+        by segmentation and mode: averages[mod][mode], e.g. averages['']['.ch:chrX'].
+        """
+        df_segmentation, accumulators, modes = self.pileup(df_segmentation, **kwargs)
+        averages = {}
+        for mod, accumulator in accumulators.items():
+            result = accumulator.result(operation)
+            averages[mod] = {mode: result[k] for k, mode, _, _ in modes}
+        return df_segmentation, averages
@@ -0,0 +1,165 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import h5py
+import numpy as np
+
+from ._version import __format_version__
+from ._logging import get_logger
+
+
+def _update_dataset(sha, name, dataset, chunksize=2**22):
+    # Name, type and shape of the dataset and its values by chunks of rows:
+    sha.update(f'{name} {dataset.dtype} {dataset.shape}'.encode())
+    if dataset.shape == ():
+        sha.update(np.asarray(dataset[()]).tobytes())
+        return
+    step = max(1, chunksize // max(1, int(np.prod(dataset.shape[1:]))))
+    for bgn in range(0, dataset.shape[0], step):
+        sha.update(np.ascontiguousarray(dataset[bgn:bgn+step]).tobytes())
+
+
+def map_fingerprint(fname, format='cool'):
+    """
+    Content fingerprint of a Hi-C map: sha1 of the datasets that observed over expected depends on,
+    pixels and bins tables (including balancing weights) for cool files, all datasets for hiclib files,
+    or of the whole file if it is not HDF5. Does not depend on file name or modification time.
+    """
+    path, _, group = fname.partition('::')
+    sha = hashlib.sha1(format.encode())
+    if not h5py.is_hdf5(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    with h5py.File(path, 'r') as f:
+        root = f[group] if group else f
+        names = []
+        root.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None)
+        if format == 'cool':
+            names = [name for name in names if name.split('/')[0] in ('pixels', 'bins')]
+        for name in sorted(names):
+            _update_dataset(sha, name, root[name])
+    return sha.hexdigest()
+
+
+class ObsExpCache(object):
+    """
+    Persistent content-addressed cache of observed over expected maps.
+
+    Each entry is a directory named by the key of the input map (content of its datasets, see map_fingerprint)
+    and parameters of obs/exp calculation, containing manifest.json (chromosomes, resolution, parameters)
+    and one .npy file per chromosome and kind of data:
+        {ch}.band.npy       obs/exp diagonals with removed diagonals (data of BandedMatrix)
+        {ch}.expected.npy   per-diagonal expected vector (for lazy maps)
+    Arrays are loaded memory-mapped. Entries are evicted in the least recently used order
+    when the total size of the cache exceeds max_size bytes.
+
+    Example:
+        cache = ObsExpCache('~/.cache/avTAD', max_size=50*2**30)
+        key = cache.key('data/OSC_dm3.cool', format='cool', balance=True, diagonals_to_remove=2)
+        band = cache.get(key, 'chrX', kind='band')
+        if band is None:
+            cache.put(key, 'chrX', compute_band(...), kind='band')
+    """
+
+    def __init__(self, cache_dir, max_size=50*2**30):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self.logger = get_logger(__name__)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, fname, format='cool', **params):
+        params = dict(params, format=format, fingerprint=self.fingerprint(fname, format=format),
+                      format_version=__format_version__)
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def fingerprint(self, fname, format='cool'):
+        """
+        map_fingerprint of the file, remembered in fingerprints.json of the cache by path, size and
+        modification time, so that the datasets are hashed again only after the file is changed.
+        """
+        path, _, group = fname.partition('::')
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        name = f'{path}::{group} {format}'
+        known = self._fingerprints()
+        entry = known.get(name)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['fingerprint']
+        fingerprint = map_fingerprint(fname, format=format)
+        known[name] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, fingerprint=fingerprint)
+        self._write(os.path.join(self.cache_dir, 'fingerprints.json'), lambda f: f.write(json.dumps(known).encode()))
+        return fingerprint
+
+    def _fingerprints(self):
+        fname = os.path.join(self.cache_dir, 'fingerprints.json')
+        if not os.path.isfile(fname):
+            return {}
+        with open(fname) as f:
+            return json.load(f)
+
+    def path(self, key, *parts):
+        return os.path.join(self.cache_dir, key, *parts)
+
+    def info(self, key):
+        """ Manifest of the entry or None if the entry does not exist. Marks the entry as recently used. """
+        fname = self.path(key, 'manifest.json')
+        if not os.path.isfile(fname):
+            return None
+        os.utime(self.path(key))
+        with open(fname) as f:
+            return json.load(f)
+
+    def create(self, key, **info):
+        """ Create an entry with manifest info, e.g. chromosomes and resolution of the map. """
+        os.makedirs(self.path(key), exist_ok=True)
+        self._write(self.path(key, 'manifest.json'), lambda f: f.write(json.dumps(info).encode()))
+
+    def get(self, key, ch, kind='band'):
+        fname = self.path(key, f'{ch}.{kind}.npy')
+        if not os.path.isfile(fname):
+            return None
+        self.logger.debug(f"Loading {kind} for {ch} from cache {fname}")
+        return np.load(fname, mmap_mode='r')
+
+    def put(self, key, ch, mtx, kind='band'):
+        self._write(self.path(key, f'{ch}.{kind}.npy'), lambda f: np.save(f, mtx))
+
+    def _write(self, fname, write):
+        # Write to temporary file first, so that interrupted runs do not leave broken entries:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmpname, fname)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def entries(self):
+        """ List of (last use time, size in bytes, key) for all entries. """
+        ret = []
+        for key in os.listdir(self.cache_dir):
+            path = self.path(key)
+            if not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, x)) for x in os.listdir(path))
+            ret.append((os.path.getmtime(path), size, key))
+        return sorted(ret)
+
+    def evict(self, keep=()):
+        """ Remove least recently used entries (except keep) until the cache fits into max_size. """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key in keep:
+                continue
+            self.logger.info(f"Evicting {key} ({size/2**20:.1f} Mb) from cache {self.cache_dir}")
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
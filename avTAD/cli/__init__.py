@@ -4,6 +4,7 @@ import sys
 import os
 from .._version import __version__
 from .._logging import get_logger
+from .._profiling import enable_profiling, report_profile
 import click
 
 # Monkey patch
@@ -25,13 +26,24 @@ class UnsortedGroup(click.Group):
     '-v', '--verbose',
     help="Verbose logging.",
     count=True)
+@click.option(
+    '--profile',
+    help="Measure wall time, CPU time, peak RSS and item counts of pipeline stages and log the summary table.",
+    is_flag=True,
+    default=False)
+@click.option(
+    '--profile-trace',
+    help="Write measurements of pipeline stages to JSON file (implies --profile).",
+    metavar="JSON_FILE",
+    default=None)
+@click.pass_context
 # @click.option(
 #     '-d', '--debug',
 #     help="On error, drop into the post-mortem debugger shell.",
 #     is_flag=True,
 #     default=False)
 # def cli(verbose, debug):
-def cli(verbose):
+def cli(ctx, verbose, profile, profile_trace):
 
     """
     Type -h or --help after any subcommand for more information.
@@ -47,9 +59,153 @@ def cli(verbose):
     else:
         root_logger.setLevel(logging.INFO)
 
+    # Stages are measured only with --profile, the report is written when the subcommand finishes:
+    if profile or profile_trace:
+        enable_profiling(trace=profile_trace)
+        ctx.call_on_close(report_profile)
+
+
+def _compose(*decorators):
+    """ Apply options in the order they are listed, as if they were written one after another. """
+    def decorator(f):
+        for d in reversed(decorators):
+            f = d(f)
+        return f
+    return decorator
+
+
+# Options of reading the map and computing observed over expected, shared by snip, batch and pileup:
+map_options = _compose(
+    click.option(
+        "--threads", "-t",
+        help="Number of threads for balancing and computing observed over expected of chromosomes concurrently, "
+             "used if --processes is 1.",
+        is_flag=False,
+        default=1,
+        type=int,
+        show_default=True),
+    click.option(
+        "--max-memory",
+        help="Memory budget in Gb for chromosomes processed concurrently by --processes or --threads: "
+             "chromosomes are started only while their estimated memory fits into it. No limit if not set.",
+        is_flag=False,
+        default=None,
+        type=float,
+        show_default=True),
+    click.option(
+        "--window", "-w",
+        help="Size of window in TAD units. Default is +-1 TAD.",
+        is_flag=False,
+        default=1,
+        type=float,
+        show_default=True),
+    click.option(
+        "--diagonals-to-remove", "-d",
+        help="Number of diagonals to remove from map.",
+        is_flag=False,
+        default=1,
+        type=int,
+        show_default=True),
+    click.option(
+        "--cache-dir",
+        help="Directory for persistent cache of observed over expected maps. "
+             "Runs with the same map, format, balance and diagonals to remove reuse the cached maps. "
+             "No caching if not set.",
+        is_flag=False,
+        default=None,
+        show_default=True),
+    click.option(
+        "--cache-size",
+        help="Maximum size of the cache in Gb, least recently used maps are evicted.",
+        is_flag=False,
+        default=50,
+        type=float,
+        show_default=True),
+    click.option(
+        "--lazy/--no-lazy",
+        help="Fetch from the map only the windows around TADs instead of whole chromosomes. "
+             "Memory use then depends on the size of the largest snip and not on the chromosome length.",
+        is_flag=True,
+        default=False,
+        show_default=True))
+
+
+# Options of shuffled controls and TAD metadata, shared by snip, batch and pileup:
+enrichment_options = _compose(
+    click.option(
+        "--niter", "-n",
+        help="Number of iterations for segmentation shuffling control.",
+        is_flag=False,
+        default=0,
+        type=int,
+        show_default=True),
+    click.option(
+        "--median/--no-median",
+        help="Compute exact median of TAD enrichment. Slow for large numbers of TADs and shuffles, "
+             "median columns are filled with NaN if not set.",
+        is_flag=True,
+        default=False,
+        show_default=True),
+    click.option(
+        "--metadata-format",
+        help="Format of TAD metadata: tsv table or columnar hdf5 file, from which rescale reads only the columns "
+             "used by --query and --split-by.",
+        is_flag=False,
+        default='tsv',
+        show_default=True))
+
+
+# Options of written snips files, shared by snip and batch:
+snip_output_options = _compose(
+    click.option(
+        "--snip-dtype",
+        help="Precision of written snips (float64, float32, float16). Error of the average TAD rescaled from snips is "
+             "within 6e-8 (float32) or 5e-4 (float16) of the average of absolute log2 values of rescaled snips.",
+        is_flag=False,
+        default='float64',
+        show_default=True),
+    click.option(
+        "--compression",
+        help="Compression of snips files by chunks with byte shuffling (gzip, lzf or none). "
+             "lzf is fast, gzip is smaller.",
+        is_flag=False,
+        default='none',
+        show_default=True))
+
+
+# Options of sequential p-values of TAD enrichment, shared by snip, batch and pileup:
+pvalue_options = _compose(
+    click.option(
+        "--pvalue-niter",
+        help="Maximal number of shuffles for sequential Monte Carlo p-values of TAD enrichment (mean log2 obs/exp). "
+             "Shuffles are drawn in batches and each TAD stops drawing when its p-value is decided by "
+             "--pvalue-hits exceedances of the observed enrichment. Adds pvalue, null_mean, null_std and null_niter "
+             "columns to TAD metadata. No p-values if 0.",
+        is_flag=False,
+        default=0,
+        type=int,
+        show_default=True),
+    click.option(
+        "--pvalue-hits",
+        help="Number of null enrichments at least as large as the observed one after which a TAD stops drawing shuffles.",
+        is_flag=False,
+        default=10,
+        type=int,
+        show_default=True),
+    click.option(
+        "--pvalue-batch",
+        help="Number of shuffles drawn at once for p-values.",
+        is_flag=False,
+        default=100,
+        type=int,
+        show_default=True))
+
+
 from . import (
     plot,
     snip,
+    batch,
+    pileup,
     rescale,
     evaluate
 )
\ No newline at end of file
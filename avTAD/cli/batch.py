@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+from . import cli, get_logger, map_options, enrichment_options, snip_output_options, pvalue_options
+import click
+
+from ..tools import *
+from ..cache import ObsExpCache
+from ..store import SnipWriter
+from ..pipeline import read_segmentation, snip_segmentation, METADATA_FORMATS
+from ..api import Pileup, MapCache
+from .._profiling import stage
+
+def _snip_job(dataset_obsexp, df_segmentation, output_prefix, add_columns, niter, seed, window, median, enrichment_only,
+              snip_dtype, compression, metadata_format, pvalue_niter, pvalue_hits, pvalue_batch):
+    snip_segmentation(dataset_obsexp, df_segmentation, output_prefix, add_columns=add_columns,
+                      niter=niter, seed=seed, window=window, median=median,
+                      enrichment_only=enrichment_only, processes=1, snip_dtype=snip_dtype, compression=compression,
+                      metadata_format=metadata_format,
+                      pvalue_niter=pvalue_niter, pvalue_hits=pvalue_hits, pvalue_batch=pvalue_batch)
+    return output_prefix
+
+@cli.command()
+@click.argument(
+    "manifest",
+    metavar="MANIFEST")
+@click.option(
+    "--format", "-f",
+    help="Input file format (cool, hiclib_heatmap, hiclib_bychr) for maps without format in the manifest.",
+    is_flag=False,
+    default="cool",
+    show_default=True)
+@click.option(
+    "--balance/--no-balance",
+    help="Balance the maps without balance in the manifest with iterative correction before snipping.",
+    is_flag=True,
+    default=True,
+    show_default=True)
+@click.option(
+    "--seed",
+    help="Seed for segmentation shuffling, the same for all jobs. Random if not set.",
+    is_flag=False,
+    default=None,
+    type=int,
+    show_default=True)
+@click.option(
+    "--processes", "-p",
+    help="Number of processes for balancing and computing observed over expected of chromosomes of each map, "
+         "and for running segmentations of the same map. "
+         "Observed over expected maps are shared between processes.",
+    is_flag=False,
+    default=1,
+    type=int,
+    show_default=True)
+@click.option(
+    "--enrichment-only",
+    help="Compute only dataframes with enrichment of TAD interactions.",
+    is_flag=True,
+    default=False,
+    show_default=True)
+@map_options
+@enrichment_options
+@snip_output_options
+@pvalue_options
+def batch(manifest, format, balance, niter, window, enrichment_only, diagonals_to_remove, lazy, median, seed, processes, threads, max_memory, cache_dir, cache_size, snip_dtype, compression, metadata_format, pvalue_niter, pvalue_hits, pvalue_batch):
+    """
+    Run snip for many maps and segmentations listed in MANIFEST.
+    MANIFEST: Tab-separated file with header and columns map, segmentation and output_prefix,
+    optional columns format and balance override the command line options for the map.
+
+    Each map is opened once for all its segmentations, each segmentation file is parsed once
+    and binned once per resolution. The output files are the same as for avTAD snip:
+      {output_prefix}.TADmetadata.tsv (or .hdf5 with --metadata-format hdf5)
+    if not --enrichment-only:
+      {output_prefix}.TADsnips.hdf5
+      {output_prefix}.TADsnips_shuf0.hdf5 etc.
+
+    Example run:
+      avTAD batch manifest.tsv --diagonals-to-remove 2 --niter 2 --processes 4
+    """
+
+    logger = get_logger(__name__)
+
+    if not metadata_format in METADATA_FORMATS:
+        raise Exception(f'Metadata format {metadata_format} is not supported, available formats are: {METADATA_FORMATS}')
+
+    if not snip_dtype in SnipWriter.dtypes:
+        raise Exception(f'Snips dtype {snip_dtype} is not supported, available dtypes are: {SnipWriter.dtypes}')
+    if not compression in SnipWriter.compressions:
+        raise Exception(f'Snips compression {compression} is not supported, available compressions are: {SnipWriter.compressions}')
+
+    df_manifest = pd.read_csv(manifest, sep='\t')
+    missing = {'map', 'segmentation', 'output_prefix'} - set(df_manifest.columns)
+    if missing:
+        raise Exception(f'Manifest {manifest} has no columns: {sorted(missing)}')
+    if 'format' not in df_manifest.columns:
+        df_manifest.loc[:, 'format'] = format
+    if 'balance' not in df_manifest.columns:
+        df_manifest.loc[:, 'balance'] = balance
+    df_manifest.loc[:, 'format'] = df_manifest.format.fillna(format)
+    df_manifest.loc[:, 'balance'] = [balance if pd.isna(x) else str(x).lower() in ['true', '1', 'yes']
+                                     for x in df_manifest.balance]
+    if df_manifest.output_prefix.duplicated().any():
+        raise Exception(f'Output prefixes in manifest {manifest} are not unique')
+
+    logger.info(f"Running {len(df_manifest)} snipping jobs for {df_manifest['map'].nunique()} maps "
+                f"and {df_manifest.segmentation.nunique()} segmentations ...")
+
+    cache = ObsExpCache(cache_dir, max_size=int(cache_size*2**30)) if cache_dir else None
+
+    # Maps are processed one after another, only the map in use is kept in memory:
+    maps = MapCache(max_memory=0)
+
+    # Segmentations are parsed once and binned once per resolution:
+    segmentations = {}
+    binned = {}
+    with stage('read_segmentation', files=df_manifest.segmentation.nunique()):
+        for fname in df_manifest.segmentation.unique():
+            logger.info(f"Reading segmentation file: {fname}")
+            segmentations[fname] = read_segmentation(fname)
+
+    for (map, map_format, map_balance), df_jobs in df_manifest.groupby(['map', 'format', 'balance'], sort=False):
+        logger.info(f"Running snipping for heatmap {map} in {map_format} format: {len(df_jobs)} segmentations ...")
+        runner = Pileup(map, format=map_format, balance=map_balance, diagonals_to_remove=diagonals_to_remove, lazy=lazy,
+                        window=window, cache=cache, maps=maps, processes=processes, threads=threads,
+                        max_memory=int(max_memory*2**30) if max_memory else None)
+
+        for fname in df_jobs.segmentation.unique():
+            if (fname, runner.resolution) not in binned:
+                binned[(fname, runner.resolution)] = runner.bin(segmentations[fname][0])
+        dfs = [binned[(fname, runner.resolution)] for fname in df_jobs.segmentation]
+
+        # Observed over expected is computed once for all segmentations, up to the widest window of them:
+        dataset_obsexp = runner.obsexp(pd.concat(dfs), enrichment_only=enrichment_only)
+
+        jobs = [(df_segmentation, output_prefix, segmentations[fname][1], niter, seed, window, median, enrichment_only,
+                 snip_dtype, compression, metadata_format, pvalue_niter, pvalue_hits, pvalue_batch)
+                for df_segmentation, fname, output_prefix in zip(dfs, df_jobs.segmentation, df_jobs.output_prefix)]
+        with stage('snip_segmentations', segmentations=len(jobs), tads=sum(len(df) for df in dfs)):
+            for output_prefix in map_with_shared_arrays(_snip_job, jobs, dataset_obsexp, processes=processes):
+                logger.info(f"Snipping done: {output_prefix}")
@@ -10,6 +10,9 @@ import datetime
 now = datetime.datetime.now()
 
 from ..tools import *
+from ..store import list_averages, read_average, write_average, write_average_tsv
+from ..expression import Expression, FUNCTIONS, evaluate_modes
+from .._profiling import stage
 
 @cli.command()
 @click.argument(
@@ -24,41 +27,79 @@ from ..tools import *
 @click.argument(
     "expression",
     metavar="EXPRESSION")
+@click.option(
+    "--operand", "-o",
+    help="Additional operand for the expression as NAME=PREFIX, can be repeated "
+         "(e.g. -o c=BG3 -o d=BG3_shuf0 for \"(a-b)-(c-d)\").",
+    metavar="NAME=PREFIX",
+    is_flag=False,
+    multiple=True,
+    default=None,
+    show_default=True)
+@click.option(
+    "--tsv/--no-tsv",
+    help="Also export resulting matrices as TSV files with the run description in the header.",
+    is_flag=True,
+    default=False,
+    show_default=True)
 
-def evaluate(a_prefix, b_prefix, output_prefix, expression):
+def evaluate(a_prefix, b_prefix, output_prefix, expression, operand, tsv):
     """
-    Evaluate matrix expression for a pair of prefixes, A_PREFIX and B_PREFIX.
-    If multiple avTAD tsv files available, will be applied to corresponding files.
+    Evaluate matrix expression for a pair of prefixes, A_PREFIX and B_PREFIX (and more prefixes passed with --operand).
+    If multiple avTAD npz (or tsv) files available, will be applied to corresponding files.
+    Output is written to {OUTPUT_PREFIX}.avTAD{mode}.npz
+
+    EXPRESSION can contain operand names (a, b and names of --operand), numbers, + - * / ** and functions:
+    abs, sign, sqrt, square, exp, exp2, log, log2, log10, log1p, maximum, minimum, fmax, fmin.
+    maximum and minimum are NaN where either operand is NaN (e.g. removed diagonals), fmax and fmin
+    skip NaN and take the other operand.
+    The expression is compiled once and evaluated for all files at once.
 
     Example usage:
        avTAD evaluate OSC OSC_shuf0 OSC_enrichment "a-b"
+       avTAD evaluate OSC OSC_shuf0 OSC-BG3_enrichment "(a-b)-(c-d)" -o c=BG3 -o d=BG3_shuf0
     """
 
     logger = get_logger(__name__)
-    logger.info(f"Loading matrices from {a_prefix} and {b_prefix} for evaluation {expression} ...")
 
-    files_list_a = glob.glob(f'{a_prefix}.avTAD*.tsv')
-    files_list_b = glob.glob(f'{b_prefix}.avTAD*.tsv')
-    modes = ['.'+x.split('.')[-2] if not x.split('.')[-2]=='avTAD' else '' for x in files_list_a]
-    print(files_list_a, modes)
+    prefixes = {'a': a_prefix, 'b': b_prefix}
+    for x in operand:
+        name, _, prefix = x.partition('=')
+        name = name.strip()
+        if not name.isidentifier() or name in FUNCTIONS or not prefix:
+            raise Exception(f"Bad operand {x}, should be NAME=PREFIX with NAME like c, bg3 or bg3_shuf")
+        if name in prefixes:
+            raise Exception(f"Operand {name} is defined twice")
+        prefixes[name] = prefix
 
-    for mode in modes:
-        a_name = f'{a_prefix}.avTAD{mode}.tsv'
-        b_name = f'{b_prefix}.avTAD{mode}.tsv'
+    expr = Expression(expression, names=list(prefixes.keys()))
+    if not expr.names:
+        raise Exception(f"Expression {expression} does not use any of operands {list(prefixes.keys())}")
 
-        if not a_name in files_list_a or not b_name in files_list_b:
-            logger.warning(f"Skipping {a_name} and {b_name}")
-            continue
+    logger.info(f"Loading matrices from {', '.join(f'{name}={prefixes[name]}' for name in expr.names)} for evaluation {expression} ...")
+    files = {name: list_averages(prefixes[name]) for name in expr.names}
+    for name in expr.names:
+        for mode in files[name]:
+            if not all(mode in files[x] for x in expr.names):
+                logger.warning(f"Skipping {files[name][mode]}, no matching files for all operands")
+    with stage('read_averages', files=sum(len(files[name]) for name in expr.names)):
+        operands = {name: {mode: read_average(fname)[0] for mode, fname in files[name].items()
+                           if all(mode in files[x] for x in expr.names)}
+                    for name in expr.names}
 
-        a = np.loadtxt(a_name, delimiter='\t')
-        b = np.loadtxt(b_name, delimiter='\t')
+    with stage('evaluate', operands=len(expr.names)) as s:
+        results = evaluate_modes(expr, operands)
+        s.count(modes=len(results))
+    logger.info(f"Evaluated {expression} for modes: {list(results.keys())}")
 
-        if len(np.unique(expression))>5:
-            raise Exception(f"Bad values in {expression}, only a, b and math operations are allowed")
+    with stage('write_averages', files=len(results)*(2 if tsv else 1)):
+        for mode, c in results.items():
+            metadata = dict(expression=expression, operands={name: files[name][mode] for name in expr.names},
+                            date=now.strftime("%Y-%m-%d %H:%M"))
+            metadata['description'] = f'{expression} for {" and ".join(f"{name}={prefixes[name]}" for name in expr.names)} at {metadata["date"]}'
 
-        c = eval(expression)
-        c[np.isinf(c)] = np.nan
-        logger.info(f"Saving output to {output_prefix}.avTAD{mode}.tsv ...")
-        np.savetxt(f'{output_prefix}.avTAD{mode}.tsv', c,
-                   header=f'{expression} for a={a_prefix} and b={b_prefix} at {now.strftime("%Y-%m-%d %H:%M")}',
-                   fmt='%.6e', delimiter='\t')
\ No newline at end of file
+            logger.info(f"Saving output to {output_prefix}.avTAD{mode}.npz ...")
+            write_average(f'{output_prefix}.avTAD{mode}.npz', c, metadata)
+            if tsv:
+                logger.info(f"Saving output to {output_prefix}.avTAD{mode}.tsv ...")
+                write_average_tsv(f'{output_prefix}.avTAD{mode}.tsv', c, metadata)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, print_function
+
+from . import cli, get_logger, map_options, enrichment_options, pvalue_options
+import click
+
+import os
+import datetime
+now = datetime.datetime.now()
+
+from ..tools import *
+from ..cache import ObsExpCache
+from ..store import write_average, write_average_tsv
+from ..pipeline import read_segmentation, save_metadata, METADATA_FORMATS
+from ..api import Pileup
+from .._profiling import stage
+
+@cli.command()
+@click.argument(
+    "segmentation",
+    metavar="TAD_SEGMENTATION_BED")
+@click.argument(
+    "map",
+    metavar="INPUT_MAP")
+@click.argument(
+    "output_prefix",
+    metavar="OUTPUT_PREFIX")
+@click.option(
+    "--format", "-f",
+    help="Input file format (cool, hiclib_heatmap, hiclib_bychr).",
+    is_flag=False,
+    default="cool",
+    show_default=True)
+@click.option(
+    "--balance/--no-balance",
+    help="Balance the map with iterative correction before snipping. "
+         "For cool file it will read the file with option --balance, "
+         "for hiclib it will perform default balancing with iterative correction.",
+    is_flag=True,
+    default=True,
+    show_default=True)
+@click.option(
+    "--seed",
+    help="Seed for segmentation shuffling. Shuffles do not depend on the number of processes. Random if not set.",
+    is_flag=False,
+    default=None,
+    type=int,
+    show_default=True)
+@click.option(
+    "--processes", "-p",
+    help="Number of processes for balancing and computing observed over expected of chromosomes, "
+         "and for averaging snips of observed and shuffled segmentations. "
+         "Observed over expected maps are shared between processes.",
+    is_flag=False,
+    default=1,
+    type=int,
+    show_default=True)
+@click.option(
+    "--split-by",
+    help="Split by groups of columns of TAD metadata (e.g. ch, TAD_size or additional columns of the segmentation). "
+         "Can be repeated to split by several columns, each snip is rescaled once for all of them.",
+    metavar="SPLIT_BY",
+    is_flag=False,
+    multiple=True,
+    default=None,
+    show_default=True)
+@click.option(
+    "--total/--no-total",
+    help="With --split-by also save the average of all selected snips, computed in the same pass.",
+    is_flag=True,
+    default=False,
+    show_default=True)
+@click.option(
+    "--query",
+    help="Query to select TADs by their metadata, should be quoted in the terminal. "
+         "Example: \"TAD_size>20 and TAD_size<30\" or \"ch=='chrX'\"",
+    is_flag=False,
+    default=None,
+    show_default=True)
+@click.option(
+    "--rescaled-size",
+    help="The resulting size of the average TAD plot after rescaling. Larger size than he max TAD size is recommended.",
+    is_flag=False,
+    default=200,
+    type=int,
+    show_default=True)
+@click.option(
+    "--save-sum/--no-save-sum",
+    help="Save sum by the zoom operation. --save-sum mode is recommended.",
+    is_flag=True,
+    default=True,
+    show_default=True)
+@click.option(
+    "--smooth-order",
+    help="The order of polynome to interpolate image.",
+    is_flag=False,
+    default=1,
+    type=int,
+    show_default=True)
+@click.option(
+    "--operation",
+    help="Operation to perform over each pixel of rescaled image (mean, sum, count, std, sem). "
+         "Median needs all rescaled snips and is available with snip and rescale only.",
+    is_flag=False,
+    default='mean',
+    show_default=True)
+@click.option(
+    "--tsv/--no-tsv",
+    help="Also export average matrices as TSV files with the run description in the header.",
+    is_flag=True,
+    default=False,
+    show_default=True)
+@map_options
+@enrichment_options
+@pvalue_options
+def pileup(segmentation, map, output_prefix, format, balance, niter, window, diagonals_to_remove, lazy, median, seed, processes, threads, max_memory, cache_dir, cache_size,
+           split_by, total, query, rescaled_size, save_sum, smooth_order, operation, tsv, metadata_format, pvalue_niter, pvalue_hits, pvalue_batch):
+    """
+    Snip, rescale and average TADs in one pass, without writing snips: snips of observed and shuffled
+    segmentations are zoomed and added to the averages as they are extracted from the map,
+    so that memory is taken by observed over expected maps only. Equivalent to snip followed by rescale
+    of the observed and each shuffled snips file.
+
+    Output files to be created:
+      {OUTPUT_PREFIX}.TADmetadata.tsv (or .hdf5 with --metadata-format hdf5)
+      {OUTPUT_PREFIX}.avTAD{mode}.npz
+      {OUTPUT_PREFIX}_shuf0.avTAD{mode}.npz etc.
+    with modes as for rescale: '' for the average of all TADs and .{SPLIT_BY}:{value} for groups.
+
+    Example run:
+      avTAD pileup data/OSC_TADS.bed data/OSC_dm3.cool OSC --diagonals-to-remove 2 --niter 2 --split-by ch --total
+    """
+
+    logger = get_logger(__name__)
+
+    if not metadata_format in METADATA_FORMATS:
+        raise Exception(f'Metadata format {metadata_format} is not supported, available formats are: {METADATA_FORMATS}')
+    logger.info(f"Running pileup for: segmentation file {segmentation}, heatmap {map} in {format} format ...")
+
+    if not operation in PileupAccumulator.operations:
+        raise Exception(f'Operation {operation} is not implemented for pileup... Exiting.')
+
+    cache = ObsExpCache(cache_dir, max_size=int(cache_size*2**30)) if cache_dir else None
+    runner = Pileup(map, format=format, balance=balance, diagonals_to_remove=diagonals_to_remove, lazy=lazy, window=window,
+                    cache=cache, processes=processes, threads=threads, max_memory=int(max_memory*2**30) if max_memory else None)
+
+    logger.info(f"Reading segmentation file: {segmentation}")
+    with stage('read_segmentation') as s:
+        df_segmentation, add_columns = read_segmentation(segmentation)
+        s.count(tads=len(df_segmentation))
+
+    # Shuffles and enrichment are computed as by snip, snips are averaged without writing them:
+    try:
+        df_segmentation, accumulators, modes = runner.pileup(df_segmentation, niter=niter, seed=seed, median=median,
+                                                             split_by=split_by, total=total, query=query,
+                                                             rescaled_size=rescaled_size, save_sum=save_sum, order=smooth_order,
+                                                             pvalue_niter=pvalue_niter, pvalue_hits=pvalue_hits,
+                                                             pvalue_batch=pvalue_batch)
+    except ValueError as e:
+        raise Exception(str(e))
+    save_metadata(df_segmentation, output_prefix, add_columns=add_columns, niter=niter, format=metadata_format,
+                  pvalues=bool(pvalue_niter))
+
+    with stage('write_averages') as s:
+        for mod, accumulator in accumulators.items():
+            averaged_matrices = accumulator.result(operation)
+            for k, mode, column, name in modes:
+                metadata = dict(map=map, segmentation=segmentation, shuffle=mod.lstrip('_') or None, query=query,
+                                operation=operation, n=int(accumulator.n[k]), window=window, rescaled_size=rescaled_size,
+                                save_sum=save_sum, smooth_order=smooth_order, date=now.strftime("%Y-%m-%d %H:%M"))
+                metadata['description'] = f'{accumulator.n[k]} snips of {segmentation}{" " + mod.lstrip("_") if mod else ""} ' \
+                                          f'from {map} (query: {query}) averaged by {operation} at {metadata["date"]}'
+                if column is not None:
+                    metadata.update(split_by=column, group=name)
+                    metadata['description'] += f' group {name} of {column}'
+
+                fname = f"{output_prefix}{mod}.avTAD{mode}"
+                logger.info(f"Saving output to {fname}.npz ...")
+                write_average(f"{fname}.npz", averaged_matrices[k], metadata, state=accumulator.group(k).state())
+                s.count(files=1, bytes=os.path.getsize(f"{fname}.npz"))
+                if tsv:
+                    logger.info(f"Saving output to {fname}.tsv ...")
+                    write_average_tsv(f"{fname}.tsv", averaged_matrices[k], metadata)
+                    s.count(files=1, bytes=os.path.getsize(f"{fname}.tsv"))
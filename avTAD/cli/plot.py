@@ -4,10 +4,12 @@ from __future__ import division, print_function
 from . import cli, get_logger
 import click
 
-import glob
 import numpy as np
 import scipy
-from ..tools import plot_heatmap
+from concurrent.futures import ProcessPoolExecutor
+from ..tools import plot_heatmap, plot_heatmap_grid
+from ..store import list_averages, read_average, average_header
+from .._profiling import stage
 
 @cli.command()
 @click.argument(
@@ -18,7 +20,7 @@ from ..tools import plot_heatmap
     metavar="OUTPUT_PREFIX")
 @click.option(
     "--cmap",
-    help="Name of colormap for plotting. Use one of seaborn/matplotlib names (Reds, RdBu_r).",
+    help="Name of colormap for plotting. Use one of matplotlib names (Reds, RdBu_r).",
     is_flag=False,
     default='RdBu_r',
     show_default=True)
@@ -69,13 +71,36 @@ from ..tools import plot_heatmap
     default=1,
     type=float,
     show_default=True)
-def plot(infile_prefix, output_prefix, cmap, vmax, vmin, center, figsize, cbar, window, autoscale):
+@click.option(
+    "--processes", "-p",
+    help="Number of processes for plotting files concurrently.",
+    is_flag=False,
+    default=1,
+    type=int,
+    show_default=True)
+@click.option(
+    "--grid/--no-grid",
+    help="Plot all files of INFILE_PREFIX as panels of one figure with the shared color scale "
+         "instead of one figure per file. With --autoscale the scale is computed from all files.",
+    is_flag=True,
+    default=False,
+    show_default=True)
+@click.option(
+    "--ncols",
+    help="Number of columns of the grid, square grid by default.",
+    is_flag=False,
+    default=None,
+    type=int,
+    show_default=True)
+def plot(infile_prefix, output_prefix, cmap, vmax, vmin, center, figsize, cbar, window, autoscale, processes, grid, ncols):
     """Plotting average TAD rescaled to the same size.
-    Input is INFILE_PREFIX , output is written to OUTFILE_PREFIX
+    Input is INFILE_PREFIX ({INFILE_PREFIX}.avTAD*.npz or .tsv files), output is written to OUTFILE_PREFIX
 
     File to be created:
         {OUTFILE_PREFIX}.avTAD.png
         {OUTFILE_PREFIX}.avTAD.ch:chrX.png etc. if multiple files are avaiable with INFILE_PREFIX
+    or with --grid:
+        {OUTFILE_PREFIX}.avTAD.grid.png
 
     Example usage:
         avTAD plot --cmap RdBu_r OSC OSC
@@ -84,19 +109,37 @@ def plot(infile_prefix, output_prefix, cmap, vmax, vmin, center, figsize, cbar,
     logger = get_logger(__name__)
     logger.info(f'Reading infile prefixes: {infile_prefix}')
 
-    file_list = glob.glob(f'{infile_prefix}.avTAD*.tsv')
-    modes_list = ['.'+x.split('.')[-2] if not x.split('.')[-2]=='avTAD' else '' for x in file_list ]
+    files = list_averages(infile_prefix)
+    if not files:
+        raise Exception(f"No average TAD files found for {infile_prefix}")
 
-    for f, mode in zip(file_list, modes_list):
-        logger.info(f"Reading {f}")
-        table = np.loadtxt(f, delimiter='\t')
-        comment_line = open(f, 'r').readline()
-        if comment_line.startswith('#'):
-            title = comment_line[1:].split()
-            title = '\n'.join([' '.join(title[(6 * i):(6 * i) + 6]) for i in range(1 + len(title) // 6)])
-        else:
-            title = f"Plotting matrix from {f}"
+    with stage('read_averages', files=len(files)):
+        tables, titles = {}, {}
+        for mode, f in files.items():
+            logger.info(f"Reading {f}")
+            tables[mode], metadata, _ = read_average(f)
+            title = average_header(metadata).split()
+            if title:
+                titles[mode] = '\n'.join([' '.join(title[(6 * i):(6 * i) + 6]) for i in range(1 + len(title) // 6)])
+            else:
+                titles[mode] = f"Plotting matrix from {f}"
+
+    if grid:
+        if autoscale:
+            vmax = np.nanpercentile(np.abs(np.concatenate([table.ravel() for table in tables.values()])), 99)
+            vmin = -vmax
+        if not vmin:
+            vmin = -vmax
+        pngname = f'{output_prefix}.avTAD.grid.png'
+        logger.info(f"Writing {len(tables)} heatmaps to {pngname} with {cmap} color map, vmax={vmax}, vmin={vmin}, center={center}")
+        with stage('plot', figures=1, panels=len(tables)):
+            plot_heatmap_grid(list(tables.values()), pngname, titles=[mode.lstrip('.') or 'all' for mode in tables],
+                              cmap=cmap, center=center, vmax=vmax, vmin=vmin, cbar=cbar, panel_size=figsize/2, ncols=ncols,
+                              window=window, suptitle=infile_prefix)
+        return
 
+    jobs = []
+    for mode, table in tables.items():
         pngname = f'{output_prefix}.avTAD{mode}.png'
         if autoscale:
             mx = np.nanpercentile(np.abs(table.flatten()), 99)
@@ -105,4 +148,17 @@ def plot(infile_prefix, output_prefix, cmap, vmax, vmin, center, figsize, cbar,
         if not vmin:
             vmin = -vmax
         logger.info(f"Writing heatmap to {pngname} with {cmap} color map, vmax={vmax}, vmin={vmin}, center={center}, figsize={figsize}, cbar={cbar}")
-        plot_heatmap(table, pngname, cmap=cmap, center=center, vmax=vmax, title=title, cbar=cbar, figsize=[figsize, figsize], window=window)
\ No newline at end of file
+        jobs.append((table, pngname, dict(cmap=cmap, center=center, vmax=vmax, title=titles[mode], cbar=cbar,
+                                          figsize=[figsize, figsize], window=window)))
+
+    with stage('plot', figures=len(jobs)):
+        if processes > 1:
+            with ProcessPoolExecutor(processes) as executor:
+                list(executor.map(_plot_job, jobs))
+        else:
+            for job in jobs:
+                _plot_job(job)
+
+def _plot_job(job):
+    table, pngname, kwargs = job
+    plot_heatmap(table, pngname, **kwargs)
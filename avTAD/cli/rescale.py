@@ -4,23 +4,20 @@ from __future__ import division, print_function
 from . import cli, get_logger
 import click
 
-import pickle
 import sys
 import os
 import datetime
 now = datetime.datetime.now()
 
-if sys.version_info[0] < 3:
-    from StringIO import StringIO
-else:
-    from io import StringIO
-
 from ..tools import *
+from ..store import open_snips, select_snips, write_average, write_average_tsv
+from ..pipeline import group_labels, group_modes, read_metadata
+from .._profiling import stage
 
 @cli.command()
 @click.argument(
-    "infile_pickle",
-    metavar="INFILE_PICKLE")
+    "infile_snips",
+    metavar="INFILE_SNIPS")
 @click.argument(
     "infile_table",
     metavar="INFILE_TABLE")
@@ -30,15 +27,24 @@ from ..tools import *
 # INFILE_TABLE reading/splitting parameters
 @click.option(
     "--split-by",
-    help="Split by groups of input columns. Split by ch is always available. Use bgn to save individual TADs.",
+    help="Split by groups of input columns. Split by ch is always available. Use bgn to save individual TADs. "
+         "Can be repeated to split by several columns (e.g. --split-by ch --split-by size_class), "
+         "each snip is rescaled once for all of them.",
     metavar="SPLIT_BY",
     is_flag=False,
+    multiple=True,
     default=None,
     show_default=True)
+@click.option(
+    "--total/--no-total",
+    help="With --split-by also save the average of all selected snips, computed in the same pass.",
+    is_flag=True,
+    default=False,
+    show_default=True)
 @click.option(
     "--table-is-indexed/--table-is-not-indexed",
     help="INFILE_TABLE has first index column. If not, then default sequential indexing is used. "
-         "Snips are taken from pickle file according to the index. It should correspond to the step of pickle creation by avTAD snip",
+         "Snips are taken from snips file according to the index. It should correspond to the step of snips file creation by avTAD snip",
     is_flag=True,
     default=True,
     show_default=True)
@@ -51,11 +57,12 @@ from ..tools import *
 @click.option(
     "--query",
     help="Query to pass to INFILE_TABLE while reading pandas dataframe, should be quoted in the terminal. "
+         "Only the columns referenced by the query and --split-by are read from the table. "
          "Example: \"TAD_size>20 and TAD_size<30\" or \"ch=='chrX'\"",
     is_flag=False,
     default=None,
     show_default=True)
-# INFILE_PICKLE snips rescaling parameters
+# INFILE_SNIPS snips rescaling parameters
 @click.option(
     "--rescaled-size",
     help="The resulting size of the average TAD plot after rescaling. Larger size than he max TAD size is recommended.",
@@ -78,109 +85,181 @@ from ..tools import *
     show_default=True)
 @click.option(
     "--operation",
-    help="Operation to perform over each pixel of rescaled image (mean, median, sum, count).",
+    help="Operation to perform over each pixel of rescaled image (mean, median, sum, count, std, sem). "
+         "All operations except median are computed in one pass with memory independent of the number of snips, "
+         "median uses temporary file with rescaled snips.",
     is_flag=False,
     default='mean',
     show_default=True)
+@click.option(
+    "--bootstrap",
+    help="Number of bootstrap resamples of snips for percentile confidence intervals of the average, not computed if 0. "
+         "Snips are resampled within each group, all resamples are accumulated in the same pass as the average. "
+         "Memory is about 3*BOOTSTRAP*RESCALED_SIZE^2*8 bytes per group. Not available for median.",
+    is_flag=False,
+    default=0,
+    type=int,
+    show_default=True)
+@click.option(
+    "--ci",
+    help="Confidence level of bootstrap intervals.",
+    is_flag=False,
+    default=0.95,
+    type=float,
+    show_default=True)
+@click.option(
+    "--bootstrap-strata",
+    help="Input column to stratify bootstrap by: snips are resampled within its values in each group "
+         "(e.g. --bootstrap-strata ch keeps the number of snips of each chromosome in the resamples of the total).",
+    is_flag=False,
+    default=None,
+    show_default=True)
+@click.option(
+    "--seed",
+    help="Seed for bootstrap resampling. Random if not set.",
+    is_flag=False,
+    default=None,
+    type=int,
+    show_default=True)
+@click.option(
+    "--tsv/--no-tsv",
+    help="Also export average matrices as TSV files with the run description in the header.",
+    is_flag=True,
+    default=False,
+    show_default=True)
 
-def rescale(infile_pickle, infile_table, output_prefix, table_is_indexed, table_has_header, query, rescaled_size, save_sum, smooth_order, operation, split_by):
+def rescale(infile_snips, infile_table, output_prefix, table_is_indexed, table_has_header, query, rescaled_size, save_sum, smooth_order, operation, split_by, total, bootstrap, ci, bootstrap_strata, seed, tsv):
     """
-    Rescale snips to the same size and average them based on index. Outputs average TAD matrix in tsv format with header with run metadata.
+    Rescale snips to the same size and average them based on index. Outputs average TAD matrix
+    in npz format with run metadata and accumulated sums and counts (and in tsv format if --tsv).
 
     Output files to be created:
     if no --split-by provided:
-        {OUTPUT_PREFIX}.avTAD.tsv
+        {OUTPUT_PREFIX}.avTAD.npz
     if --split-by SPLIT_BY , then a set of files will be created:
-        {OUTPUT_PREFIX}.avTAD.{SPLIT_BY}:{values}.tsv
+        {OUTPUT_PREFIX}.avTAD.{SPLIT_BY}:{values}.npz
+    for each SPLIT_BY (and {OUTPUT_PREFIX}.avTAD.npz if --total).
+    if --bootstrap, lower and upper bounds of confidence intervals are saved for each average:
+        {OUTPUT_PREFIX}.avTADci{mode}.lower.npz
+        {OUTPUT_PREFIX}.avTADci{mode}.upper.npz
 
     Example usage:
-       avTAD rescale OSC.TADsnips.pickle OSC.TADmetadata.tsv OSC --rescaled-size 200
+       avTAD rescale OSC.TADsnips.hdf5 OSC.TADmetadata.tsv OSC --rescaled-size 200
+       avTAD rescale OSC.TADsnips.hdf5 OSC.TADmetadata.hdf5 OSC --query "TAD_size>20"
     """
 
     logger = get_logger(__name__)
-    logger.info(f"Loading pickle file {infile_pickle} ...")
-
-    # Setting parameter for further averaging operation on snips:
-    if operation=='mean':
-        func = np.nanmean
-    elif operation=='median':
-        func = np.nanmedian
-    elif operation=='sum':
-        func = np.nansum
-    elif operation == 'count':
-        func = lambda x: np.nansum(np.isfinite(x))
-    else:
+    logger.info(f"Opening snips file {infile_snips} ...")
+
+    # Checking parameter for further averaging operation on snips:
+    if not operation in PileupAccumulator.operations+['median']:
         raise Exception(f'Operation {operation} is not implemented... Exiting.')
+    if bootstrap and operation == 'median':
+        raise Exception('Bootstrap is not available for median... Exiting.')
+    if not 0 < ci < 1:
+        raise Exception(f'Confidence level should be between 0 and 1, got {ci}... Exiting.')
 
-    snips = pickle.load(open(infile_pickle, 'rb'))
+    with stage('open_snips') as s:
+        snips = open_snips(infile_snips)
+        s.count(snips=len(snips))
 
     logger.info(f"Performing filtering based on dataframe passed in {infile_table}")
 
-    if infile_table:
-        df_segmentation = pd.read_csv(infile_table, sep='\s',
-                                  header=0 if table_has_header else None,
-                                  index_col=0 if table_is_indexed else None,
-                                  engine='python'
-                                  )
-    else:
-        infile_table = 'stdout'
-        inf = StringIO(sys.stdin)
-        df_segmentation = pd.read_csv(inf, sep='\s',
-                                  header=0 if table_has_header else None,
-                                  index_col=0 if table_is_indexed else None,
-                                  engine='python'
-                                  ).query(query)
+    with stage('read_table') as s:
+        if infile_table and table_has_header:
+            # Only the columns used for splitting and filtering are parsed:
+            columns = list(split_by) + ([bootstrap_strata] if bootstrap_strata else [])
+            try:
+                df_segmentation = read_metadata(infile_table, columns=columns, query=query, index=table_is_indexed)
+            except ValueError as e:
+                raise Exception(str(e))
+        else:
+            if infile_table:
+                df_segmentation = read_metadata(infile_table, header=table_has_header, index=table_is_indexed)
+            else:
+                infile_table = 'stdout'
+                df_segmentation = pd.read_csv(sys.stdin, sep=r'\s+',
+                                              header=0 if table_has_header else None,
+                                              index_col=0 if table_is_indexed else None)
 
-    if not table_has_header:
-        df_segmentation = df_segmentation.loc[:, 0:3]
-        df_segmentation.columns = ['ch', 'bgn', 'end']
+            if not table_has_header:
+                df_segmentation = df_segmentation.loc[:, 0:3]
+                df_segmentation.columns = ['ch', 'bgn', 'end']
 
-    if query:
-        df_segmentation = df_segmentation.query(query)
+            if query:
+                df_segmentation = df_segmentation.query(query)
+        s.count(tads=len(df_segmentation))
 
     assert df_segmentation.index.max() <= len(snips) # segmentation index is probably not aligned with snips if False
 
-    if split_by is None:
-        index = df_segmentation.index
-        logger.info(f"Selecting index from {infile_pickle} ({len(index)} elements) ...")
+    # Each snip is zoomed once and added to the total and to its group for each split column:
+    try:
+        groupings, offsets, labels = group_labels(df_segmentation, split_by, total)
+    except ValueError as e:
+        raise Exception(str(e))
 
-        logger.info(f"Zooming snip arrays to {rescaled_size}x{rescaled_size} ...")
-        snips_rescaled = np.array(
-            zoom(snips[index], finalShape=(rescaled_size, rescaled_size), saveSum=save_sum, order=smooth_order)
-        )
+    if bootstrap:
+        if bootstrap_strata and not bootstrap_strata in df_segmentation.columns:
+            raise Exception(
+                f"{bootstrap_strata} in not in df_segmentation columns. Available choices are: {df_segmentation.columns}")
+        strata = pd.factorize(df_segmentation[bootstrap_strata])[0] if bootstrap_strata else None
+        logger.info(f"Drawing {bootstrap} bootstrap resamples" + (f" stratified by {bootstrap_strata}" if bootstrap_strata else "") + " ...")
+        bootstrap_accumulator = BootstrapAccumulator(bootstrap_weights(labels, bootstrap, strata=strata, seed=seed), labels, offsets[-1],
+                                                     (rescaled_size, rescaled_size), squares=operation in ['std', 'sem'])
+    else:
+        bootstrap_accumulator = None
 
-        logger.info(f"Creating average plot with function {operation} ...")
-        averaged_matrix = func(snips_rescaled, axis=0)
+    index = df_segmentation.index
+    logger.info(f"Selecting index from {infile_snips} ({len(index)} elements) ...")
+    logger.info(f"Zooming snip arrays to {rescaled_size}x{rescaled_size} and averaging them with function {operation} "
+                f"in {offsets[-1]} groups ...")
+    with stage('rescale', snips=len(index), groups=int(offsets[-1])):
+        if operation == 'median':
+            accumulator = None
+            averaged_matrices, counts = average_snips_grouped(select_snips(snips, index), labels, offsets[-1], operation=operation,
+                                                              finalShape=(rescaled_size, rescaled_size), saveSum=save_sum, order=smooth_order)
+        else:
+            accumulator = accumulate_snips_grouped(select_snips(snips, index), labels, offsets[-1],
+                                                   finalShape=(rescaled_size, rescaled_size), saveSum=save_sum, order=smooth_order,
+                                                   bootstrap=bootstrap_accumulator)
+            averaged_matrices, counts = accumulator.result(operation), accumulator.n
+            if bootstrap_accumulator is not None:
+                percentiles = (round(100*(1-ci)/2, 6), round(100*(1+ci)/2, 6))
+                intervals = bootstrap_accumulator.percentiles(operation, percentiles)
 
-        if os.path.isfile(f"{output_prefix}.avTAD.tsv"):
-            logger.warning(f"File {output_prefix}.avTAD.tsv exists, it will be overwritten!")
+    with stage('write_averages') as s:
+        for k, mode, column, name in group_modes(groupings, offsets):
+            metadata = dict(snips=infile_snips, table=infile_table, query=query, operation=operation, n=int(counts[k]),
+                            rescaled_size=rescaled_size, save_sum=save_sum, smooth_order=smooth_order,
+                            date=now.strftime("%Y-%m-%d %H:%M"))
+            metadata['description'] = f'{counts[k]} snips from {infile_snips} as indexed in {infile_table} (query: {query}) averaged by {operation} at {metadata["date"]}'
+            fname = f"{output_prefix}.avTAD{mode}"
+            if column is not None:
+                metadata.update(split_by=column, group=name)
+                metadata['description'] += f' group {name} of {column}'
 
-        logger.info(f"Saving output to {output_prefix}.avTAD.tsv ...")
-        np.savetxt(f'{output_prefix}.avTAD.tsv', averaged_matrix,
-                   header=f'{len(index)} snips from {infile_pickle} as indexed in {infile_table} (query: {query}) averaged by {operation} at {now.strftime("%Y-%m-%d %H:%M")}',
-                   fmt='%.6e', delimiter='\t')
+            if os.path.isfile(f"{fname}.npz"):
+                logger.warning(f"File {fname}.npz exists, it will be overwritten!")
 
-    else:
-        if not split_by in df_segmentation.columns:
-            raise Exception(
-                f"{split_by} in not in df_segmentation columns. Available choices are: {df_segmentation.columns}")
-        for name, group in df_segmentation.groupby(split_by):
-            index = group.index
-            logger.info(f"Selecting index from {infile_pickle}, group {name} of {split_by} ({len(index)} elements) ...")
-
-            logger.info(f"Zooming snip arrays to {rescaled_size}x{rescaled_size} ...")
-            snips_rescaled = np.array(
-                zoom(snips[index], finalShape=(rescaled_size, rescaled_size), saveSum=save_sum, order=smooth_order)
-            )
-
-            logger.info(f"Creating average plot with function {operation} ...")
-            averaged_matrix = func(snips_rescaled, axis=0)
-
-            fname = f"{output_prefix}.avTAD.{split_by}:{name}.tsv"
-            if os.path.isfile(fname):
-                logger.warning(f"File {fname} exists, it will be overwritten!")
-
-            logger.info(f"Saving output to {fname} ...")
-            np.savetxt(fname, averaged_matrix,
-                       header=f'{len(index)} snips from {infile_pickle} as indexed in {infile_table} (query: {query}) averaged by {operation} at {now.strftime("%Y-%m-%d %H:%M")} group {name} of {split_by}',
-                       fmt='%.6e', delimiter='\t')
\ No newline at end of file
+            logger.info(f"Saving output to {fname}.npz ...")
+            write_average(f"{fname}.npz", averaged_matrices[k], metadata,
+                          state=None if accumulator is None else accumulator.group(k).state())
+            s.count(files=1, bytes=os.path.getsize(f"{fname}.npz"))
+            if tsv:
+                logger.info(f"Saving output to {fname}.tsv ...")
+                write_average_tsv(f"{fname}.tsv", averaged_matrices[k], metadata)
+                s.count(files=1, bytes=os.path.getsize(f"{fname}.tsv"))
+
+            if bootstrap_accumulator is None:
+                continue
+            for bound, percentile, interval in zip(['lower', 'upper'], percentiles, intervals):
+                metadata_ci = dict(metadata, bootstrap=bootstrap, ci=ci, percentile=percentile, bootstrap_strata=bootstrap_strata, seed=seed)
+                metadata_ci['description'] = f'{bound} bound of {ci} bootstrap confidence interval ({percentile} percentile of {bootstrap} resamples) of ' + metadata['description']
+                # Bounds are named outside of {output_prefix}.avTAD{mode} averages listed by plot and evaluate:
+                fname_ci = f"{output_prefix}.avTADci{mode}.{bound}"
+                logger.info(f"Saving output to {fname_ci}.npz ...")
+                write_average(f"{fname_ci}.npz", interval[k], metadata_ci)
+                s.count(files=1, bytes=os.path.getsize(f"{fname_ci}.npz"))
+                if tsv:
+                    write_average_tsv(f"{fname_ci}.tsv", interval[k], metadata_ci)
+                    s.count(files=1, bytes=os.path.getsize(f"{fname_ci}.tsv"))
@@ -0,0 +1,148 @@
+import ast
+import numpy as np
+
+# Functions allowed in expressions, all of them are elementwise numpy ufuncs:
+FUNCTIONS = {
+    'abs': np.abs,
+    'sign': np.sign,
+    'sqrt': np.sqrt,
+    'square': np.square,
+    'exp': np.exp,
+    'exp2': np.exp2,
+    'log': np.log,
+    'log2': np.log2,
+    'log10': np.log10,
+    'log1p': np.log1p,
+    'maximum': np.maximum,
+    'minimum': np.minimum,
+    'fmax': np.fmax,
+    'fmin': np.fmin,
+}
+
+OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+    ast.USub: np.negative,
+    ast.UAdd: np.positive,
+}
+
+
+class Expression(object):
+    """
+    Arithmetic expression over named matrices compiled to a sequence of numpy ufunc calls.
+
+    The expression is validated by its syntax tree: only operand names, numeric literals,
+    + - * / ** and functions from FUNCTIONS are allowed. Intermediate results are computed
+    in place with out= into a few preallocated buffers, so no temporaries are created per operation.
+    Operands can be stacks of matrices (e.g. all modes of average TADs at once).
+
+    Example:
+        expr = Expression('log2(a/b)-log2(c/b)', names=['a', 'b', 'c'])
+        result = expr(a=mtx_a, b=mtx_b, c=mtx_c)
+    """
+
+    def __init__(self, expression, names=('a', 'b')):
+        self.expression = expression
+        self.allowed_names = set(names)
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'Cannot parse expression {expression}: {e.msg}')
+
+        # Program is a list of (ufunc, arguments, output register), arguments are
+        # ('name', operand), ('const', value) or ('reg', index):
+        self.names = []
+        self.program = []
+        self.nregisters = 0
+        self._free = []
+        self.result = self._compile(tree.body)
+
+    def _compile(self, node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return ('const', float(node.value))
+        if isinstance(node, ast.Name):
+            if not node.id in self.allowed_names:
+                raise ValueError(f'Unknown name {node.id} in expression {self.expression}, '
+                                 f'allowed names are: {sorted(self.allowed_names)}')
+            if not node.id in self.names:
+                self.names.append(node.id)
+            return ('name', node.id)
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return self._emit(OPERATORS[type(node.op)], [node.left, node.right])
+        if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+            return self._emit(OPERATORS[type(node.op)], [node.operand])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS and not node.keywords:
+            func = FUNCTIONS[node.func.id]
+            if len(node.args) != func.nin:
+                raise ValueError(f'Function {node.func.id} takes {func.nin} arguments in expression {self.expression}')
+            return self._emit(func, node.args)
+        raise ValueError(f'Not allowed in expression {self.expression}: {ast.get_source_segment(self.expression.strip(), node)}. '
+                         f'Only {sorted(self.allowed_names)}, numbers, + - * / ** and functions '
+                         f'{sorted(FUNCTIONS)} are allowed')
+
+    def _emit(self, func, nodes):
+        args = [self._compile(node) for node in nodes]
+        if all(kind == 'const' for kind, _ in args):
+            # Constant subexpressions are evaluated once at compilation:
+            return ('const', float(func(*[value for _, value in args])))
+
+        # Result is written in place to the register of one of the arguments if there is one:
+        registers = [value for kind, value in args if kind == 'reg']
+        for register in registers[1:]:
+            self._free.append(register)
+        if registers:
+            out = registers[0]
+        elif self._free:
+            out = self._free.pop()
+        else:
+            out = self.nregisters
+            self.nregisters += 1
+        self.program.append((func, args, out))
+        return ('reg', out)
+
+    def __call__(self, **operands):
+        missing = [name for name in self.names if not name in operands]
+        if missing:
+            raise ValueError(f'Operands {missing} are required by expression {self.expression}')
+        arrays = {name: np.asarray(operands[name], dtype=np.float64) for name in self.names}
+        shape = np.broadcast_shapes(*[x.shape for x in arrays.values()]) if arrays else ()
+
+        kind, value = self.result
+        if kind == 'const':
+            return np.full(shape, value)
+        if kind == 'name':
+            return np.broadcast_to(arrays[value], shape).copy()
+
+        registers = [np.empty(shape) for _ in range(self.nregisters)]
+        with np.errstate(all='ignore'):
+            for func, args, out in self.program:
+                values = [arrays[value] if kind == 'name' else registers[value] if kind == 'reg' else value
+                          for kind, value in args]
+                func(*values, out=registers[out])
+        return registers[value]
+
+
+def evaluate_modes(expression, operands):
+    """
+    Evaluate compiled Expression for all modes at once.
+    operands is dict of dicts: operand name -> mode -> matrix. Modes available for all operands
+    of the expression are stacked and evaluated in one vectorized batch per matrix shape.
+    Infinite values are replaced by NaN. Returns dict of resulting matrices by mode.
+    """
+    names = expression.names
+    modes = [mode for mode in operands[names[0]] if all(mode in operands[name] for name in names)] if names else []
+    by_shape = {}
+    for mode in modes:
+        by_shape.setdefault(tuple(np.broadcast_shapes(*[np.shape(operands[name][mode]) for name in names])), []).append(mode)
+
+    ret = {}
+    for shape, group in by_shape.items():
+        stacks = {name: np.stack([np.broadcast_to(operands[name][mode], shape) for mode in group]) for name in names}
+        result = expression(**stacks)
+        result[np.isinf(result)] = np.nan
+        for mode, mtx in zip(group, result):
+            ret[mode] = mtx
+    return ret
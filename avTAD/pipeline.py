@@ -0,0 +1,447 @@
+import os
+import h5py
+import numpy as np
+import pandas as pd
+
+from .tools import read_map, BandedMatrix, ObsExpView, HiclibChromosome, lazy_expected, expected_extent, \
+    shuffle_segmentations, tad_enrichment, sequential_pvalues, iter_snips, map_with_shared_arrays, map_with_memory_budget, accumulate_snips_grouped
+from .store import write_snips, write_metadata_columns, read_metadata_columns, query_columns
+from ._logging import get_logger
+from ._profiling import stage
+
+
+def table_separator(fname):
+    """
+    Separator of a text table for the fast C parser of pandas: tabs if the first line has them
+    (empty fields of NaNs are kept), any whitespace otherwise or if fname is a pipe that cannot be read twice.
+    """
+    if not os.path.isfile(fname):
+        return r'\s+'
+    with open(fname, 'r') as f:
+        line = f.readline()
+    return '\t' if '\t' in line else r'\s+'
+
+
+def read_segmentation(fname):
+    """ Read BED-like file with TADs. Returns dataframe with ch, bgn, end and additional columns, and names of additional columns. """
+    df_segmentation = pd.read_csv(fname, sep=table_separator(fname), header=None)
+    add_columns  = list(df_segmentation.columns[3:]) if len(df_segmentation.columns)>3 else []
+    df_segmentation.columns = ['ch', 'bgn', 'end'] + add_columns
+    return df_segmentation, add_columns
+
+
+def bin_segmentation(df_segmentation, resolution):
+    """ Add TAD coordinates in bins of resolution, drop duplicates and sort TADs by chromosome and start. """
+    df_segmentation = df_segmentation.copy()
+    df_segmentation.loc[:, 'bgn_bin'] = df_segmentation.bgn // resolution
+    df_segmentation.loc[:, 'end_bin'] = df_segmentation.end // resolution
+    df_segmentation.loc[:, 'TAD_size'] = df_segmentation.end_bin - df_segmentation.bgn_bin
+
+    return df_segmentation.drop_duplicates().sort_values(['ch', 'bgn_bin']).reset_index(drop=True)
+
+
+def max_window(df_segmentation, window=1, enrichment_only=False):
+    """ The widest window in bins: TAD with +-window TADs, or just TAD if only enrichment is needed. """
+    if len(df_segmentation) == 0:
+        return 0
+    tad_window = df_segmentation.TAD_size if enrichment_only else \
+        df_segmentation.TAD_size + 2*(window*df_segmentation.TAD_size).astype(int)
+    return int(tad_window.max())
+
+
+def add_shuffled_segmentations(df_segmentation, niter, seed=None):
+    """
+    Add columns bgn_bin_shuf{i} and end_bin_shuf{i} with niter shuffles of the segmentation,
+    created for all iterations at once. Each chromosome has its own random generator derived from the seed.
+    """
+    groups = df_segmentation.groupby('ch')
+    shuffled = np.zeros((niter, len(df_segmentation), 2), dtype=np.int64)
+    for (ch, group), seed_ch in zip(groups, np.random.SeedSequence(seed).spawn(groups.ngroups)):
+        shuffled[:, group.index, :] = shuffle_segmentations(group[['bgn_bin', 'end_bin']].values, niter, seed=seed_ch)
+
+    df_shuffled = pd.DataFrame({f'{key}_shuf{i}': shuffled[i, :, k]
+                                for i in range(niter) for k, key in enumerate(['bgn_bin', 'end_bin'])},
+                               index=df_segmentation.index)
+    return pd.concat([df_segmentation, df_shuffled], axis=1)
+
+
+def add_enrichment(df_segmentation, dataset_obsexp, niter=0, median=False):
+    """ Add sum, mean, median and nelements columns for observed and all shuffled segmentations. """
+    mods = ['']+[f'_shuf{i}' for i in range(niter)]
+    enrichments = np.full((len(mods), len(df_segmentation), 4), np.nan)
+    for ch, group in df_segmentation.groupby('ch'):
+        bgns = group[[f'bgn_bin{mod}' for mod in mods]].values.T
+        ends = group[[f'end_bin{mod}' for mod in mods]].values.T
+        enrichments[:, group.index, :] = tad_enrichment(dataset_obsexp[ch], bgns, ends, median=median)
+
+    columns = {}
+    for k, mod in enumerate(mods):
+        columns[f"sum{mod}"]       = enrichments[k, :, 0]
+        columns[f"mean{mod}"]      = enrichments[k, :, 1]
+        columns[f"median{mod}"]    = enrichments[k, :, 2]
+        columns[f"nelements{mod}"] = enrichments[k, :, 3]
+    df_enrichment = pd.DataFrame(columns, index=df_segmentation.index)
+    return pd.concat([df_segmentation.drop(columns=df_enrichment.columns, errors='ignore'), df_enrichment], axis=1)
+
+
+def add_pvalues(df_segmentation, dataset_obsexp, max_niter, hits=10, batch=100, seed=None):
+    """
+    Add columns pvalue, null_mean, null_std and null_niter with sequential Monte Carlo p-values of the mean
+    enrichment of TADs (see sequential_pvalues), chromosome by chromosome. Generators of chromosomes are spawned
+    from the seed after those of add_shuffled_segmentations, so the null draws do not repeat the written shuffles.
+    """
+    groups = df_segmentation.groupby('ch')
+    pvalues = np.full((len(df_segmentation), 4), np.nan)
+    seeds = np.random.SeedSequence(seed).spawn(2*groups.ngroups)[groups.ngroups:]
+    for (ch, group), seed_ch in zip(groups, seeds):
+        pvalues[group.index] = sequential_pvalues(dataset_obsexp[ch], group[['bgn_bin', 'end_bin']].values,
+                                                  group['mean'].values, max_niter, hits=hits, batch=batch, seed=seed_ch)
+
+    df_pvalues = pd.DataFrame({'pvalue': pvalues[:, 0], 'null_mean': pvalues[:, 1], 'null_std': pvalues[:, 2],
+                               'null_niter': pvalues[:, 3].astype(np.int64)}, index=df_segmentation.index)
+    return pd.concat([df_segmentation.drop(columns=df_pvalues.columns, errors='ignore'), df_pvalues], axis=1)
+
+
+# Formats of TAD metadata written by snip:
+METADATA_FORMATS = ['tsv', 'hdf5']
+
+
+def write_metadata(df_segmentation, fname, add_columns=(), niter=0, format='tsv', pvalues=False):
+    """ Write TAD metadata as TSV table or columnar HDF5 file (format='hdf5'), with p-values columns if pvalues. """
+    cols = ['bgn_bin', 'end_bin', 'sum', 'mean', 'median', 'nelements']
+    columns = ['ch', 'bgn', 'end', 'TAD_size']+list(add_columns)+cols+[f'{x}_shuf{i}' for i in range(niter) for x in cols]
+    if pvalues:
+        columns += ['pvalue', 'null_mean', 'null_std', 'null_niter']
+    if format == 'tsv':
+        df_segmentation[columns].to_csv(fname, sep='\t', index=True, header=True)
+    elif format == 'hdf5':
+        write_metadata_columns(fname, df_segmentation[columns])
+    else:
+        raise ValueError(f'Metadata format {format} is not supported')
+
+
+def read_metadata(fname, columns=None, query=None, header=True, index=True, chunksize=2**20):
+    """
+    Read TAD metadata written by snip: columnar HDF5 file or TSV table (any whitespace-separated table
+    with the header, or without it if not header). Only columns (all by default) and columns referenced
+    by query are parsed, rows are filtered by query chunk by chunk of chunksize TADs.
+    """
+    if os.path.isfile(fname) and h5py.is_hdf5(fname):
+        return read_metadata_columns(fname, columns=columns, query=query, chunksize=chunksize)
+
+    sep = table_separator(fname)
+    referenced = query_columns(query) if query else set()
+    usecols = None
+    if header and sep == '\t' and columns is not None and referenced is not None:
+        with open(fname, 'r') as f:
+            names = f.readline().rstrip('\n').split('\t')
+        missing = [column for column in columns if not column in names]
+        if missing:
+            raise ValueError(f"{missing} not in columns of {fname}. Available choices are: {names[1 if index else 0:]}")
+        usecols = [k for k, name in enumerate(names) if (index and k == 0) or name in set(columns) | referenced]
+    chunks = [df.query(query) if query else df
+              for df in pd.read_csv(fname, sep=sep, header=0 if header else None, index_col=0 if index else None,
+                                    usecols=usecols, chunksize=chunksize)]
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks)
+
+
+def _write_snips_job(dataset, segmentations, fname, key_bgn, key_end, window, dtype='float64', compression=None):
+    write_snips(fname, iter_snips(segmentations=segmentations,
+                                  dataset=dataset,
+                                  window=window,
+                                  key_bgn=key_bgn,
+                                  key_end=key_end),
+                dtype=dtype, compression=compression)
+    return fname
+
+
+def write_snips_files(df_segmentation, dataset_obsexp, output_prefix, niter=0, window=1, processes=1,
+                      dtype='float64', compression=None):
+    """
+    Retrieve snippets (log2 and filling inf with nans included) of observed and shuffled segmentations
+    and write them as they are retrieved to {output_prefix}.TADsnips{_shufN}.hdf5, one file per segmentation,
+    with dtype and compression of SnipWriter. With processes > 1 files are written by worker processes sharing obs/exp maps.
+    """
+    logger = get_logger(__name__)
+    mods = ['']+[f'_shuf{i}' for i in range(niter)]
+    jobs = [(df_segmentation[['ch', f'bgn_bin{mod}', f'end_bin{mod}']], f"{output_prefix}.TADsnips{mod}.hdf5",
+             f'bgn_bin{mod}', f'end_bin{mod}', window, dtype, compression) for mod in mods]
+    if processes > 1:
+        logger.info(f"Writing snips for {len(jobs)} segmentations with {processes} processes ...")
+    with stage('write_snips', files=len(jobs), snips=len(jobs)*len(df_segmentation)) as s:
+        for fname in map_with_shared_arrays(_write_snips_job, jobs, dataset_obsexp, processes=processes):
+            logger.info(f"Snips written to {fname}")
+            s.count(bytes=os.path.getsize(fname))
+
+
+def enrich_segmentation(dataset_obsexp, df_segmentation, niter=0, seed=None, median=False,
+                        pvalue_niter=0, pvalue_hits=10, pvalue_batch=100):
+    """
+    Shuffled controls and enrichment of TAD interactions of a binned segmentation, computed in memory.
+    With pvalue_niter, p-values of TAD enrichment from up to pvalue_niter shuffles are added (see add_pvalues).
+    Returns the dataframe with TAD metadata.
+    """
+    logger = get_logger(__name__)
+
+    # Creating shuffled segmentations for all iterations at once:
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    if niter:
+        logger.info(f"Shuffling segmentation {niter} times with seed {seed} ...")
+    with stage('shuffle', tads=len(df_segmentation), segmentations=niter):
+        df_segmentation = add_shuffled_segmentations(df_segmentation, niter, seed=seed)
+
+    # Computing enrichment for all segmentations (observed and shuffled) chromosome by chromosome:
+    with stage('enrichment', tads=len(df_segmentation), segmentations=niter+1):
+        df_segmentation = add_enrichment(df_segmentation, dataset_obsexp, niter=niter, median=median)
+
+    # Sequential p-values from shuffles drawn in batches until TADs are decided:
+    if pvalue_niter:
+        logger.info(f"Computing p-values of enrichment with up to {pvalue_niter} shuffles, "
+                    f"stopping after {pvalue_hits} exceedances ...")
+        with stage('pvalues', tads=len(df_segmentation)) as s:
+            df_segmentation = add_pvalues(df_segmentation, dataset_obsexp, pvalue_niter, hits=pvalue_hits,
+                                          batch=pvalue_batch, seed=seed)
+            s.count(shuffles=int(df_segmentation.null_niter.sum()))
+
+    return df_segmentation
+
+
+def save_metadata(df_segmentation, output_prefix, add_columns=(), niter=0, format='tsv', pvalues=False):
+    """ Write TAD metadata to {output_prefix}.TADmetadata.{format}, returns the file name. """
+    with stage('write_metadata') as s:
+        fname = f"{output_prefix}.TADmetadata.{format}"
+        write_metadata(df_segmentation, fname, add_columns=add_columns, niter=niter, format=format, pvalues=pvalues)
+        s.count(bytes=os.path.getsize(fname))
+    return fname
+
+
+def snip_segmentation(dataset_obsexp, df_segmentation, output_prefix, add_columns=(), niter=0, seed=None,
+                      window=1, median=False, enrichment_only=False, processes=1, snip_dtype='float64', compression=None,
+                      metadata_format='tsv', pvalue_niter=0, pvalue_hits=10, pvalue_batch=100):
+    """
+    Snipping of a binned segmentation: shuffled controls, enrichment of TAD interactions (see enrich_segmentation)
+    written to {output_prefix}.TADmetadata.tsv (or .hdf5 with metadata_format='hdf5') and, if not enrichment_only,
+    snips of observed and shuffled TADs written with snip_dtype and compression.
+    Returns the dataframe with TAD metadata.
+    """
+    df_segmentation = enrich_segmentation(dataset_obsexp, df_segmentation, niter=niter, seed=seed, median=median,
+                                          pvalue_niter=pvalue_niter, pvalue_hits=pvalue_hits, pvalue_batch=pvalue_batch)
+
+    # Save enrichment dataframe to a file:
+    save_metadata(df_segmentation, output_prefix, add_columns=add_columns, niter=niter, format=metadata_format,
+                  pvalues=bool(pvalue_niter))
+
+    if not enrichment_only:
+        write_snips_files(df_segmentation, dataset_obsexp, output_prefix, niter=niter, window=window, processes=processes,
+                          dtype=snip_dtype, compression=compression)
+
+    return df_segmentation
+
+
+def group_labels(df_segmentation, split_by=(), total=False):
+    """
+    Groups of TADs for averaging in one pass: all TADs (if total or no split_by) and groups of values
+    of each split_by column. Returns groupings as (column, names of groups, codes of TADs), with None column
+    and names for all TADs, offsets of groupings in the consecutive numbering of groups
+    and (ngroupings, number of TADs) array of labels as in average_snips_grouped.
+    """
+    groupings = []
+    if not split_by or total:
+        groupings.append((None, None, np.zeros(len(df_segmentation), dtype=np.int64)))
+    for column in split_by:
+        if not column in df_segmentation.columns:
+            raise ValueError(f"{column} in not in df_segmentation columns. Available choices are: {df_segmentation.columns}")
+        codes, names = pd.factorize(df_segmentation[column], sort=True)
+        groupings.append((column, names, codes))
+
+    offsets = np.cumsum([0]+[1 if names is None else len(names) for _, names, _ in groupings])
+    labels = np.array([np.where(codes < 0, -1, codes+offset) for (_, _, codes), offset in zip(groupings, offsets)])
+    return groupings, offsets, labels.reshape(len(groupings), len(df_segmentation))
+
+
+def group_modes(groupings, offsets):
+    """ Index, mode ('' for all TADs and '.{column}:{name}' for groups), column and name of each group of group_labels. """
+    ret = []
+    for (column, names, _), offset in zip(groupings, offsets):
+        for k, name in enumerate([None] if names is None else names):
+            name = name.item() if isinstance(name, np.generic) else name
+            ret.append((offset+k, '' if column is None else f'.{column}:{name}', column, name))
+    return ret
+
+
+def _pileup_job(dataset, segmentations, key_bgn, key_end, labels, ngroups, window, finalShape, saveSum, order):
+    return accumulate_snips_grouped(iter_snips(segmentations, dataset, window=window, key_bgn=key_bgn, key_end=key_end),
+                                    labels, ngroups, finalShape=finalShape, saveSum=saveSum, order=order)
+
+
+def pileup_segmentation(df_segmentation, dataset_obsexp, labels, ngroups, niter=0, window=1,
+                        finalShape=(200, 200), saveSum=True, order=1, processes=1):
+    """
+    Fused snipping and averaging: snips (log2 and filling inf with nans included) of observed
+    and shuffled segmentations are extracted, zoomed by batches to finalShape and added
+    to GroupedPileupAccumulator of ngroups groups with labels as in average_snips_grouped.
+    Snips are never written, memory is the obs/exp maps and one batch of snips.
+    With processes > 1 segmentations are processed by worker processes sharing obs/exp maps.
+    Returns accumulators by segmentation: '' for observed and '_shuf{i}' for shuffled.
+    """
+    mods = ['']+[f'_shuf{i}' for i in range(niter)]
+    jobs = [(df_segmentation[['ch', f'bgn_bin{mod}', f'end_bin{mod}']], f'bgn_bin{mod}', f'end_bin{mod}',
+             labels, ngroups, window, tuple(finalShape), saveSum, order) for mod in mods]
+    with stage('pileup', segmentations=len(jobs), snips=len(jobs)*len(df_segmentation), groups=int(ngroups)):
+        return dict(zip(mods, map_with_shared_arrays(_pileup_job, jobs, dataset_obsexp, processes=processes)))
+
+
+def _obsexp_job(mtx, max_offset, lazy=False, diagonals_to_remove=1):
+    """
+    Expected vector (if lazy) or banded observed over expected of a chromosome view, returned
+    together with the view, which keeps balancing weights computed on reading (for hiclib maps).
+    The band is extended to the end of the last group of diagonals used for expected.
+    """
+    if lazy:
+        return mtx, lazy_expected(mtx, max_offset)
+    n = len(mtx)
+    band = BandedMatrix.from_dense(mtx, min(expected_extent(n, max_offset), n-1))
+    band.observed_over_expected(diagonals_to_remove=diagonals_to_remove)
+    return mtx, band
+
+
+class HiCMap(object):
+    """
+    Hi-C map opened for snipping. Chromosomes, resolution and lengths are available after opening,
+    observed over expected maps are computed on request, only for the diagonals up to max_offset,
+    and kept for further requests that do not need more diagonals.
+
+    Maps are read by blocks one chromosome at a time, so only the bands around the main diagonal are kept in memory.
+    With lazy=True obs/exp is computed on the fly for each requested window.
+    If cache (ObsExpCache) is provided, obs/exp computed by previous runs is taken from it,
+    and the map file is not read unless something is missing.
+    """
+
+    def __init__(self, fname, format='cool', balance=True, diagonals_to_remove=1, lazy=False, cache=None):
+        self.fname = fname
+        self.format = format
+        self.balance = balance
+        self.diagonals_to_remove = diagonals_to_remove
+        self.lazy = lazy
+        self.cache = cache
+        self.logger = get_logger(__name__)
+        self.dataset = None
+        self.obsexp = {}
+
+        self.cache_key = cache.key(fname, format=format, balance=balance, diagonals_to_remove=diagonals_to_remove) if cache else None
+        cache_info = cache.info(self.cache_key) if cache else None
+        if cache_info is None or lazy:
+            with stage('read_map') as s:
+                self.read()
+                s.count(chromosomes=len(self.chrms))
+            if cache and cache_info is None:
+                cache.create(self.cache_key, map=os.path.abspath(fname), format=format, balance=balance,
+                             diagonals_to_remove=diagonals_to_remove, chrms=self.chrms,
+                             resolution=int(self.resolution), lengths=self.lengths)
+        else:
+            self.logger.info(f"Found {fname} with balance={balance} in {format} format in cache {cache.path(self.cache_key)}")
+            self.chrms, self.resolution, self.lengths = cache_info['chrms'], cache_info['resolution'], cache_info['lengths']
+
+    def read(self):
+        self.logger.info(f"Reading {self.fname} file with balance={self.balance} in {self.format} format ...")
+        # Maps are always read by blocks, only the band around the main diagonal is kept in memory:
+        self.dataset, self.chrms, self.resolution = read_map(self.fname, format=self.format, balance=self.balance, lazy=True)
+        self.lengths = {ch: len(self.dataset[ch]) for ch in self.chrms}
+
+    def obsexp_memory(self, ch, max_offset, chunksize=1000):
+        """ Rough estimate of memory in bytes needed to compute observed over expected of the chromosome. """
+        n = self.lengths[ch]
+        width = min(expected_extent(n, max_offset), n-1)+1
+        # Blocks of chunksize rows read from the map, the band with its mask and temporary copy,
+        # and the whole chromosome matrix with its copy for iterative correction of hiclib maps:
+        memory = 2*8*min(chunksize, n)*min(chunksize+width, n)
+        if not self.lazy:
+            memory += 3*8*n*width
+        mtx = self.dataset[ch] if self.dataset is not None else None
+        if isinstance(mtx, HiclibChromosome) and mtx.balance and mtx.weights is None:
+            memory += 2*8*n*n
+        return memory
+
+    def memory(self):
+        """ Memory in bytes taken by arrays kept for further requests: observed over expected maps and balancing weights. """
+        memory = sum(mtx.data.nbytes if isinstance(mtx, BandedMatrix) else np.asarray(mtx.expected).nbytes
+                     for mtx in self.obsexp.values())
+        if self.dataset is not None:
+            memory += sum(np.asarray(mtx.weights).nbytes for mtx in self.dataset.values()
+                          if getattr(mtx, 'weights', None) is not None)
+        return memory
+
+    def _available_obsexp(self, ch, max_offset):
+        """ Observed over expected with at least max_offset diagonals computed before or cached, None if not available. """
+        mtx = self.obsexp.get(ch, None)
+        if mtx is not None:
+            if self.lazy and len(mtx.expected) > expected_extent(self.lengths[ch], max_offset):
+                return mtx
+            if not self.lazy and mtx.max_offset >= max_offset:
+                return mtx
+        if self.cache is None:
+            return None
+
+        cache, key = self.cache, self.cache_key
+        if self.lazy:
+            expected = cache.get(key, ch, kind='expected')
+            if expected is None or len(expected) <= expected_extent(self.lengths[ch], max_offset):
+                return None
+            mtx = ObsExpView(self.dataset[ch], expected, diagonals_to_remove=self.diagonals_to_remove)
+        else:
+            band = cache.get(key, ch, kind='band')
+            if band is None or band.shape[1] <= max_offset:
+                return None
+            mtx = BandedMatrix(band[:, :max_offset+1])
+        self.obsexp[ch] = mtx
+        return mtx
+
+    def _store_obsexp(self, ch, view, result):
+        """ Keep (and cache) observed over expected computed by _obsexp_job for the chromosome view. """
+        cache, key = self.cache, self.cache_key
+        if self.lazy:
+            # The view computed in another process keeps the balancing weights of hiclib maps:
+            self.dataset[ch] = view
+            if cache:
+                cache.put(key, ch, result, kind='expected')
+            mtx = ObsExpView(view, result, diagonals_to_remove=self.diagonals_to_remove)
+        else:
+            if cache:
+                cache.put(key, ch, result.data, kind='band')
+            mtx = result
+        self.obsexp[ch] = mtx
+        return mtx
+
+    def get_obsexp(self, ch, max_offset):
+        """ Observed over expected map of a chromosome with at least max_offset diagonals. """
+        return self.get_obsexp_maps([ch], max_offset)[ch]
+
+    def get_obsexp_maps(self, chrms, max_offset, processes=1, threads=1, max_memory=None):
+        """
+        Dict of observed over expected maps for chromosomes with at least max_offset diagonals.
+        Balancing (for hiclib maps) and obs/exp of chromosomes that are not available yet are computed
+        concurrently by processes (or threads), chromosomes are started while the estimated memory
+        of running chromosomes (see obsexp_memory) is within max_memory bytes. Results do not depend
+        on the number of processes.
+        """
+        self.logger.info(f"Computing observed over expected for {max_offset} diagonals ...")
+        with stage('obsexp', chromosomes=len(chrms), diagonals=max_offset):
+            ret = {ch: self._available_obsexp(ch, max_offset) for ch in chrms}
+            missing = [ch for ch in chrms if ret[ch] is None]
+            if missing and self.dataset is None:
+                with stage('read_map') as s:
+                    self.read()
+                    s.count(chromosomes=len(self.chrms))
+            jobs = [(self.dataset[ch], max_offset, self.lazy, self.diagonals_to_remove) for ch in missing]
+            memory = [self.obsexp_memory(ch, max_offset) for ch in missing]
+            if len(missing) > 1 and max(processes, threads) > 1:
+                self.logger.info(f"Computing observed over expected for {len(missing)} chromosomes with "
+                                 f"{processes if processes > 1 else threads} {'processes' if processes > 1 else 'threads'} ...")
+            results = map_with_memory_budget(_obsexp_job, jobs, memory, processes=processes if len(missing) > 1 else 1,
+                                             threads=threads if len(missing) > 1 else 1, max_memory=max_memory)
+            for ch, (view, result) in zip(missing, results):
+                ret[ch] = self._store_obsexp(ch, view, result)
+        if self.cache:
+            self.cache.evict(keep=[self.cache_key])
+        return ret
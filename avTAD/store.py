@@ -0,0 +1,313 @@
+import ast
+import glob
+import json
+import pickle
+import h5py
+import numpy as np
+import pandas as pd
+
+from ._version import __format_version__
+from ._logging import get_logger
+
+
+class SnipWriter(object):
+    """
+    Writer of the snips container: HDF5 file with one flat float buffer of all snips
+    and the index of their offsets in the buffer and shapes:
+
+        snips/data      float64, float32 or float16 (total number of pixels, )
+        snips/offsets   int64   (number of snips + 1, )
+        snips/shapes    int64   (number of snips, 2)
+
+    Snips are appended one by one and written by chunks, so the whole set
+    is never kept in memory. The data can be written with reduced precision (dtype)
+    and compressed by chunks with gzip or lzf after byte shuffling (compression).
+
+    Example:
+        with SnipWriter('OSC.TADsnips.hdf5', dtype='float32', compression='gzip') as writer:
+            for mtx in snips:
+                writer.append(mtx)
+    """
+
+    dtypes = ['float64', 'float32', 'float16']
+    compressions = ['none', 'gzip', 'lzf']
+
+    def __init__(self, fname, chunksize=2**20, dtype='float64', compression=None):
+        if not str(np.dtype(dtype)) in self.dtypes:
+            raise ValueError(f'Snips dtype {dtype} is not supported, available dtypes are: {self.dtypes}')
+        compression = None if compression in [None, 'none'] else compression
+        if not (compression is None or compression in self.compressions):
+            raise ValueError(f'Snips compression {compression} is not supported, available compressions are: {self.compressions}')
+        self.fname = fname
+        self.chunksize = chunksize
+        self.dtype = np.dtype(dtype)
+        self.f = h5py.File(fname, 'w')
+        self.f.attrs['format'] = 'avTAD::TADsnips'
+        self.f.attrs['format_version'] = __format_version__
+        grp = self.f.create_group('snips')
+        self.data = grp.create_dataset('data', shape=(0,), maxshape=(None,), dtype=self.dtype,
+                                       chunks=(min(chunksize, 2**16),), compression=compression,
+                                       shuffle=compression is not None)
+        self.offsets = [0]
+        self.shapes = []
+        self.buffer = []
+        self.buffer_size = 0
+
+    def append(self, mtx):
+        mtx = np.asarray(mtx, dtype=self.dtype)
+        self.buffer.append(mtx.ravel())
+        self.buffer_size += mtx.size
+        self.offsets.append(self.offsets[-1] + mtx.size)
+        self.shapes.append(mtx.shape)
+        if self.buffer_size >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        bgn = len(self.data)
+        self.data.resize((bgn + self.buffer_size,))
+        self.data[bgn:] = np.concatenate(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def close(self):
+        if self.f is None:
+            return
+        self.flush()
+        grp = self.f['snips']
+        grp.create_dataset('offsets', data=np.array(self.offsets, dtype=np.int64))
+        grp.create_dataset('shapes', data=np.array(self.shapes, dtype=np.int64).reshape(-1, 2))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_snips(fname, snips, **kwargs):
+    """ Write an iterable of 2D snips to the HDF5 container. Returns the number of snips written. """
+    with SnipWriter(fname, **kwargs) as writer:
+        for mtx in snips:
+            writer.append(mtx)
+    return len(writer.shapes)
+
+
+class SnipStore(object):
+    """
+    Read-only access to snips container written by SnipWriter.
+    Only the index is loaded on opening, snips are read from the flat buffer on request
+    and returned as float64 whatever the precision of the file:
+
+        store = SnipStore('OSC.TADsnips.hdf5')
+        mtx = store[0]
+        mtxs = store[[0, 5, 10]]   # list of snips
+    """
+
+    def __init__(self, fname, buffer_size=2**22):
+        self.fname = fname
+        self.buffer_size = buffer_size
+        self.f = h5py.File(fname, 'r')
+        grp = self.f['snips']
+        self.data = grp['data']
+        self.offsets = grp['offsets'][()]
+        self.shapes = grp['shapes'][()]
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get(self, i):
+        bgn, end = self.offsets[i], self.offsets[i+1]
+        return self.data[bgn:end].reshape(self.shapes[i]).astype(np.float64)
+
+    def __getitem__(self, index):
+        if np.isscalar(index):
+            return self.get(int(index))
+        if isinstance(index, slice):
+            index = range(*index.indices(len(self)))
+        return [self.get(int(i)) for i in index]
+
+    def iter(self, index=None):
+        """
+        Iterate over snips selected by index (all by default) one by one.
+        Runs of increasing indices are read by blocks of up to buffer_size pixels,
+        so that each chunk of compressed data is decompressed once.
+        """
+        index = np.arange(len(self)) if index is None else np.asarray(index, dtype=np.int64)
+        k = 0
+        while k < len(index):
+            bgn = self.offsets[index[k]]
+            run = k+1
+            while run < len(index) and index[run] > index[run-1] and self.offsets[index[run]+1] - bgn <= self.buffer_size:
+                run += 1
+            block = self.data[bgn:self.offsets[index[run-1]+1]]
+            for i in index[k:run]:
+                yield block[self.offsets[i]-bgn:self.offsets[i+1]-bgn].reshape(self.shapes[i]).astype(np.float64)
+            k = run
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_snips(fname):
+    """
+    Open snips file written by avTAD snip: HDF5 snips container or
+    pickle with the array of snips created by older versions of avTAD.
+    """
+    if h5py.is_hdf5(fname):
+        return SnipStore(fname)
+
+    logger = get_logger(__name__)
+    logger.warning(f"{fname} is not a snips container, reading it as legacy pickle. "
+                   f"The whole file will be loaded into memory, only open pickles from trusted sources.")
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+
+def select_snips(snips, index):
+    """ Iterate over snips selected by index from SnipStore or legacy array of snips. """
+    if isinstance(snips, SnipStore):
+        return snips.iter(index)
+    return (snips[i] for i in index)
+
+
+def write_metadata_columns(fname, df):
+    """
+    Write TAD metadata to the columnar HDF5 container, one typed dataset per column:
+
+        metadata/index          int64   (number of TADs, )
+        metadata/columns/{k}    numeric, bool or UTF-8 bytes for strings (number of TADs, )
+
+    Names of columns in their order are kept in the columns attribute of the metadata group.
+    Written by snip with --metadata-format hdf5, read by read_metadata_columns.
+    """
+    with h5py.File(fname, 'w') as f:
+        f.attrs['format'] = 'avTAD::TADmetadata'
+        f.attrs['format_version'] = __format_version__
+        grp = f.create_group('metadata')
+        grp.attrs['columns'] = json.dumps([str(column) for column in df.columns])
+        grp.create_dataset('index', data=np.asarray(df.index, dtype=np.int64))
+        columns = grp.create_group('columns')
+        for k, column in enumerate(df.columns):
+            values = df[column].values
+            if values.dtype.kind in 'biuf':
+                columns.create_dataset(str(k), data=values)
+            else:
+                columns.create_dataset(str(k), data=np.char.encode(np.asarray(values, dtype=str), 'utf-8'))
+                columns[str(k)].attrs['kind'] = 'str'
+
+
+def query_columns(query):
+    """ Names referenced by pandas query, None if it is not a python expression (e.g. with backticks or @). """
+    try:
+        tree = ast.parse(query.strip(), mode='eval')
+    except SyntaxError:
+        return None
+    return set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+
+
+def _read_column(dataset, bgn, end):
+    values = dataset[bgn:end]
+    return np.char.decode(values, 'utf-8').astype(object) if dataset.attrs.get('kind') == 'str' else values
+
+
+def read_metadata_columns(fname, columns=None, query=None, chunksize=2**20):
+    """
+    Read TAD metadata written by write_metadata_columns. Only columns (all by default) and columns
+    referenced by query are read, rows are filtered by query chunk by chunk of chunksize TADs.
+    Returns dataframe indexed as written.
+    """
+    with h5py.File(fname, 'r') as f:
+        grp = f['metadata']
+        names = json.loads(grp.attrs['columns'])
+        if columns is not None:
+            missing = [column for column in columns if not column in names]
+            if missing:
+                raise ValueError(f"{missing} not in columns of {fname}. Available choices are: {names}")
+        referenced = query_columns(query) if query else set()
+        if columns is None or referenced is None:
+            selected = names
+        else:
+            selected = [name for name in names if name in set(columns) | referenced]
+
+        datasets = {name: grp['columns'][str(names.index(name))] for name in selected}
+        index = grp['index']
+        chunks = []
+        for bgn in range(0, max(len(index), 1), chunksize):
+            df = pd.DataFrame({name: _read_column(dataset, bgn, bgn+chunksize) for name, dataset in datasets.items()},
+                              index=index[bgn:bgn+chunksize])
+            chunks.append(df.query(query) if query else df)
+    return chunks[0] if len(chunks) == 1 else pd.concat(chunks)
+
+
+def average_header(metadata):
+    """ One-line description of the average matrix, as in the header of TSV files. """
+    return metadata.get('description', '')
+
+
+def write_average(fname, matrix, metadata=None, state=None):
+    """
+    Write average matrix to the binary .npz container:
+
+        matrix          float64 (size, size)    average matrix
+        metadata        JSON string             run parameters and description
+        sum, sumsq      float64 (size, size)    state of PileupAccumulator (if provided),
+        count           int64   (size, size)    enough to recombine averages exactly
+        n               int64   ()
+
+    Written by rescale and evaluate as {prefix}.avTAD{mode}.npz, read by evaluate and plot.
+    """
+    metadata = dict(metadata or {}, format='avTAD::average', format_version=__format_version__)
+    arrays = {'matrix': np.asarray(matrix, dtype=np.float64),
+              'metadata': np.array(json.dumps(metadata, default=str))}
+    if state is not None:
+        arrays.update({key: np.asarray(value) for key, value in state.items()})
+    with open(fname, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def write_average_tsv(fname, matrix, metadata=None):
+    """ TSV export of average matrix with the description in the comment header. """
+    np.savetxt(fname, matrix, header=average_header(metadata or {}), fmt='%.6e', delimiter='\t')
+
+
+def read_average(fname):
+    """
+    Read average matrix written by write_average or TSV file written by older versions.
+    Returns the matrix, metadata dict and the accumulator state dict (None if not saved).
+    """
+    if fname.endswith('.tsv'):
+        with open(fname, 'r') as f:
+            comment_line = f.readline()
+        description = comment_line[1:].strip() if comment_line.startswith('#') else ''
+        return np.loadtxt(fname, delimiter='\t'), {'description': description}, None
+
+    with np.load(fname, allow_pickle=False) as f:
+        matrix = f['matrix']
+        metadata = json.loads(f['metadata'][()])
+        state = {key: f[key] for key in ['sum', 'sumsq', 'count', 'n']} if 'sum' in f.files else None
+    return matrix, metadata, state
+
+
+def list_averages(prefix):
+    """
+    Average matrices {prefix}.avTAD{mode}.npz (or .tsv written by older versions) available for the prefix.
+    Returns dict of file names by mode: '' for the total and e.g. '.ch:chrX' for groups.
+    npz files are preferred over tsv files of the same mode.
+    """
+    ret = {}
+    for ext in ['.tsv', '.npz']:
+        for fname in glob.glob(f'{glob.escape(prefix)}.avTAD*{ext}'):
+            mode = fname[len(prefix)+len('.avTAD'):-len(ext)]
+            if mode == '' or mode.startswith('.'):
+                ret[mode] = fname
+    return dict(sorted(ret.items()))
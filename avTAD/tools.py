@@ -5,70 +5,438 @@ import cooltools
 from cooltools.lib import numutils
 
 import glob
+import functools
+import os
+import tempfile
+import warnings
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import matplotlib as mpl
 mpl.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
 
 import pandas as pd
 import numpy as np
+from scipy import ndimage
 
-def read_cooler(in_cooler, balance=True):
+def read_cooler(in_cooler, balance=True, lazy=False):
     datasets = {}
     c = cooler.Cooler(in_cooler)
     chrms = c.chromnames
     for ch in chrms:
-        datasets[ch] = c.matrix(as_pixels=False, balance=balance).fetch(f'{ch}')
+        if lazy:
+            datasets[ch] = CoolerChromosome(c, ch, balance=balance)
+        else:
+            datasets[ch] = c.matrix(as_pixels=False, balance=balance).fetch(f'{ch}')
 
     return datasets, chrms, c.binsize
 
-def read_hiclib_heatmap(infile, balance=False):
+
+def _slice_bounds(key, length):
+    bgn, end, step = key.indices(length) if isinstance(key, slice) else slice(key, key+1).indices(length)
+    if step != 1:
+        raise ValueError('Only contiguous slices of the map are supported')
+    return bgn, max(bgn, end)
+
+
+class CoolerChromosome(object):
+    """
+    Lazy view of a single chromosome of a cooler.
+
+    Behaves like a dense chromosome matrix for len() and 2D slicing,
+    but fetches only the requested block from the pixel table, so memory
+    depends on the size of the block and not on the chromosome length.
+    """
+
+    def __init__(self, c, ch, balance=True):
+        self.cooler = c
+        self.ch = ch
+        self.balance = balance
+        self.offset = int(c.offset(ch))
+        self.nbins = int(c.extent(ch)[1]) - self.offset
+
+    def __len__(self):
+        return self.nbins
+
+    @property
+    def shape(self):
+        return (self.nbins, self.nbins)
+
+    def __getitem__(self, key):
+        rows, cols = key
+        i0, i1 = _slice_bounds(rows, self.nbins)
+        j0, j1 = _slice_bounds(cols, self.nbins)
+        selector = self.cooler.matrix(as_pixels=False, balance=self.balance)
+        return selector[self.offset+i0:self.offset+i1, self.offset+j0:self.offset+j1]
+
+    def diagonal_sums(self, max_offset, chunksize=2**22):
+        """
+        Sums and numbers of non-NaN pixels for diagonals 0..max_offset, as diagonal_sums of the
+        dense chromosome matrix, streamed from the pixel table by chunks of chunksize pixels,
+        so the time is linear in the number of non-zero pixels and not quadratic in bins.
+        With balance, pixels are multiplied by weights of their bins and pixels
+        of bins with NaN weights are not counted, as NaNs of the balanced matrix.
+        """
+        n = self.nbins
+        max_offset = min(max_offset, n-1)
+        lo, hi = self.offset, self.offset + n
+        if self.balance:
+            weights = self.cooler.bins()[lo:hi]['weight' if self.balance is True else self.balance].values.astype(float)
+            valid = np.isfinite(weights)
+        else:
+            weights, valid = None, np.ones(n, dtype=bool)
+
+        sums = np.zeros(max_offset+1)
+        with self.cooler.open('r') as h5:
+            # Pixels of the rows of the chromosome, the upper triangle is stored, so bin2 >= bin1:
+            bin1_offset = h5['indexes/bin1_offset']
+            bgn, end = int(bin1_offset[lo]), int(bin1_offset[hi])
+            for a in range(bgn, end, chunksize):
+                b = min(a+chunksize, end)
+                bin1 = h5['pixels/bin1_id'][a:b] - lo
+                bin2 = h5['pixels/bin2_id'][a:b] - lo
+                dist = bin2 - bin1
+                keep = (bin2 < n) & (dist <= max_offset)
+                bin1, bin2, dist = bin1[keep], bin2[keep], dist[keep]
+                values = h5['pixels/count'][a:b][keep].astype(float)
+                if weights is not None:
+                    values *= weights[bin1] * weights[bin2]
+                    finite = np.isfinite(values)
+                    dist, values = dist[finite], values[finite]
+                sums += np.bincount(dist, weights=values, minlength=max_offset+1)
+
+        # Non-NaN pixels of the diagonal d are pairs of valid bins (i, i+d), including zero pixels:
+        if weights is None:
+            counts = n - np.arange(max_offset+1, dtype=np.int64)
+        else:
+            spectrum = np.fft.rfft(valid.astype(float), 2*n)
+            counts = np.rint(np.fft.irfft(spectrum * np.conj(spectrum), 2*n)[:max_offset+1]).astype(np.int64)
+        return sums, counts
+
+
+def distance_bins(n):
+    """
+    Log-spaced groups of diagonals pooled together for expected calculation,
+    as in numutils.observedOverExpected: [(0, 1), (1, 2), ..., (x, n)].
+    """
+    edges = numutils.logbins(1, n, 1.03, version=1) if n > 1 else [1]
+    edges = np.concatenate([[0], edges])
+    return np.array([edges[:-1], np.minimum(edges[1:], n)]).T
+
+
+def diagonal_sums(mtx, max_offset, chunksize=1000):
+    """
+    Sums and numbers of non-NaN pixels for diagonals 0..max_offset of a symmetric matrix.
+    The matrix is read by blocks of chunksize rows along the main diagonal,
+    so it can be a lazy view (e.g. CoolerChromosome).
+    """
+    n = len(mtx)
+    max_offset = min(max_offset, n-1)
+    sums = np.zeros(max_offset+1)
+    counts = np.zeros(max_offset+1, dtype=np.int64)
+    for bgn in range(0, n, chunksize):
+        end = min(bgn+chunksize, n)
+        block = np.asarray(mtx[bgn:end, bgn:min(end+max_offset, n)], dtype=float)
+        for offset in range(max_offset+1):
+            diag = np.diagonal(block, offset)
+            mask = np.isfinite(diag)
+            sums[offset] += np.sum(diag[mask])
+            counts[offset] += np.sum(mask)
+    return sums, counts
+
+
+def expected_from_sums(sums, counts, n):
+    """
+    Expected value for each diagonal with diagonals pooled by distance_bins(n).
+    The output is shorter than sums if the last group of diagonals is incomplete.
+    NaN is returned for groups without valid pixels, 1 for groups with zero sum
+    (such diagonals are left unnormalized by numutils.observedOverExpected).
+    """
+    expected = []
+    for lo, hi in distance_bins(n):
+        if hi > len(sums):
+            break
+        ss, count = np.sum(sums[lo:hi]), np.sum(counts[lo:hi])
+        value = np.nan if count == 0 else (1 if ss == 0 else ss / count)
+        expected += [value]*(hi-lo)
+    return np.array(expected, dtype=float)
+
+
+def expected_extent(n, max_offset):
+    """ Last diagonal that should be summed to compute expected up to max_offset. """
+    for lo, hi in distance_bins(n):
+        if hi > max_offset:
+            return hi-1
+    return n-1
+
+
+class ObsExpView(object):
+    """
+    Observed over expected computed on the fly for the requested block of a
+    (lazy) chromosome matrix. Diagonals beyond the expected vector length and
+    diagonals_to_remove first diagonals are filled with NaN.
+    """
+
+    def __init__(self, mtx, expected, diagonals_to_remove=1):
+        self.mtx = mtx
+        self.expected = expected
+        self.diagonals_to_remove = diagonals_to_remove
+
+    def __len__(self):
+        return len(self.mtx)
+
+    @property
+    def shape(self):
+        return (len(self), len(self))
+
+    def __getitem__(self, key):
+        rows, cols = key
+        i0, i1 = _slice_bounds(rows, len(self))
+        j0, j1 = _slice_bounds(cols, len(self))
+        block = np.array(self.mtx[i0:i1, j0:j1], dtype=float)
+        dist = np.abs(np.arange(i0, i1)[:, None] - np.arange(j0, j1)[None, :])
+        valid = dist < len(self.expected)
+        block[valid] /= self.expected[dist[valid]]
+        block[~valid | (dist < self.diagonals_to_remove)] = np.nan
+        return block
+
+
+def lazy_expected(mtx, max_offset, chunksize=1000):
+    """
+    Expected of a lazy chromosome matrix computed only for the diagonals up to max_offset
+    (and to the end of their group of diagonals), which is enough to snip windows
+    not wider than max_offset+1 bins. Diagonal sums of cool maps are accumulated from their pixel tables.
+    """
+    n = len(mtx)
+    if isinstance(mtx, CoolerChromosome):
+        # Cool maps are streamed from the pixel table without densifying blocks of the matrix:
+        sums, counts = mtx.diagonal_sums(expected_extent(n, max_offset))
+    else:
+        sums, counts = diagonal_sums(mtx, expected_extent(n, max_offset), chunksize=chunksize)
+    return expected_from_sums(sums, counts, n)
+
+
+def lazy_observed_over_expected(mtx, max_offset, diagonals_to_remove=1, chunksize=1000):
+    """ ObsExpView of a lazy chromosome matrix with expected computed by lazy_expected. """
+    expected = lazy_expected(mtx, max_offset, chunksize=chunksize)
+    return ObsExpView(mtx, expected, diagonals_to_remove=diagonals_to_remove)
+
+class BandedMatrix(object):
+    """
+    Symmetric chromosome matrix stored as its diagonals 0..max_offset only:
+    data[i, d] = mtx[i, i+d], NaN beyond the end of the matrix.
+
+    Behaves like a dense matrix for len() and 2D slicing, pixels further than
+    max_offset from the main diagonal are NaN. TAD snips never reach further than
+    the widest window, so the memory is n*(max_offset+1) instead of n*n.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def from_dense(cls, mtx, max_offset, chunksize=1000):
+        """
+        Band of diagonals 0..max_offset of a dense or lazy matrix.
+        The matrix is read by blocks of chunksize rows, so lazy views are never densified.
+        """
+        n = len(mtx)
+        data = np.full((n, max_offset+1), np.nan)
+        for bgn in range(0, n, chunksize):
+            end = min(bgn+chunksize, n)
+            block = np.asarray(mtx[bgn:end, bgn:min(end+max_offset, n)], dtype=float)
+            for offset in range(min(max_offset, n-1-bgn)+1):
+                diag = np.diagonal(block, offset)
+                data[bgn:bgn+len(diag), offset] = diag
+        return cls(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def shape(self):
+        return (len(self), len(self))
+
+    @property
+    def max_offset(self):
+        return self.data.shape[1]-1
+
+    def __getitem__(self, key):
+        rows, cols = key
+        i0, i1 = _slice_bounds(rows, len(self))
+        j0, j1 = _slice_bounds(cols, len(self))
+        i = np.arange(i0, i1)[:, None]
+        j = np.arange(j0, j1)[None, :]
+        lo, dist = np.broadcast_arrays(np.minimum(i, j), np.abs(i - j))
+        valid = dist <= self.max_offset
+        block = np.full(valid.shape, np.nan)
+        block[valid] = self.data[lo[valid], dist[valid]]
+        return block
+
+    def observed_over_expected(self, diagonals_to_remove=1):
+        """
+        Divide the band by expected in place, as numutils.observedOverExpected does for dense matrices:
+        diagonals are pooled by distance_bins and NaNs are ignored.
+        The band should cover whole groups of diagonals (see expected_extent) for exact expected,
+        the last incomplete group is dropped. First diagonals_to_remove diagonals are filled with NaN.
+        """
+        nans = np.isnan(self.data)
+        sums = np.sum(np.where(nans, 0, self.data), axis=0)
+        counts = np.sum(~nans, axis=0)
+        del nans
+        expected = expected_from_sums(sums, counts, len(self))
+        self.data = self.data[:, :len(expected)]
+        self.data /= expected[None, :]
+        self.data[:, :diagonals_to_remove] = np.nan
+        return self
+
+    def summed_area_tables(self):
+        """
+        Band analogue of summed_area_tables for finite log2 values and for the finite mask,
+        used by band_square_sums to compute sums over TAD squares in O(1).
+
+        For prefix sums along the diagonals Q[i, d] = sum(data[:i, d]), squares [b:e, b:e]
+        of size s = e - b are sums of the upper triangle U = sum_{d<s} (Q[e-d, d] - Q[b, d])
+        counted twice minus the main diagonal, so for each table the prefix sums
+        over d of Q[b, d] and of Q[e-d, d] are stored together with Q[:, 0].
+        """
+        n, width = self.data.shape
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.log2(self.data)
+        mask = np.isfinite(values)
+        values[~mask] = 0
+        tables = []
+        for table in values, mask.astype(np.int64):
+            prefix = np.zeros((n+1, width), dtype=table.dtype)
+            np.cumsum(table, axis=0, out=prefix[1:])
+            rows = np.zeros((n+1, width+1), dtype=table.dtype)
+            np.cumsum(prefix, axis=1, out=rows[:, 1:])
+            shifted = np.zeros((n+1, width+1), dtype=table.dtype)
+            for d in range(width):
+                shifted[d:, d+1] = prefix[:n+1-d, d]
+            np.cumsum(shifted, axis=1, out=shifted)
+            tables.append((shifted, rows, prefix[:, 0].copy()))
+            del prefix
+        return tables
+
+
+def band_square_sums(tables, bgns, ends):
+    """ Sums over squares [bgn:end, bgn:end] from tables of BandedMatrix.summed_area_tables. """
+    shifted, rows, diagonal = tables
+    sizes = ends - bgns
+    if np.any(sizes >= shifted.shape[1]):
+        raise ValueError(f'TADs of size {sizes.max()} do not fit into the band of {shifted.shape[1]-1} diagonals')
+    return 2*(shifted[ends, sizes] - rows[bgns, sizes]) - (diagonal[ends] - diagonal[bgns])
+
+
+class HiclibChromosome(object):
+    """
+    Lazy view of a single chromosome of a hiclib HDF5 map: block [bgn:end, bgn:end]
+    of a dataset (whole-genome heatmap or chromosome map).
+
+    Behaves like a dense chromosome matrix for len() and 2D slicing, only the requested
+    block is read from the file by HDF5 hyperslab selection. The file is opened for each read
+    and closed afterwards, so no handles are left open and views can be passed to other processes.
+    With balance=True iterative correction weights are computed on the first access
+    from the whole chromosome block, which is released afterwards, and blocks are balanced on reading.
+    """
+
+    def __init__(self, fname, dataset, bgn, end, balance=False):
+        self.fname = fname
+        self.dataset = dataset
+        self.bgn = int(bgn)
+        self.nbins = int(end) - self.bgn
+        self.balance = balance
+        self.weights = None
+
+    def __len__(self):
+        return self.nbins
+
+    @property
+    def shape(self):
+        return (self.nbins, self.nbins)
+
+    def read(self, i0, i1, j0, j1):
+        """ Raw block [i0:i1, j0:j1] of the chromosome. """
+        with h5py.File(self.fname, 'r') as f:
+            return f[self.dataset][self.bgn+i0:self.bgn+i1, self.bgn+j0:self.bgn+j1]
+
+    def __getitem__(self, key):
+        rows, cols = key
+        i0, i1 = _slice_bounds(rows, self.nbins)
+        j0, j1 = _slice_bounds(cols, self.nbins)
+        block = self.read(i0, i1, j0, j1)
+        if not self.balance:
+            return block
+        if self.weights is None:
+            self.weights = numutils.iterative_correction_symmetric(self.read(0, self.nbins, 0, self.nbins).astype(float))[1]
+        return block / self.weights[i0:i1, None] / self.weights[None, j0:j1]
+
+
+def _chromosome_label(ch):
+    return ch if 'chr' in ch else f'chr{ch}'
+
+
+def read_hiclib_heatmap(infile, balance=False, lazy=False):
+    """
+    Read hiclib whole-genome heatmap by chromosomes: lazy views (HiclibChromosome) if lazy,
+    otherwise dense chromosome matrices read one by one, the whole-genome heatmap is never loaded.
+    """
     datasets = {}
-    f = h5py.File(infile)
-    map = f['heatmap'][()]
-    resolution = pickle.loads(f['resolution'][()])
-    chrms_sizes = f['chromosomeStarts'][()]
-    idx2chrms = pickle.loads(f['genomeIdxToLabel'][()])
+    with h5py.File(infile, 'r') as f:
+        n = f['heatmap'].shape[0]
+        resolution = pickle.loads(f['resolution'][()])
+        chrms_sizes = f['chromosomeStarts'][()]
+        idx2chrms = pickle.loads(f['genomeIdxToLabel'][()])
     for idx in idx2chrms.keys():
-        ch = idx2chrms[idx]
-        ch = ch if 'chr' in ch else f'chr{ch}'
         bgn = chrms_sizes[idx]
-        end = chrms_sizes[idx+1] if idx+1<len(chrms_sizes) else len(map)
-        mtx = map[bgn:end, bgn:end]
-        if balance:
-            mtx = numutils.iterative_correction_symmetric(mtx)
-        datasets[ch] = mtx
+        end = chrms_sizes[idx+1] if idx+1<len(chrms_sizes) else n
+        mtx = HiclibChromosome(infile, 'heatmap', bgn, end, balance=balance)
+        datasets[_chromosome_label(idx2chrms[idx])] = mtx if lazy else mtx[:, :]
 
     return datasets, sorted(datasets.keys()), resolution
 
-def read_hiclib_bychr(infile, balance=False):
+def read_hiclib_bychr(infile, balance=False, lazy=False):
+    """ Read hiclib map by chromosome: lazy views (HiclibChromosome) if lazy, otherwise dense chromosome matrices. """
     datasets = {}
-    f = h5py.File(infile)
-    resolution = pickle.loads(f['resolution'][()])
-    idx2chrms = pickle.loads(f['genomeIdxToLabel'][()])
+    with h5py.File(infile, 'r') as f:
+        resolution = pickle.loads(f['resolution'][()])
+        idx2chrms = pickle.loads(f['genomeIdxToLabel'][()])
+        lengths = {idx: f[f'{idx} {idx}'].shape[0] for idx in idx2chrms.keys()}
     for idx in idx2chrms.keys():
-        ch = idx2chrms[idx]
-        mtx = f[f'{idx} {idx}'][()]
-        ch = ch if 'chr' in ch else f'chr{ch}'
-        if balance:
-            mtx = numutils.iterative_correction_symmetric(mtx)
-        datasets[ch] = mtx
+        mtx = HiclibChromosome(infile, f'{idx} {idx}', 0, lengths[idx], balance=balance)
+        datasets[_chromosome_label(idx2chrms[idx])] = mtx if lazy else mtx[:, :]
 
     return datasets, sorted(datasets.keys()), resolution
 
-def shuffle_segmentation(segmentation, seed=None):
+def read_map(infile, format='cool', balance=True, lazy=False):
+    """
+    Read Hi-C map in cool, hiclib_heatmap or hiclib_bychr format. Returns datasets by chromosome, chromosomes and resolution.
+    With lazy=True datasets are views of chromosomes that read only the requested blocks from the file.
+    """
+    if format=='cool':
+        return read_cooler(infile, balance=balance, lazy=lazy)
+    elif format=='hiclib_heatmap':
+        return read_hiclib_heatmap(infile, balance=balance, lazy=lazy)
+    elif format=='hiclib_bychr':
+        return read_hiclib_bychr(infile, balance=balance, lazy=lazy)
+    else:
+        raise Exception(f'Map format {format} is not supported ...')
 
-    if not seed is None:
-        np.random.seed(seed)
+def shuffle_segmentation(segmentation, seed=None):
+    """
+    Shuffle TADs and inter-TAD intervals of a single segmentation with a local random generator.
+    Returns reconstructed segmentation in the shuffled order of TADs and the order itself.
+    """
+    rng = np.random.default_rng(seed)
 
     tads_lens      = segmentation[:,1] - segmentation[:,0]
     tad_idxs       = np.arange(len(tads_lens))
-    tads_idxs_shuf = np.random.permutation(tad_idxs)
+    tads_idxs_shuf = rng.permutation(tad_idxs)
     tads_lens_shuf = tads_lens[tads_idxs_shuf]
 
     intertads_lens      = np.append(segmentation[0,0], segmentation[1:,0] - segmentation[:-1,1])
-    intertads_lens_shuf = np.random.permutation(intertads_lens)
+    intertads_lens_shuf = rng.permutation(intertads_lens)
 
     ends = np.cumsum(intertads_lens_shuf+tads_lens_shuf)
     starts = ends-tads_lens_shuf
@@ -78,26 +446,672 @@ def shuffle_segmentation(segmentation, seed=None):
     return segmentation_reconstructed, tads_idxs_shuf
 
 
-def snipper(segmentations, dataset, window=1, key_bgn='bgn_bin', key_end='end_bin'):
-    ret = []
-    for i, r in segmentations.iterrows():
-        size = int(window * (r[key_end] - r[key_bgn]))
-        input_mtx = dataset[r.ch]
-        bgn = max(0, r[key_bgn] - size)
-        end = min(r[key_end] + size, len(input_mtx))
-        mtx = np.log2(input_mtx[bgn:end, bgn:end])
+def shuffle_segmentations(segmentation, niter, seed=None):
+    """
+    niter shuffles of a single segmentation (sorted array of TAD starts and ends) in one vectorized pass.
+    Orders of TADs and inter-TAD intervals are drawn as argsort of random keys for all iterations at once,
+    TAD positions are reconstructed by cumulative sums.
+
+    Returns integer array (niter, n_tads, 2) with starts and ends of shuffled TADs,
+    where TAD i keeps its index (and size) in each shuffle.
+    """
+    rng = np.random.default_rng(seed)
+    segmentation = np.asarray(segmentation, dtype=np.int64)
+    ntads = len(segmentation)
+    tads_lens = segmentation[:, 1] - segmentation[:, 0]
+    intertads_lens = np.append(segmentation[:1, 0], segmentation[1:, 0] - segmentation[:-1, 1])
+
+    tads_idxs_shuf = np.argsort(rng.random((niter, ntads)), axis=1)
+    intertads_idxs_shuf = np.argsort(rng.random((niter, ntads)), axis=1)
+    tads_lens_shuf = tads_lens[tads_idxs_shuf]
+
+    ends = np.cumsum(intertads_lens[intertads_idxs_shuf] + tads_lens_shuf, axis=1)
+
+    ret = np.empty((niter, ntads, 2), dtype=np.int64)
+    iters = np.arange(niter)[:, None]
+    ret[iters, tads_idxs_shuf, 0] = ends - tads_lens_shuf
+    ret[iters, tads_idxs_shuf, 1] = ends
+    return ret
+
+
+def iter_snips(segmentations, dataset, window=1, key_bgn='bgn_bin', key_end='end_bin'):
+    for ch, bgn_bin, end_bin in zip(segmentations.ch, segmentations[key_bgn], segmentations[key_end]):
+        size = int(window * (end_bin - bgn_bin))
+        input_mtx = dataset[ch]
+        bgn = max(0, bgn_bin - size)
+        end = min(end_bin + size, len(input_mtx))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mtx = np.log2(input_mtx[bgn:end, bgn:end])
         mtx[np.isinf(mtx)] = np.nan
-        ret.append(mtx)
-    return np.array(ret)
+        yield mtx
+
+def share_arrays(arrays):
+    """
+    Copy numpy arrays (and data of banded matrices) from dict to shared memory, so that worker
+    processes can access them without copying. Other values are passed as is.
+
+    Returns the dict with arrays replaced by views of shared memory, the specifications
+    to pass to attach_arrays in worker processes and the list of shared memory blocks.
+    The blocks should be released with release_arrays by the owner process.
+    """
+    shared, specs, blocks = {}, {}, []
+    for key, value in arrays.items():
+        band = isinstance(value, BandedMatrix)
+        if band:
+            value = value.data
+        if not isinstance(value, np.ndarray):
+            shared[key] = value
+            specs[key] = (None, value)
+            continue
+        block = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        mtx = np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)
+        mtx[...] = value
+        shared[key] = BandedMatrix(mtx) if band else mtx
+        specs[key] = (block.name, (value.shape, value.dtype.str, band))
+        blocks.append(block)
+    return shared, specs, blocks
+
+def attach_arrays(specs):
+    """
+    Attach to arrays in shared memory created by share_arrays.
+    Returns the dict of arrays and the list of shared memory blocks to keep them alive.
+    """
+    arrays, blocks = {}, []
+    for key, (name, value) in specs.items():
+        if name is None:
+            arrays[key] = value
+            continue
+        shape, dtype, band = value
+        block = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        if band:
+            arrays[key] = BandedMatrix(arrays[key])
+        blocks.append(block)
+    return arrays, blocks
+
+def release_arrays(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+# State of worker processes with arrays in shared memory:
+_worker = {}
+
+def _init_shared_worker(specs):
+    _worker['arrays'], _worker['blocks'] = attach_arrays(specs)
+
+def _run_shared_job(args):
+    func, job = args
+    return func(_worker['arrays'], *job)
+
+def map_with_shared_arrays(func, jobs, arrays, processes=1):
+    """
+    Apply func(arrays, *job) to each job, yielding results in the order of jobs.
+    With processes > 1 arrays (dict of numpy arrays or banded matrices) are copied
+    to shared memory once and jobs are run by a pool of worker processes;
+    func should be defined at the module level.
+    """
+    if processes <= 1:
+        for job in jobs:
+            yield func(arrays, *job)
+        return
+
+    _, specs, blocks = share_arrays(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_shared_worker, initargs=(specs,)) as pool:
+            for ret in pool.map(_run_shared_job, [(func, job) for job in jobs]):
+                yield ret
+    finally:
+        release_arrays(blocks)
+
+def map_with_memory_budget(func, jobs, memory, processes=1, threads=1, max_memory=None):
+    """
+    Apply func(*job) to each job, yielding results in the order of jobs.
+    With processes > 1 (or threads > 1) jobs are run concurrently by a pool of processes
+    (or threads); func should be defined at the module level for processes.
+    memory is the estimate of memory in bytes needed by each job: jobs are started in order
+    only while the total estimate of running jobs is within max_memory (no limit if None),
+    one job is always allowed to run even if its estimate exceeds max_memory.
+    """
+    if processes <= 1 and threads <= 1:
+        for job in jobs:
+            yield func(*job)
+        return
+
+    workers = processes if processes > 1 else threads
+    executor = ProcessPoolExecutor(max_workers=workers) if processes > 1 else ThreadPoolExecutor(max_workers=workers)
+    with executor as pool:
+        running, results = {}, {}
+        used, started, finished = 0, 0, 0
+        while finished < len(jobs):
+            while started < len(jobs) and len(running) < workers and \
+                    (not running or max_memory is None or used + memory[started] <= max_memory):
+                running[pool.submit(func, *jobs[started])] = started
+                used += memory[started]
+                started += 1
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k = running.pop(future)
+                used -= memory[k]
+                results[k] = future.result()
+            while finished in results:
+                yield results.pop(finished)
+                finished += 1
+
+def snipper(segmentations, dataset, window=1, key_bgn='bgn_bin', key_end='end_bin'):
+    ret = list(iter_snips(segmentations, dataset, window=window, key_bgn=key_bgn, key_end=key_end))
+    snips = np.empty(len(ret), dtype=object)
+    for i, mtx in enumerate(ret):
+        snips[i] = mtx
+    return snips
 
 def zoom(snippets, finalShape=(30, 30), saveSum=True, order=1):
-    ret = []
-    for i, snip in enumerate(snippets):
-        mtx = snip
-        mtx = numutils.zoom_array(mtx, finalShape, saveSum, order=order)
-        ret.append(mtx)
+    ret = {}
+    for indices, stack in zoom_batches(snippets, finalShape=finalShape, saveSum=saveSum, order=order):
+        ret.update(zip(indices, stack))
+    return [ret[i] for i in range(len(ret))]
+
+@functools.lru_cache(maxsize=1024)
+def zoom_operator(in_size, final_size, saveSum=True):
+    """
+    Linear operator R of numutils.zoom_array with order=1 along one axis: zoom_array(X) = R X R.T
+    Built once per (in_size, final_size) pair by zooming unit vectors with scipy.ndimage.zoom
+    exactly as zoom_array does. Also returns boolean support S of the operator: output pixel
+    is NaN if any input pixel in the support is NaN, as for scipy.ndimage.zoom.
+    """
+    mult = int(np.ceil(in_size / final_size)) if final_size < in_size else 1
+    multiplier = final_size * mult / in_size + 0.0000001
+    units = np.eye(in_size)
+    R = np.array([ndimage.zoom(x, multiplier, order=1) for x in units]).T
+    S = np.array([np.isnan(ndimage.zoom(np.where(x > 0, np.nan, 0), multiplier, order=1)) for x in units]).T
+    R = R.reshape(final_size, mult, in_size).mean(axis=1)
+    S = S.reshape(final_size, mult, in_size).any(axis=1).astype(float)
+    if saveSum:
+        R *= in_size / final_size
+    R.flags.writeable = False
+    S.flags.writeable = False
+    return R, S
+
+def zoom_stack(stack, finalShape=(30, 30), saveSum=True):
+    """ Zoom a stack of 2D snips of the same shape to finalShape with cached zoom operators (order=1). """
+    stack = np.asarray(stack, dtype=float)
+    if stack.shape[1] == 0 or stack.shape[2] == 0:
+        return np.full((len(stack),)+tuple(finalShape), np.nan)
+    Rr, Sr = zoom_operator(stack.shape[1], finalShape[0], saveSum)
+    Rc, Sc = zoom_operator(stack.shape[2], finalShape[1], saveSum)
+    nans = np.isnan(stack)
+    ret = Rr @ np.where(nans, 0, stack) @ Rc.T
+    if nans.any():
+        ret[(Sr @ nans.astype(float) @ Sc.T) > 0] = np.nan
     return ret
 
+def zoom_batches(snippets, finalShape=(30, 30), saveSum=True, order=1, batch_pixels=2**24):
+    """
+    Zoom snips to finalShape by groups of the same input shape, so that the time depends
+    on the number of distinct shapes rather than on the number of snips.
+    Snips are buffered by shape until batch_pixels input pixels are collected.
+    Yields indices of snips in the input order and stacks of zoomed snips.
+    Orders other than 1 fall back to numutils.zoom_array snip by snip.
+    """
+    if order != 1:
+        for i, mtx in enumerate(snippets):
+            yield [i], numutils.zoom_array(mtx, finalShape, saveSum, order=order)[None]
+        return
+
+    groups, buffered = {}, 0
+    for i, mtx in enumerate(snippets):
+        indices, mtxs = groups.setdefault(np.shape(mtx), ([], []))
+        indices.append(i)
+        mtxs.append(mtx)
+        buffered += np.size(mtx)
+        if buffered >= batch_pixels:
+            for indices, mtxs in groups.values():
+                yield indices, zoom_stack(mtxs, finalShape, saveSum)
+            groups, buffered = {}, 0
+    for indices, mtxs in groups.values():
+        yield indices, zoom_stack(mtxs, finalShape, saveSum)
+
+def summed_area_tables(mtx):
+    """
+    2D prefix sums of finite log2(mtx) values and of the finite mask,
+    padded with zero first row and column:
+    sat[i, j] is the sum over mtx[:i, :j].
+    """
+    n = len(mtx)
+    sat = np.zeros((n+1, n+1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.log2(mtx, out=sat[1:, 1:])
+    mask = np.isfinite(sat)
+    sat[~mask] = 0
+    finite = mask.astype(np.int64)
+    finite[0, :] = 0
+    finite[:, 0] = 0
+    del mask
+    for table in sat, finite:
+        np.cumsum(table, axis=0, out=table)
+        np.cumsum(table, axis=1, out=table)
+    return sat, finite
+
+
+def square_sums(sat, bgns, ends):
+    """ Sums over squares [bgn:end, bgn:end] for arrays of bgns and ends from summed area table. """
+    return sat[ends, ends] - sat[bgns, ends] - sat[ends, bgns] + sat[bgns, bgns]
+
+
+def window_enrichment(mtx):
+    """ Enrichment of a single TAD: sum, mean, median and number of finite log2 values. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mtx = np.log2(mtx)
+    mtx = mtx[np.isfinite(mtx)]
+    if len(mtx) == 0:
+        return 0, np.nan, np.nan, 0
+    return np.sum(mtx), np.mean(mtx), np.median(mtx), len(mtx)
+
+
+def enrichment_tables(mtx):
+    """
+    Summed area tables of finite log2 values and of the finite mask of a dense or banded matrix
+    with the function of square sums over them, None for lazy matrices. Built once, they are passed
+    to tad_enrichment for any number of TAD sets of the same chromosome.
+    """
+    if isinstance(mtx, BandedMatrix):
+        return mtx.summed_area_tables(), band_square_sums
+    if isinstance(mtx, np.ndarray):
+        return summed_area_tables(mtx), square_sums
+    return None
+
+
+def tad_enrichment(mtx, bgns, ends, median=False, tables=None):
+    """
+    Enrichment of TADs [bgn:end, bgn:end] in observed over expected matrix of a chromosome.
+    bgns and ends are integer arrays of the same shape, e.g. (n_segmentations, n_tads),
+    output has additional last axis with sum, mean, median and number of finite log2 values.
+
+    For dense and banded matrices sums and numbers of elements come from summed area tables,
+    built once for all TADs, or taken from tables built by enrichment_tables. Medians are computed
+    TAD by TAD only if requested, NaN is returned otherwise.
+    """
+    n = len(mtx)
+    bgns = np.clip(np.asarray(bgns, dtype=np.int64), 0, n)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, n)
+    ret = np.full(bgns.shape+(4,), np.nan)
+
+    if tables is None:
+        tables = enrichment_tables(mtx)
+    if tables is not None:
+        (sat, finite), sums = tables
+        ret[..., 0] = sums(sat, bgns, ends)
+        ret[..., 3] = sums(finite, bgns, ends)
+        del tables, sat, finite
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ret[..., 1] = np.where(ret[..., 3] > 0, ret[..., 0] / ret[..., 3], np.nan)
+        if median:
+            for idx in np.ndindex(bgns.shape):
+                bgn, end = bgns[idx], ends[idx]
+                ret[idx][2] = window_enrichment(mtx[bgn:end, bgn:end])[2]
+    else:
+        # Lazy matrices are fetched window by window:
+        for idx in np.ndindex(bgns.shape):
+            bgn, end = bgns[idx], ends[idx]
+            ret[idx] = window_enrichment(mtx[bgn:end, bgn:end])
+        if not median:
+            ret[..., 2] = np.nan
+
+    return ret
+
+
+def sequential_pvalues(mtx, segmentation, observed, max_niter, hits=10, batch=100, seed=None):
+    """
+    Sequential Monte Carlo (Besag and Clifford, 1991) one-sided p-values of the observed mean enrichment
+    of TADs of a single segmentation (sorted array of TAD starts and ends) of the chromosome mtx.
+
+    Shuffled segmentations are drawn in vectorized batches, and each TAD keeps the draws of its null enrichment
+    until the null reaches the observed one hits times or max_niter draws are done. p-value is hits/draws
+    for TADs stopped early and (exceedances+1)/(draws+1) otherwise. Only TADs not stopped yet are measured
+    in each batch, by lookups in summed area tables built once for the chromosome, draws stop when all TADs
+    are stopped. Null enrichments that are NaN (no finite values) are not counted as draws,
+    TADs with NaN observed enrichment are not tested.
+
+    Returns float array (n_tads, 4) with p-value, mean and standard deviation of the null enrichment
+    and the number of draws.
+    """
+    rng = np.random.default_rng(seed)
+    segmentation = np.asarray(segmentation, dtype=np.int64)
+    observed = np.asarray(observed, dtype=float)
+    ntads = len(segmentation)
+    exceed = np.zeros(ntads, dtype=np.int64)
+    draws = np.zeros(ntads, dtype=np.int64)
+    sums = np.zeros(ntads)
+    sumsq = np.zeros(ntads)
+    active = np.isfinite(observed)
+    # Tables are built once, each batch only looks up the corners of shuffled TADs:
+    tables = enrichment_tables(mtx)
+
+    done = 0
+    while done < max_niter and active.any():
+        size = min(batch, max_niter - done)
+        shuffled = shuffle_segmentations(segmentation, size, seed=rng)
+        idx = np.flatnonzero(active)
+        null = tad_enrichment(mtx, shuffled[:, idx, 0], shuffled[:, idx, 1], tables=tables)[..., 1]
+        finite = np.isfinite(null)
+        hit = finite & (null >= observed[idx])
+
+        # Draws of the batch after the hits-th exceedance of a TAD are discarded:
+        reached = np.cumsum(hit, axis=0) + exceed[idx] >= hits
+        stopped = reached.any(axis=0)
+        used = np.arange(size)[:, None] < np.where(stopped, reached.argmax(axis=0)+1, size)
+        valid = finite & used
+        values = np.where(valid, null, 0)
+
+        exceed[idx] += (hit & used).sum(axis=0)
+        draws[idx] += valid.sum(axis=0)
+        sums[idx] += values.sum(axis=0)
+        sumsq[idx] += (values**2).sum(axis=0)
+        active[idx[stopped]] = False
+        done += size
+
+    ret = np.full((ntads, 4), np.nan)
+    tested = np.isfinite(observed)
+    ret[tested, 0] = np.where(exceed >= hits, exceed / np.maximum(draws, 1), (exceed + 1) / (draws + 1))[tested]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ret[:, 1] = np.where(draws > 0, sums / draws, np.nan)
+        ret[:, 2] = np.where(draws > 1, np.sqrt(np.maximum(sumsq - sums**2 / draws, 0) / (draws - 1)), np.nan)
+    ret[:, 3] = draws
+    return ret
+
+
+class PileupAccumulator(object):
+    """
+    Running per-pixel sum, sum of squares and number of finite values
+    of the matrices of the same shape. Memory does not depend on the number of matrices.
+    """
+
+    operations = ['mean', 'sum', 'count', 'std', 'sem']
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.sum = np.zeros(self.shape)
+        self.sumsq = np.zeros(self.shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.n = 0
+
+    def add(self, mtx):
+        self.add_stack(np.asarray(mtx)[None])
+
+    def add_stack(self, stack):
+        finite = np.isfinite(stack)
+        values = np.where(finite, stack, 0)
+        self.sum += values.sum(axis=0)
+        self.sumsq += (values**2).sum(axis=0)
+        self.count += finite.sum(axis=0)
+        self.n += len(stack)
+
+    def result(self, operation='mean'):
+        """
+        Average matrix by operation: mean, sum and count of finite values,
+        std (sample standard deviation, ddof=1) or sem (std/sqrt(count)).
+        NaN is returned for pixels without enough finite values.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(self.count > 0, self.sum / self.count, np.nan)
+            if operation == 'mean':
+                return mean
+            elif operation == 'sum':
+                return self.sum.copy()
+            elif operation == 'count':
+                return self.count.astype(float)
+            var = np.where(self.count > 1, (self.sumsq - self.count * mean**2) / (self.count - 1), np.nan)
+            std = np.sqrt(np.maximum(var, 0))
+            if operation == 'std':
+                return std
+            elif operation == 'sem':
+                return std / np.sqrt(self.count)
+        raise ValueError(f'Operation {operation} is not implemented')
+
+    def state(self):
+        """ Accumulated arrays that are enough to restore or merge the accumulator. """
+        return {'sum': self.sum, 'sumsq': self.sumsq, 'count': self.count, 'n': np.asarray(self.n)}
+
+    @classmethod
+    def from_state(cls, state):
+        accumulator = cls.__new__(cls)
+        accumulator.sum = np.array(state['sum'], dtype=float)
+        accumulator.sumsq = np.array(state['sumsq'], dtype=float)
+        accumulator.count = np.array(state['count'], dtype=np.int64)
+        accumulator.shape = accumulator.sum.shape
+        accumulator.n = int(state['n']) if np.ndim(state['n']) == 0 else np.array(state['n'], dtype=np.int64)
+        return accumulator
+
+    def merge(self, other):
+        """ Add the matrices accumulated by other accumulator of the same shape. """
+        if other.shape != self.shape:
+            raise ValueError(f'Cannot merge accumulators of shapes {self.shape} and {other.shape}')
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        self.count += other.count
+        self.n += other.n
+        return self
+
+
+class GroupedPileupAccumulator(PileupAccumulator):
+    """
+    PileupAccumulator for ngroups groups of matrices at once: sums are kept
+    with the leading group axis, each matrix of the stack is added to the group of its label.
+    Matrices can be added to several groups (e.g. of different groupings) by calling add_stack
+    with the same stack and different labels.
+    """
+
+    def __init__(self, ngroups, shape):
+        super(GroupedPileupAccumulator, self).__init__((ngroups,)+tuple(shape))
+        self.n = np.zeros(ngroups, dtype=np.int64)
+
+    def add(self, mtx, label):
+        self.add_stack(np.asarray(mtx)[None], [label])
+
+    def group(self, k):
+        """ PileupAccumulator of the group k, sharing memory with this one. """
+        return PileupAccumulator.from_state({'sum': self.sum[k], 'sumsq': self.sumsq[k],
+                                             'count': self.count[k], 'n': self.n[k]})
+
+    def add_stack(self, stack, labels):
+        # Matrices with negative labels are not in any group. The rest are sorted by group,
+        # so that each group is reduced in one call:
+        labels = np.asarray(labels)
+        order = np.flatnonzero(labels >= 0)
+        if len(order) == 0:
+            return
+        order = order[np.argsort(labels[order], kind='stable')]
+        labels = labels[order]
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        groups = labels[starts]
+
+        stack = np.asarray(stack)[order]
+        finite = np.isfinite(stack)
+        values = np.where(finite, stack, 0)
+        self.sum[groups] += np.add.reduceat(values, starts, axis=0)
+        self.sumsq[groups] += np.add.reduceat(values**2, starts, axis=0)
+        self.count[groups] += np.add.reduceat(finite, starts, axis=0, dtype=np.int64)
+        self.n[groups] += np.diff(np.r_[starts, len(labels)])
+
+
+def bootstrap_weights(labels, nboot, strata=None, seed=None):
+    """
+    Multinomial weights of nboot bootstrap resamples for groupings of matrices with labels
+    as in average_snips_grouped: (ngroupings, nboot, number of matrices) array with the number
+    of draws of each matrix in each resample of its group (0 for matrices not in any group).
+    Matrices are resampled within their group, and within strata of the group if strata
+    (integer label of each matrix) is provided, so that resamples keep the sizes of groups and strata.
+    """
+    rng = np.random.default_rng(seed)
+    labels = np.atleast_2d(labels)
+    n = labels.shape[1]
+    strata = np.zeros(n, dtype=np.int64) if strata is None else np.asarray(strata, dtype=np.int64)
+    weights = np.zeros((len(labels), nboot, n), dtype=np.int32)
+    for grouping, grouping_weights in zip(labels, weights):
+        valid = np.flatnonzero(grouping >= 0)
+        # Cells are (group, stratum) pairs, matrices are sorted by cell and resampled cell by cell:
+        cells = np.stack([grouping[valid], strata[valid]])
+        _, inverse = np.unique(cells, axis=1, return_inverse=True)
+        order = valid[np.argsort(inverse, kind='stable')]
+        sizes = np.bincount(inverse.ravel())
+        for members in np.split(order, np.cumsum(sizes)[:-1]):
+            grouping_weights[:, members] = rng.multinomial(len(members), np.full(len(members), 1/len(members)), size=nboot)
+    return weights
+
+
+class BootstrapAccumulator(PileupAccumulator):
+    """
+    PileupAccumulator of nboot bootstrap resamples for ngroups groups of matrices at once,
+    sums are kept with the leading (group, resample) axes. Resamples are given by bootstrap_weights
+    for the labels of matrices. For each stack of matrices the weighted sums of all resamples
+    of a group are computed by one matrix product of the weights (nboot, matrices of the group)
+    and the stack, so the stack is never copied for each resample.
+    With squares=False sums of squares are not kept (enough for mean, sum and count).
+    """
+
+    def __init__(self, weights, labels, ngroups, shape, squares=True):
+        self.weights = np.asarray(weights)
+        self.labels = np.atleast_2d(labels)
+        super(BootstrapAccumulator, self).__init__((ngroups, self.weights.shape[1])+tuple(shape))
+        if not squares:
+            self.sumsq = None
+        self.n = np.zeros(ngroups, dtype=np.int64)
+
+    def add_stack(self, stack, indices):
+        """ Add the stack of matrices with indices in labels and weights. """
+        indices = np.asarray(indices)
+        stack = np.asarray(stack).reshape(len(indices), -1)
+        finite = np.isfinite(stack)
+        values = np.where(finite, stack, 0)
+        squares = values**2 if self.sumsq is not None else None
+        finite = finite.astype(float)
+        for grouping, weights in zip(self.labels, self.weights):
+            labels = grouping[indices]
+            order = np.flatnonzero(labels >= 0)
+            order = order[np.argsort(labels[order], kind='stable')]
+            starts = np.flatnonzero(np.r_[True, labels[order][1:] != labels[order][:-1]]) if len(order) else []
+            for bgn, end in zip(starts, np.r_[starts[1:], len(order)].astype(int)):
+                members = order[bgn:end]
+                group = labels[members[0]]
+                w = weights[:, indices[members]].astype(float)
+                self.sum[group] += (w @ values[members]).reshape(self.sum.shape[1:])
+                self.count[group] += np.rint(w @ finite[members]).astype(np.int64).reshape(self.count.shape[1:])
+                if squares is not None:
+                    self.sumsq[group] += (w @ squares[members]).reshape(self.sumsq.shape[1:])
+                self.n[group] += len(members)
+
+    def percentiles(self, operation='mean', q=(2.5, 97.5)):
+        """ Percentiles q of the operation over resamples: (len(q), ngroups)+shape array, NaN resamples are ignored. """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanpercentile(self.result(operation), q, axis=1)
+
+
+def tiled_nanmedian(mtxs, shape, max_memory=2**28, tmpdir=None):
+    """
+    Per-pixel median of the matrices of the same shape, ignoring NaNs.
+    Matrices are dumped one by one to a temporary file, which is then memory-mapped
+    and the median is computed by tiles of rows that fit into max_memory bytes.
+    Returns the median matrix and the number of matrices.
+    """
+    batches = (([i], np.asarray(mtx)[None]) for i, mtx in enumerate(mtxs))
+    ret, n = grouped_nanmedian(batches, None, 1, shape, max_memory=max_memory, tmpdir=tmpdir)
+    return ret[0], n[0]
+
+
+def grouped_nanmedian(batches, labels, ngroups, shape, max_memory=2**28, tmpdir=None):
+    """
+    Per-pixel median of the matrices of the same shape for ngroups groups, ignoring NaNs.
+    batches yield indices of matrices and their stacks, as zoom_batches.
+    labels is (ngroupings, number of matrices) array with the group of each matrix
+    in each grouping, negative if the matrix is not in any group (or None for one group of all matrices).
+    Matrices are dumped once to a temporary file, the median of each group is computed
+    by tiles of rows of the memory-mapped file.
+    Returns (ngroups,)+shape array of medians and the number of matrices in each group.
+    """
+    shape = tuple(shape)
+    ret = np.full((ngroups,)+shape, np.nan)
+    counts = np.zeros(ngroups, dtype=np.int64)
+    nbytes = 8*int(np.prod(shape))
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        fname = os.path.join(tmp, 'stack.bin')
+        n = 0
+        with open(fname, 'wb') as f:
+            for indices, stack in batches:
+                for i, mtx in zip(indices, stack):
+                    f.seek(i*nbytes)
+                    f.write(np.ascontiguousarray(mtx, dtype=np.float64).tobytes())
+                n += len(indices)
+        if n == 0:
+            return ret, counts
+        labels = np.zeros((1, n), dtype=np.int64) if labels is None else np.atleast_2d(labels)
+        stack = np.memmap(fname, dtype=np.float64, mode='r', shape=(n,)+shape)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            for group in range(ngroups):
+                index = np.flatnonzero((labels == group).any(axis=0))
+                counts[group] = len(index)
+                if len(index) == 0:
+                    continue
+                rows = max(1, int(max_memory // (8*len(index)*int(np.prod(shape[1:])))))
+                for bgn in range(0, shape[0], rows):
+                    tile = stack[:, bgn:bgn+rows] if len(index) == n else stack[index, bgn:bgn+rows]
+                    ret[group, bgn:bgn+rows] = np.nanmedian(tile, axis=0)
+        del stack
+    return ret, counts
+
+
+def average_snips(snips, operation='mean', finalShape=(30, 30), saveSum=True, order=1):
+    """
+    Zoom snips by batches to finalShape and average them by operation
+    (mean, sum, count, std, sem or median). The stack of all zoomed snips is never kept in memory:
+    batches are folded into PileupAccumulator or, for median, processed by tiled_nanmedian.
+    Returns the average matrix and the number of snips.
+    """
+    batches = (stack for _, stack in zoom_batches(snips, finalShape, saveSum=saveSum, order=order))
+    if operation == 'median':
+        return tiled_nanmedian((mtx for stack in batches for mtx in stack), finalShape)
+    if not operation in PileupAccumulator.operations:
+        raise ValueError(f'Operation {operation} is not implemented')
+    accumulator = PileupAccumulator(finalShape)
+    for stack in batches:
+        accumulator.add_stack(stack)
+    return accumulator.result(operation), accumulator.n
+
+
+def average_snips_grouped(snips, labels, ngroups, operation='mean', finalShape=(30, 30), saveSum=True, order=1):
+    """
+    Zoom each snip once and average snips by operation in ngroups groups in one pass.
+    labels is (ngroupings, number of snips) array with the group of each snip in each grouping
+    (negative for snips not in any group of the grouping), groups of different groupings are numbered consecutively, e.g. for the total and split by ch:
+        labels = [[0, 0, 0, 0], [1, 1, 2, 2]]
+    Returns (ngroups,)+finalShape array of average matrices and the number of snips in each group.
+    """
+    if operation == 'median':
+        batches = zoom_batches(snips, finalShape, saveSum=saveSum, order=order)
+        return grouped_nanmedian(batches, np.atleast_2d(labels), ngroups, finalShape)
+    if not operation in PileupAccumulator.operations:
+        raise ValueError(f'Operation {operation} is not implemented')
+    accumulator = accumulate_snips_grouped(snips, labels, ngroups, finalShape, saveSum=saveSum, order=order)
+    return accumulator.result(operation), accumulator.n
+
+
+def accumulate_snips_grouped(snips, labels, ngroups, finalShape=(30, 30), saveSum=True, order=1, bootstrap=None):
+    """
+    Zoom each snip once and add it to GroupedPileupAccumulator of ngroups groups
+    with labels as in average_snips_grouped. Returns the accumulator.
+    If bootstrap (BootstrapAccumulator) is provided, zoomed snips are added to it in the same pass.
+    """
+    labels = np.atleast_2d(labels)
+    accumulator = GroupedPileupAccumulator(ngroups, finalShape)
+    for indices, stack in zoom_batches(snips, finalShape, saveSum=saveSum, order=order):
+        for grouping in labels:
+            accumulator.add_stack(stack, grouping[indices])
+        if bootstrap is not None:
+            bootstrap.add_stack(stack, indices)
+    return accumulator
+
+
 def compute_enrichment(mtx, window=1, normalize=False):
     # TODO design a proper test
     size = len(mtx)
@@ -115,31 +1129,87 @@ def compute_enrichment(mtx, window=1, normalize=False):
     return enrichment
 
 
-def plot_heatmap(s, pngname, cmap='Reds', center=None, vmax=None, title='', cbar=True, figsize=[7,7], window=1):
+def heatmap_norm(mtxs, center=None, vmax=None, vmin=None):
+    """
+    Color scale normalization shared by matrices, as in seaborn.heatmap: limits default to
+    the range of finite values, with center the scale is made symmetric around it.
+    """
+    if vmax is None or (vmin is None and center is None):
+        values = np.concatenate([np.asarray(mtx, dtype=float).ravel() for mtx in mtxs])
+        values = values[np.isfinite(values)]
+        if vmax is None:
+            vmax = values.max() if len(values) else 1
+        if vmin is None and center is None:
+            vmin = values.min() if len(values) else 0
+    if not center is None:
+        vmin = -vmax if vmin is None else vmin
+        vrange = max(vmax - center, center - vmin)
+        vmin, vmax = center - vrange, center + vrange
+    return mpl.colors.Normalize(vmin=vmin, vmax=vmax)
 
-    plt.figure(figsize=figsize)
-    mtx = s.copy()
 
-    if not center is None and not vmax is None:
-        sns.heatmap(mtx, square=True, cmap=cmap,
-                    center=center, vmin=-vmax, vmax=vmax, cbar=cbar)
-    elif not center is None:
-        sns.heatmap(mtx, square=True, cmap=cmap,
-                    center=center, cbar=cbar)
-    else:
-        sns.heatmap(mtx, square=True, cmap=cmap, cbar=cbar)
+def heatmap_image(mtx, cmap, norm):
+    """ RGBA image of the matrix with normalization applied once, NaNs are transparent. """
+    cmap = mpl.colormaps[cmap] if isinstance(cmap, str) else cmap
+    image = cmap(norm(np.ma.masked_invalid(mtx)))
+    image[~np.isfinite(mtx)] = 0
+    return image
 
+
+def _draw_heatmap(ax, mtx, cmap, norm, title='', window=1):
     size = len(mtx)
+    ax.imshow(heatmap_image(mtx, cmap, norm), interpolation='nearest', extent=(0, size, size, 0))
+
     bgn = size * window / (2 * window + 1)
     end = size - bgn
-    plt.plot([0, size], [bgn, bgn], '--', color='gray', alpha=0.5)
-    plt.plot([0, size], [end, end], '--', color='gray', alpha=0.5)
-    plt.plot([bgn, bgn], [0, size], '--', color='gray', alpha=0.5)
-    plt.plot([end, end], [0, size], '--', color='gray', alpha=0.5)
+    for pos in bgn, end:
+        ax.plot([0, size], [pos, pos], '--', color='gray', alpha=0.5)
+        ax.plot([pos, pos], [0, size], '--', color='gray', alpha=0.5)
+    ax.set_xlim(0, size)
+    ax.set_ylim(size, 0)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    ax.set_title(title)
+
+
+def plot_heatmap(s, pngname, cmap='Reds', center=None, vmax=None, title='', cbar=True, figsize=[7,7], window=1, vmin=None):
+    """
+    Plot heatmap of the matrix with dashed lines at the TAD borders.
+    Matrix is drawn as one image with precomputed colors, not as a mesh of cells.
+    """
+    from matplotlib.figure import Figure
+
+    mtx = np.asarray(s, dtype=float)
+    norm = heatmap_norm([mtx], center=center, vmax=vmax, vmin=-vmax if vmin is None and not vmax is None else vmin)
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+    _draw_heatmap(ax, mtx, cmap, norm, title=title, window=window)
+    if cbar:
+        fig.colorbar(mpl.cm.ScalarMappable(norm=norm, cmap=cmap), ax=ax)
+    fig.savefig(pngname)
+
 
-    plt.xticks([])
-    plt.yticks([])
+def plot_heatmap_grid(mtxs, pngname, titles=None, cmap='Reds', center=None, vmax=None, vmin=None, cbar=True,
+                      panel_size=4, ncols=None, window=1, suptitle=''):
+    """
+    Plot heatmaps of several matrices as panels of one figure with the shared color scale.
+    """
+    from matplotlib.figure import Figure
 
-    plt.title(title)
+    mtxs = [np.asarray(mtx, dtype=float) for mtx in mtxs]
+    titles = titles or ['']*len(mtxs)
+    ncols = ncols or int(np.ceil(np.sqrt(len(mtxs))))
+    nrows = int(np.ceil(len(mtxs) / ncols))
+    norm = heatmap_norm(mtxs, center=center, vmax=vmax, vmin=vmin)
 
-    plt.savefig(pngname)
+    fig = Figure(figsize=(panel_size*ncols + (1 if cbar else 0), panel_size*nrows), layout='constrained')
+    axes = fig.subplots(nrows, ncols, squeeze=False)
+    for ax, mtx, title in zip(axes.ravel(), mtxs, titles):
+        _draw_heatmap(ax, mtx, cmap, norm, title=title, window=window)
+    for ax in axes.ravel()[len(mtxs):]:
+        ax.set_axis_off()
+    if cbar:
+        fig.colorbar(mpl.cm.ScalarMappable(norm=norm, cmap=cmap), ax=axes.ravel().tolist(), shrink=0.6)
+    if suptitle:
+        fig.suptitle(suptitle)
+    fig.savefig(pngname)
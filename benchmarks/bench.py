@@ -0,0 +1,209 @@
+"""
+Benchmarks of avTAD stages on synthetic maps.
+
+Each stage (reading the map, obs/exp, enrichment, snipping, zoom, averaging, evaluation, plotting)
+is timed (wall and CPU time) and memory-profiled (peak of memory allocated during the stage,
+traced by tracemalloc, and peak RSS of the process with its increase during the stage, which also
+covers memory not allocated by Python such as HDF5 buffers) across scaling axes: chromosome length,
+number of TADs, number of shuffles and rescaled size. Axes are varied one at a time around the base configuration.
+
+Example run:
+    python benchmarks/bench.py run --output bench.json
+    python benchmarks/bench.py run --quick --axes n,niter --output bench_quick.json
+    python benchmarks/bench.py compare bench_old.json bench.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import tempfile
+import resource
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+
+# synthetic is next to this script, avTAD is imported from the repository if it is not installed:
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic
+
+import avTAD
+from avTAD.tools import read_map, BandedMatrix, zoom_batches, zoom_operator, average_snips, plot_heatmap
+from avTAD.store import open_snips
+from avTAD.expression import Expression, evaluate_modes
+from avTAD.pipeline import read_segmentation, bin_segmentation, max_window, add_shuffled_segmentations, \
+    add_enrichment, write_snips_files
+
+BASE = dict(n=4000, ntads=50, niter=2, rescaled_size=100)
+AXES = dict(n=[2000, 4000, 8000, 16000], ntads=[25, 50, 100], niter=[0, 2, 8], rescaled_size=[50, 100, 200])
+
+QUICK_BASE = dict(n=1000, ntads=10, niter=1, rescaled_size=50)
+QUICK_AXES = dict(n=[500, 1000, 2000], ntads=[5, 10, 20], niter=[0, 1, 4], rescaled_size=[25, 50, 100])
+
+
+def max_rss():
+    """ Peak resident set size of the process in Mb. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def measure(func, *args, **kwargs):
+    """
+    Run func and return its result and wall time, CPU time, peak traced memory, peak RSS
+    and increase of peak RSS during the run in Mb.
+    """
+    rss = max_rss()
+    tracemalloc.start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss, rss_before = max_rss(), rss
+    return result, {'wall': wall, 'cpu': cpu, 'peak_mb': peak / 2**20,
+                    'max_rss_mb': rss, 'rss_increase_mb': rss - rss_before}
+
+
+def make_dataset(tmpdir, n, ntads, nchroms=2, resolution=10000, format='cool', seed=0):
+    """ Synthetic map in format and BED segmentation in tmpdir. Returns map and segmentation file names. """
+    lengths, segmentations, pixels = synthetic.synthetic_dataset(nchroms=nchroms, n=n, ntads=ntads, seed=seed)
+    prefix = os.path.join(tmpdir, f'synthetic_n{n}_ntads{ntads}')
+    synthetic.write_bed(f'{prefix}.bed', segmentations, resolution)
+    if format == 'cool':
+        synthetic.write_cool(f'{prefix}.cool', lengths, pixels, resolution)
+        return f'{prefix}.cool', f'{prefix}.bed'
+    synthetic.write_hiclib(f'{prefix}.{format}.hdf5', lengths, pixels, resolution, format=format)
+    return f'{prefix}.{format}.hdf5', f'{prefix}.bed'
+
+
+def run_stages(map_file, bed_file, tmpdir, format='cool', niter=2, rescaled_size=100, window=1, seed=0):
+    """ Run avTAD stages one by one on the map and segmentation. Returns measurements by stage. """
+    stages = {}
+    prefix = os.path.join(tmpdir, 'bench')
+
+    # Dense reading of all chromosomes of the map:
+    dataset, stages['read_map'] = measure(read_map, map_file, format=format, balance=format=='cool')
+    del dataset
+
+    df, _ = read_segmentation(bed_file)
+    dataset, chrms, resolution = read_map(map_file, format=format, balance=format=='cool', lazy=format=='cool')
+    df = bin_segmentation(df, resolution)
+    max_offset = max_window(df, window)
+
+    def obsexp():
+        ret = {}
+        for ch in chrms:
+            n = len(dataset[ch])
+            ret[ch] = BandedMatrix.from_dense(dataset[ch], min(max_offset, n-1))
+            ret[ch].observed_over_expected(diagonals_to_remove=2)
+        return ret
+    dataset_obsexp, stages['obsexp'] = measure(obsexp)
+
+    def enrichment():
+        return add_enrichment(add_shuffled_segmentations(df, niter, seed=seed), dataset_obsexp, niter=niter)
+    df, stages['enrichment'] = measure(enrichment)
+
+    _, stages['snipper'] = measure(write_snips_files, df, dataset_obsexp, prefix, niter=niter, window=window)
+
+    # Zoom operators are cached between runs, they are built anew for each configuration:
+    zoom_operator.cache_clear()
+    with open_snips(f'{prefix}.TADsnips.hdf5') as snips:
+        _, stages['zoom'] = measure(lambda: sum(len(stack) for _, stack in zoom_batches(snips.iter(), (rescaled_size, rescaled_size))))
+    # Observed and all shuffled segmentations are averaged, measurements are summed (peak memory is the maximum):
+    averages, measurements = {}, []
+    for mod in ['']+[f'_shuf{i}' for i in range(niter)]:
+        with open_snips(f'{prefix}.TADsnips{mod}.hdf5') as snips:
+            (averages[mod], _), m = measure(average_snips, snips.iter(), operation='mean',
+                                            finalShape=(rescaled_size, rescaled_size))
+        measurements.append(m)
+    stages['averaging'] = {'wall': sum(m['wall'] for m in measurements), 'cpu': sum(m['cpu'] for m in measurements),
+                           **{key: max(m[key] for m in measurements) for key in ['peak_mb', 'max_rss_mb', 'rss_increase_mb']}}
+
+    if niter:
+        operands = {'a': {'': averages['']}, 'b': {'': averages['_shuf0']}}
+        _, stages['evaluate'] = measure(evaluate_modes, Expression('a-b'), operands)
+
+    _, stages['plot'] = measure(plot_heatmap, averages[''], f'{prefix}.png', cmap='RdBu_r', center=0, vmax=0.5)
+    return stages
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--output", "-o", help="Output JSON file.", default="bench.json", show_default=True)
+@click.option("--axes", help="Comma-separated scaling axes to vary.", default=','.join(AXES), show_default=True)
+@click.option("--format", "-f", help="Format of synthetic maps (cool, hiclib_heatmap, hiclib_bychr).",
+              default='cool', show_default=True)
+@click.option("--nchroms", help="Number of chromosomes of synthetic maps.", default=2, type=int, show_default=True)
+@click.option("--repeat", help="Number of repeats of each configuration, the fastest is reported.",
+              default=1, type=int, show_default=True)
+@click.option("--quick", help="Small configurations for smoke runs.", is_flag=True, default=False)
+def run(output, axes, format, nchroms, repeat, quick):
+    """ Run benchmarks and write results to JSON. """
+    base, values = (QUICK_BASE, QUICK_AXES) if quick else (BASE, AXES)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        datasets = {}
+        for axis in axes.split(','):
+            if not axis in values:
+                raise Exception(f'Unknown axis {axis}, available axes are: {list(values)}')
+            for value in values[axis]:
+                config = dict(base, **{axis: value})
+                key = (config['n'], config['ntads'])
+                if not key in datasets:
+                    datasets[key] = make_dataset(tmpdir, config['n'], config['ntads'], nchroms=nchroms, format=format)
+                runs = [run_stages(*datasets[key], tmpdir, format=format, niter=config['niter'],
+                                   rescaled_size=config['rescaled_size']) for _ in range(repeat)]
+                stages = {stage: min((x[stage] for x in runs), key=lambda x: x['wall']) for stage in runs[0]}
+                results.append({'axis': axis, 'value': value, 'config': config, 'stages': stages})
+                click.echo(f"{axis}={value}: " + ', '.join(f"{stage} {x['wall']:.3f}s" for stage, x in stages.items()), err=True)
+
+    report = {
+        'avTAD_version': avTAD.__version__,
+        'format_version': avTAD.__format_version__,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'format': format,
+        'nchroms': nchroms,
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f"Results written to {output}", err=True)
+
+
+@cli.command()
+@click.argument("old")
+@click.argument("new")
+@click.option("--metric", help="Metric to compare (wall, cpu, peak_mb, max_rss_mb, rss_increase_mb).", default='wall', show_default=True)
+@click.option("--threshold", help="Ratio new/old above which the stage is reported as regression.",
+              default=1.25, type=float, show_default=True)
+def compare(old, new, metric, threshold):
+    """ Compare two JSON results of run, exit with code 1 if there are regressions. """
+    def table(fname):
+        with open(fname) as f:
+            report = json.load(f)
+        return pd.DataFrame([{'axis': x['axis'], 'value': x['value'], 'stage': stage, metric: m[metric]}
+                             for x in report['results'] for stage, m in x['stages'].items()])
+
+    df = table(old).merge(table(new), on=['axis', 'value', 'stage'], suffixes=('_old', '_new'))
+    df['ratio'] = df[f'{metric}_new'] / df[f'{metric}_old']
+    click.echo(df.to_string(index=False, float_format=lambda x: f'{x:.3f}'))
+    regressions = df[df.ratio > threshold]
+    if len(regressions):
+        click.echo(f"{len(regressions)} stages are slower than {threshold}x:\n"
+                   f"{regressions.to_string(index=False, float_format=lambda x: f'{x:.3f}')}", err=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,125 @@
+"""
+Synthetic Hi-C maps and TAD segmentations for benchmarks.
+
+Contacts decay with genomic distance as a power law, pixels inside TADs are enriched,
+counts are Poisson. Only pixels up to max_distance bins from the main diagonal are generated,
+so maps of long chromosomes fit into memory.
+"""
+import pickle
+import h5py
+import cooler
+import numpy as np
+import pandas as pd
+
+
+def random_segmentation(n, ntads, min_size=5, max_size=50, seed=None):
+    """ ntads non-overlapping TADs (bgn, end) in bins with sizes in [min_size, max_size] on a chromosome of n bins. """
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(min_size, max_size+1, size=ntads)
+    if sizes.sum() > n:
+        raise ValueError(f'{ntads} TADs of sizes {min_size}-{max_size} do not fit into {n} bins')
+    # Free space is distributed between TADs at random:
+    gaps = rng.multinomial(n - sizes.sum(), np.ones(ntads+1)/(ntads+1))[:-1]
+    bgns = np.cumsum(gaps + np.r_[0, sizes[:-1]])
+    return np.stack([bgns, bgns + sizes], axis=1)
+
+
+def synthetic_pixels(n, tads, max_distance=200, depth=100, alpha=-1.0, tad_strength=2.0, seed=None):
+    """
+    Upper triangle pixels (bin1_id, bin2_id, count) of a chromosome of n bins:
+    expected count is depth*(distance+1)**alpha, multiplied by tad_strength inside TADs.
+    """
+    rng = np.random.default_rng(seed)
+    tad_id = np.full(n, -1)
+    for k, (bgn, end) in enumerate(tads):
+        tad_id[bgn:end] = k
+
+    bin1, bin2, count = [], [], []
+    for d in range(min(max_distance, n-1)+1):
+        i = np.arange(n-d)
+        expected = np.full(len(i), depth*(d+1.)**alpha)
+        expected[(tad_id[i] >= 0) & (tad_id[i] == tad_id[i+d])] *= tad_strength
+        counts = rng.poisson(expected)
+        nonzero = counts > 0
+        bin1.append(i[nonzero])
+        bin2.append(i[nonzero]+d)
+        count.append(counts[nonzero])
+    pixels = pd.DataFrame({'bin1_id': np.concatenate(bin1), 'bin2_id': np.concatenate(bin2), 'count': np.concatenate(count)})
+    return pixels.sort_values(['bin1_id', 'bin2_id']).reset_index(drop=True)
+
+
+def synthetic_dataset(nchroms=2, n=2000, ntads=100, min_size=5, max_size=50, max_distance=200, seed=0, **kwargs):
+    """
+    Chromosome lengths in bins, TADs by chromosome and pixels by chromosome of a synthetic genome.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(2*nchroms)
+    lengths, segmentations, pixels = {}, {}, {}
+    for k in range(nchroms):
+        ch = f'chr{k+1}'
+        lengths[ch] = n
+        segmentations[ch] = random_segmentation(n, ntads, min_size, max_size, seed=seeds[2*k])
+        pixels[ch] = synthetic_pixels(n, segmentations[ch], max_distance=max_distance, seed=seeds[2*k+1], **kwargs)
+    return lengths, segmentations, pixels
+
+
+def write_bed(fname, segmentations, resolution):
+    df = pd.concat([pd.DataFrame({'ch': ch, 'bgn': tads[:, 0]*resolution, 'end': tads[:, 1]*resolution})
+                    for ch, tads in segmentations.items()])
+    df.to_csv(fname, sep='\t', header=False, index=False)
+
+
+def balance_weights(n, pixels, ignore_diags=2, max_iters=500, tol=1e-5):
+    """
+    Iterative correction weights of a chromosome from its upper triangle pixels, computed in memory
+    (balancing of the written cool file by cooler is much slower for benchmark-sized maps).
+    """
+    pixels = pixels[pixels.bin2_id - pixels.bin1_id >= ignore_diags]
+    bin1, bin2, count = pixels.bin1_id.values, pixels.bin2_id.values, pixels['count'].values.astype(float)
+    weights = np.ones(n)
+    for _ in range(max_iters):
+        values = count * weights[bin1] * weights[bin2]
+        marginals = np.bincount(bin1, values, minlength=n) + np.bincount(bin2, values, minlength=n)
+        marginals /= marginals[marginals > 0].mean()
+        marginals[marginals == 0] = 1
+        weights /= marginals
+        if marginals.var() < tol:
+            break
+    return weights
+
+
+def write_cool(fname, lengths, pixels, resolution, balance=True):
+    """ Cool file with the synthetic map, with balancing weights in 'weight' column if balance. """
+    chromsizes = pd.Series({ch: n*resolution for ch, n in lengths.items()})
+    bins = cooler.binnify(chromsizes, resolution)
+    if balance:
+        bins['weight'] = np.concatenate([balance_weights(n, pixels[ch]) for ch, n in lengths.items()])
+    offsets = np.cumsum([0] + list(lengths.values()))[:-1]
+    genome_pixels = pd.concat([df.assign(bin1_id=df.bin1_id+offset, bin2_id=df.bin2_id+offset)
+                               for df, offset in zip(pixels.values(), offsets)], ignore_index=True)
+    cooler.create_cooler(fname, bins, genome_pixels, ordered=True)
+    return fname
+
+
+def dense_matrix(n, pixels):
+    mtx = np.zeros((n, n))
+    mtx[pixels.bin1_id.values, pixels.bin2_id.values] = pixels['count'].values
+    mtx[pixels.bin2_id.values, pixels.bin1_id.values] = pixels['count'].values
+    return mtx
+
+
+def write_hiclib(fname, lengths, pixels, resolution, format='hiclib_bychr'):
+    """ hiclib HDF5 file with the synthetic map: whole-genome heatmap (hiclib_heatmap) or by chromosome (hiclib_bychr). """
+    chrms = list(lengths.keys())
+    with h5py.File(fname, 'w') as f:
+        f['resolution'] = np.void(pickle.dumps(resolution))
+        f['genomeIdxToLabel'] = np.void(pickle.dumps({idx: ch for idx, ch in enumerate(chrms)}))
+        if format == 'hiclib_bychr':
+            for idx, ch in enumerate(chrms):
+                f.create_dataset(f'{idx} {idx}', data=dense_matrix(lengths[ch], pixels[ch]))
+        else:
+            offsets = np.cumsum([0] + [lengths[ch] for ch in chrms])
+            heatmap = f.create_dataset('heatmap', shape=(offsets[-1], offsets[-1]), dtype=np.float64)
+            for idx, ch in enumerate(chrms):
+                heatmap[offsets[idx]:offsets[idx+1], offsets[idx]:offsets[idx+1]] = dense_matrix(lengths[ch], pixels[ch])
+            f['chromosomeStarts'] = offsets[:-1]
+    return fname
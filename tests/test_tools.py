@@ -1,5 +1,6 @@
 from __future__ import division, print_function
 import numpy as np
+import pytest
 import pandas as pd
 from avTAD.tools import *
 
@@ -30,4 +31,586 @@ def test_loading():
         if diagonals_to_remove:
             np.fill_diagonal(mtx3, np.nan)
 
-        assert np.nansum(mtx2)==np.nansum(mtx3)
\ No newline at end of file
+        assert np.nansum(mtx2)==np.nansum(mtx3)
+def test_lazy_cooler():
+    """
+    Lazy chromosome views fetch the same blocks as dense matrices:
+      pytest tests/test_tools.py::test_lazy_cooler
+    """
+    import os
+    from cooltools.lib.numutils import observed_over_expected
+    infile = os.path.join(os.path.dirname(__file__), 'data', 'Kc167_dm3.cool')
+    dense, chrms, resolution = read_cooler(infile, balance=True)
+    lazy, chrms_lazy, resolution_lazy = read_cooler(infile, balance=True, lazy=True)
+
+    assert chrms==chrms_lazy and resolution==resolution_lazy
+    for ch in chrms:
+        assert len(dense[ch])==len(lazy[ch])
+    np.testing.assert_array_equal(dense['chr4'][10:40, 5:50], lazy['chr4'][10:40, 5:50])
+
+    mtx = np.random.RandomState(0).rand(30, 30)
+    mtx = mtx + mtx.T
+    obsexp = observed_over_expected(mtx)[0]
+    view = lazy_observed_over_expected(mtx, max_offset=29, diagonals_to_remove=0, chunksize=7)
+    np.testing.assert_allclose(view[3:20, 3:20], obsexp[3:20, 3:20])
+    view = lazy_observed_over_expected(mtx, max_offset=5, diagonals_to_remove=2)
+    assert np.all(np.isnan(view[0:30, 0:30][np.abs(np.subtract.outer(range(30), range(30)))<2]))
+
+def test_tad_enrichment():
+    """
+    Enrichment from summed area tables is equal to TAD-by-TAD calculation:
+      pytest tests/test_tools.py::test_tad_enrichment
+    """
+    rs = np.random.RandomState(0)
+    mtx = rs.rand(50, 50)*2
+    mtx[rs.rand(50, 50)<0.1] = 0
+    mtx[rs.rand(50, 50)<0.1] = np.nan
+    bgns = rs.randint(0, 40, size=(3, 10))
+    ends = bgns + rs.randint(0, 15, size=(3, 10))
+
+    expected = np.array([[window_enrichment(mtx[b:e, b:e]) for b, e in zip(*x)] for x in zip(bgns, np.minimum(ends, 50))])
+    enrichment = tad_enrichment(mtx, bgns, ends, median=True)
+    np.testing.assert_allclose(enrichment, expected, equal_nan=True)
+    assert np.all(np.isnan(tad_enrichment(mtx, bgns, ends)[..., 2]))
+    for m in [mtx, BandedMatrix.from_dense(mtx, 20)]:
+        np.testing.assert_array_equal(tad_enrichment(m, bgns, ends, tables=enrichment_tables(m)), tad_enrichment(m, bgns, ends))
+
+def test_snip_store(tmp_path):
+    """
+    Snips written to the container are read back by index:
+      pytest tests/test_tools.py::test_snip_store
+    """
+    from avTAD.store import write_snips, open_snips
+    rs = np.random.RandomState(0)
+    snips = [rs.rand(n, n) for n in [3, 10, 1, 7, 0]]
+    fname = str(tmp_path / 'test.TADsnips.hdf5')
+    assert write_snips(fname, iter(snips), chunksize=20)==len(snips)
+
+    with open_snips(fname) as store:
+        assert len(store)==len(snips)
+        np.testing.assert_array_equal(store[1], snips[1])
+        for mtx, i in zip(store[[3, 0, 4]], [3, 0, 4]):
+            np.testing.assert_array_equal(mtx, snips[i])
+
+def test_snip_store_precision(tmp_path):
+    """
+    Reduced-precision compressed snips are read back as float64 within the rounding of dtype,
+    and the average is within the documented bound:
+      pytest tests/test_tools.py::test_snip_store_precision
+    """
+    from avTAD.store import write_snips, open_snips
+    rs = np.random.RandomState(0)
+    snips = [rs.randn(n, n)*3 for n in rs.randint(5, 30, size=40)]
+    snips[3][1, 2] = np.nan
+    reference, _ = average_snips(iter(snips), finalShape=(20, 20))
+    absolute, _ = average_snips((np.abs(mtx) for mtx in snips), finalShape=(20, 20))
+
+    for dtype, compression, u in [('float32', 'lzf', 2.**-24), ('float16', 'gzip', 2.**-11)]:
+        fname = str(tmp_path / f'{dtype}.TADsnips.hdf5')
+        write_snips(fname, iter(snips), dtype=dtype, compression=compression, chunksize=100)
+        with open_snips(fname) as store:
+            assert store.data.dtype==np.dtype(dtype) and store.data.compression==compression
+            assert store[3].dtype==np.float64 and np.isnan(store[3][1, 2])
+            np.testing.assert_allclose(store[10], snips[10], rtol=u)
+            for i, mtx in zip([2, 5, 6, 30], store.iter([2, 5, 6, 30])):
+                np.testing.assert_array_equal(mtx, store[i])
+            average, _ = average_snips(store.iter(), finalShape=(20, 20))
+        assert np.all(np.abs(average-reference)<=u*absolute+1e-12)
+
+    with pytest.raises(ValueError):
+        write_snips(str(tmp_path / 'bad.hdf5'), iter(snips), dtype='int32')
+
+def test_average_store(tmp_path):
+    """
+    Average matrices are read back with metadata, accumulators of groups are merged exactly:
+      pytest tests/test_tools.py::test_average_store
+    """
+    from avTAD.store import write_average, read_average, list_averages
+    rs = np.random.RandomState(0)
+    stack = rs.rand(6, 5, 5)
+    stack[rs.rand(*stack.shape)<0.2] = np.nan
+    accumulator = GroupedPileupAccumulator(2, (5, 5))
+    accumulator.add_stack(stack, [0, 1, 0, 1, 1, 0])
+    for k in range(2):
+        write_average(str(tmp_path / f'test.avTAD.group:{k}.npz'), accumulator.result('mean')[k],
+                      {'description': f'group {k}'}, state=accumulator.group(k).state())
+
+    averages = list_averages(str(tmp_path / 'test'))
+    assert list(averages.keys())==['.group:0', '.group:1']
+    matrix, metadata, state = read_average(averages['.group:0'])
+    assert metadata['description']=='group 0'
+    np.testing.assert_array_equal(matrix, accumulator.result('mean')[0])
+
+    merged = PileupAccumulator.from_state(state).merge(PileupAccumulator.from_state(read_average(averages['.group:1'])[2]))
+    total = PileupAccumulator((5, 5))
+    total.add_stack(stack)
+    assert merged.n==total.n==6
+    for operation in ['mean', 'std']:
+        np.testing.assert_allclose(merged.result(operation), total.result(operation), equal_nan=True)
+
+def test_rescale_bootstrap_files(tmp_path):
+    """
+    Bootstrap confidence bounds written by rescale are not listed as averages for plot and evaluate:
+      pytest tests/test_tools.py::test_rescale_bootstrap_files
+    """
+    import os
+    from click.testing import CliRunner
+    from avTAD.cli import cli
+    from avTAD.store import write_snips, list_averages
+    rs = np.random.RandomState(0)
+    write_snips(str(tmp_path / 'test.TADsnips.hdf5'), iter([rs.rand(n, n) for n in rs.randint(5, 20, size=10)]))
+    pd.DataFrame({'ch': np.repeat(['chr1', 'chr2'], 5), 'bgn': np.arange(10)*100, 'end': np.arange(10)*100+50}) \
+        .to_csv(tmp_path / 'test.TADmetadata.tsv', sep='\t')
+
+    prefix = str(tmp_path / 'test')
+    result = CliRunner().invoke(cli, ['rescale', f'{prefix}.TADsnips.hdf5', f'{prefix}.TADmetadata.tsv', prefix,
+                                      '--split-by', 'ch', '--total', '--rescaled-size', '10', '--bootstrap', '5', '--seed', '0'])
+    assert result.exit_code==0, result.output
+    assert list(list_averages(prefix))==['', '.ch:chr1', '.ch:chr2']
+    for mode in ['', '.ch:chr1', '.ch:chr2']:
+        for bound in ['lower', 'upper']:
+            assert os.path.isfile(f'{prefix}.avTADci{mode}.{bound}.npz')
+
+def test_shared_arrays():
+    """
+    Arrays in shared memory are visible after attaching:
+      pytest tests/test_tools.py::test_shared_arrays
+    """
+    arrays = {'chr1': np.arange(12, dtype=float).reshape(3, 4), 'chr2': 'not an array'}
+    shared, specs, blocks = share_arrays(arrays)
+    try:
+        attached, attached_blocks = attach_arrays(specs)
+        np.testing.assert_array_equal(attached['chr1'], arrays['chr1'])
+        assert attached['chr2']==arrays['chr2']
+        shared['chr1'][0, 0] = -1
+        assert attached['chr1'][0, 0]==-1
+        del attached
+        for block in attached_blocks:
+            block.close()
+    finally:
+        release_arrays(blocks)
+
+def test_average_snips():
+    """
+    Streaming averages are equal to averages over the stack of zoomed snips:
+      pytest tests/test_tools.py::test_average_snips
+    """
+    from cooltools.lib.numutils import zoom_array
+    rs = np.random.RandomState(0)
+    snips = [rs.rand(n, n) for n in [10, 15, 20, 9]]
+    for mtx in snips:
+        mtx[rs.rand(*mtx.shape)<0.2] = np.nan
+    stack = np.array([zoom_array(mtx, (12, 12), True, order=1) for mtx in snips])
+
+    for operation, func in [('mean', np.nanmean), ('median', np.nanmedian), ('sum', np.nansum),
+                            ('std', lambda x, axis: np.nanstd(x, axis=axis, ddof=1))]:
+        average, n = average_snips(iter(snips), operation=operation, finalShape=(12, 12))
+        assert n==len(snips)
+        with np.errstate(all='ignore'):
+            np.testing.assert_allclose(average, func(stack, axis=0), equal_nan=True)
+
+def test_average_snips_grouped():
+    """
+    Averages of groups of several groupings in one pass are equal to averages of each group:
+      pytest tests/test_tools.py::test_average_snips_grouped
+    """
+    rs = np.random.RandomState(0)
+    snips = [rs.rand(n, n) for n in [10, 15, 20, 9, 15, 10]]
+    for mtx in snips:
+        mtx[rs.rand(*mtx.shape)<0.2] = np.nan
+    labels = np.array([[0, 0, 0, 0, 0, 0], [1, 2, 1, -1, 2, 1], [3, 3, 4, 4, 4, 5]])
+
+    for operation in ['mean', 'median', 'std']:
+        averages, n = average_snips_grouped(iter(snips), labels, 6, operation=operation, finalShape=(12, 12))
+        for group in range(6):
+            index = np.flatnonzero((labels==group).any(axis=0))
+            average, n_group = average_snips([snips[i] for i in index], operation=operation, finalShape=(12, 12))
+            assert n[group]==n_group==len(index)
+            np.testing.assert_allclose(averages[group], average, equal_nan=True)
+
+def test_expression():
+    """
+    Compiled expressions are equal to numpy evaluation, names and functions are validated:
+      pytest tests/test_tools.py::test_expression
+    """
+    from avTAD.expression import Expression, evaluate_modes
+    rs = np.random.RandomState(0)
+    a, b, c = rs.rand(3, 4, 5, 5)
+    expr = Expression('log2(abs(a-b)+1)*-2 + c**2/(1+1) - maximum(a, c)', names=['a', 'b', 'c'])
+    assert expr.names==['a', 'b', 'c'] and expr.nregisters==2
+    np.testing.assert_allclose(expr(a=a, b=b, c=c), np.log2(np.abs(a-b)+1)*-2 + c**2/2 - np.maximum(a, c))
+
+    a[0, 0, 0] = np.nan
+    assert np.isnan(Expression('maximum(a, b)')(a=a, b=b)[0, 0, 0])
+    assert Expression('fmin(a, b)')(a=a, b=b)[0, 0, 0]==b[0, 0, 0]
+
+    results = evaluate_modes(Expression('a/b'), {'a': {'': a[0], '.ch:chrX': a[1], '.ch:chrY': a[2]},
+                                                 'b': {'': b[0], '.ch:chrX': b[1]}})
+    assert list(results.keys())==['', '.ch:chrX']
+    np.testing.assert_allclose(results['.ch:chrX'], a[1]/b[1])
+
+    for bad in ['__import__("os")', 'a.T', 'c+a', 'eval("a")', 'log2(a, b)', 'a[0]', '"a"']:
+        with pytest.raises(ValueError):
+            Expression(bad)
+
+def test_plot_heatmap(tmp_path):
+    """
+    Heatmaps are plotted with the color scale symmetric around center, grid panels share one scale:
+      pytest tests/test_tools.py::test_plot_heatmap
+    """
+    norm = heatmap_norm([np.array([[-0.5, 2.], [np.nan, 0.]])], center=0)
+    assert (norm.vmin, norm.vmax)==(-2, 2)
+    norm = heatmap_norm([np.ones((2, 2)), np.full((2, 2), 3.)])
+    assert (norm.vmin, norm.vmax)==(1, 3)
+
+    mtx = np.random.RandomState(0).rand(30, 30)
+    mtx[0, 0] = np.nan
+    assert heatmap_image(mtx, 'RdBu_r', norm)[0, 0, 3]==0
+    plot_heatmap(mtx, str(tmp_path / 'test.png'), cmap='RdBu_r', center=0, vmax=1)
+    plot_heatmap_grid([mtx, mtx.T, -mtx], str(tmp_path / 'grid.png'), titles=['a', 'b', 'c'], center=0)
+    assert (tmp_path / 'test.png').exists() and (tmp_path / 'grid.png').exists()
+
+def test_zoom_batches():
+    """
+    Batched zoom with cached operators reproduces numutils.zoom_array including NaNs:
+      pytest tests/test_tools.py::test_zoom_batches
+    """
+    from cooltools.lib.numutils import zoom_array
+    rs = np.random.RandomState(0)
+    snips = [rs.rand(n, n) for n in [1, 7, 30, 7, 45, 30]]
+    for mtx in snips:
+        mtx[rs.rand(*mtx.shape)<0.05] = np.nan
+
+    for save_sum in [True, False]:
+        zoomed = zoom(snips, finalShape=(20, 20), saveSum=save_sum)
+        for mtx, ret in zip(snips, zoomed):
+            np.testing.assert_allclose(ret, zoom_array(mtx, (20, 20), save_sum, order=1), equal_nan=True)
+
+def test_obsexp_cache(tmp_path):
+    """
+    Cached maps are found by content of the map file and evicted when the cache is full:
+      pytest tests/test_tools.py::test_obsexp_cache
+    """
+    from avTAD.cache import ObsExpCache
+    fname = tmp_path / 'map.cool'
+    fname.write_bytes(b'0'*1000)
+    cache = ObsExpCache(str(tmp_path / 'cache'), max_size=2000)
+    key = cache.key(str(fname), format='cool', balance=True, diagonals_to_remove=2)
+    assert key!=cache.key(str(fname), format='cool', balance=False, diagonals_to_remove=2)
+    assert cache.info(key) is None
+
+    cache.create(key, chrms=['chr1'], resolution=1000)
+    cache.put(key, 'chr1', np.eye(10))
+    assert cache.info(key)['chrms']==['chr1']
+    np.testing.assert_array_equal(cache.get(key, 'chr1'), np.eye(10))
+    assert cache.get(key, 'chr2') is None
+
+    cache.put(key, 'chr2', np.eye(20))
+    cache.evict()
+    assert cache.info(key) is None
+
+def test_obsexp_cache_weights(tmp_path):
+    """
+    Cache misses after the map is rebalanced in place, only the weights column is changed:
+      pytest tests/test_tools.py::test_obsexp_cache_weights
+    """
+    import os
+    import h5py
+    from avTAD.cache import ObsExpCache, map_fingerprint
+    fname = str(tmp_path / 'map.cool')
+    with h5py.File(fname, 'w') as f:
+        for name in ['bin1_id', 'bin2_id', 'count']:
+            f.create_dataset(f'pixels/{name}', data=np.arange(100))
+        f.create_dataset('bins/weight', data=np.ones(100))
+    cache = ObsExpCache(str(tmp_path / 'cache'))
+    fingerprint = map_fingerprint(fname)
+    key = cache.key(fname, format='cool', balance=True, diagonals_to_remove=2)
+    assert key==cache.key(fname, format='cool', balance=True, diagonals_to_remove=2)
+
+    stat = os.stat(fname)
+    with h5py.File(fname, 'r+') as f:
+        f['bins/weight'][:50] = 2
+    # Modification time may have coarse resolution, the file should look modified anyway:
+    os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns+10**9))
+    assert os.path.getsize(fname)==stat.st_size
+    assert map_fingerprint(fname)!=fingerprint
+    assert cache.key(fname, format='cool', balance=True, diagonals_to_remove=2)!=key
+
+def test_banded_matrix():
+    """
+    Banded matrix returns the same windows and TAD enrichment as dense matrix:
+      pytest tests/test_tools.py::test_banded_matrix
+    """
+    from cooltools.lib.numutils import observed_over_expected
+    rs = np.random.RandomState(0)
+    n, max_offset = 60, 15
+    mtx = rs.rand(n, n)*3
+    mtx = mtx + mtx.T
+    dist = np.abs(np.subtract.outer(np.arange(n), np.arange(n)))
+
+    band = BandedMatrix.from_dense(mtx, max_offset, chunksize=7)
+    dense = np.where(dist<=max_offset, mtx, np.nan)
+    np.testing.assert_array_equal(band[0:n, 0:n], dense)
+    np.testing.assert_array_equal(band[3:20, 10:40], dense[3:20, 10:40])
+
+    bgns = rs.randint(0, 50, size=(3, 20))
+    ends = np.minimum(bgns + rs.randint(0, 16, size=(3, 20)), n)
+    np.testing.assert_allclose(tad_enrichment(band, bgns, ends), tad_enrichment(dense, bgns, ends), equal_nan=True)
+
+    obsexp = observed_over_expected(mtx)[0]
+    band.observed_over_expected(diagonals_to_remove=2)
+    obsexp[dist<2] = np.nan
+    np.testing.assert_allclose(band[0:n, 0:n], np.where(dist<=max_offset, obsexp, np.nan), equal_nan=True)
+
+def test_shuffle_segmentations():
+    """
+    Shuffled TADs keep their sizes and do not overlap:
+      pytest tests/test_tools.py::test_shuffle_segmentations
+    """
+    segmentation = np.array([[2, 5], [5, 9], [12, 13], [20, 30], [31, 40]])
+    shuffled = shuffle_segmentations(segmentation, 50, seed=0)
+
+    assert shuffled.shape==(50, 5, 2)
+    np.testing.assert_array_equal(shuffled[..., 1]-shuffled[..., 0], np.tile(segmentation[:, 1]-segmentation[:, 0], (50, 1)))
+    for shuffle in shuffled:
+        shuffle = shuffle[np.argsort(shuffle[:, 0])]
+        assert shuffle[0, 0]>=0 and np.all(shuffle[1:, 0]>=shuffle[:-1, 1]) and shuffle[-1, 1]==40
+    np.testing.assert_array_equal(shuffled, shuffle_segmentations(segmentation, 50, seed=0))
+
+def test_profiling(tmp_path):
+    """
+    Stages are recorded with counts and nesting only when profiling is enabled:
+      pytest tests/test_tools.py::test_profiling
+    """
+    import json
+    from avTAD._profiling import stage, enable_profiling, report_profile
+
+    with stage('disabled', tads=10) as s:
+        s.count(snips=5)
+
+    profiler = enable_profiling(trace=str(tmp_path / 'trace.json'))
+    with stage('outer', tads=10) as s:
+        with stage('inner'):
+            pass
+        s.count(snips=5)
+        s.count(snips=5)
+    assert [x['stage'] for x in profiler.records]==['outer', 'inner']
+    report_profile()
+
+    with open(tmp_path / 'trace.json') as f:
+        records = json.load(f)['stages']
+    assert [(x['stage'], x['depth']) for x in records]==[('outer', 0), ('inner', 1)]
+    assert records[0]['tads']==10 and records[0]['snips']==10
+    assert records[0]['wall']>=records[1]['wall']>=0
+    assert stage('after') is stage('disabled')
+
+def test_lazy_hiclib(tmp_path):
+    """
+    Lazy hiclib views read the same balanced blocks as dense chromosome matrices:
+      pytest tests/test_tools.py::test_lazy_hiclib
+    """
+    import h5py
+    import pickle
+    from cooltools.lib.numutils import iterative_correction_symmetric
+    rs = np.random.RandomState(0)
+    mtxs = [rs.poisson(10, size=(n, n)).astype(float) for n in (40, 25)]
+    mtxs = [mtx + mtx.T for mtx in mtxs]
+    heatmap = np.zeros((65, 65))
+    heatmap[:40, :40], heatmap[40:, 40:] = mtxs
+
+    with h5py.File(tmp_path / 'heatmap.hdf5', 'w') as f:
+        f['heatmap'] = heatmap
+        f['chromosomeStarts'] = np.array([0, 40])
+        f['resolution'] = np.void(pickle.dumps(10000))
+        f['genomeIdxToLabel'] = np.void(pickle.dumps({0: '2L', 1: 'chrX'}))
+
+    for balance in [False, True]:
+        dense, chrms, resolution = read_hiclib_heatmap(str(tmp_path / 'heatmap.hdf5'), balance=balance)
+        lazy, chrms_lazy, _ = read_hiclib_heatmap(str(tmp_path / 'heatmap.hdf5'), balance=balance, lazy=True)
+        assert chrms==chrms_lazy==['chr2L', 'chrX'] and resolution==10000
+        for ch, mtx in zip(chrms, mtxs):
+            expected = iterative_correction_symmetric(mtx)[0] if balance else mtx
+            assert len(lazy[ch])==len(mtx)
+            np.testing.assert_allclose(dense[ch], expected)
+            np.testing.assert_allclose(lazy[ch][5:20, 3:len(mtx)], expected[5:20, 3:])
+
+def test_bootstrap():
+    """
+    Bootstrap resamples keep sizes of groups and strata, and are averaged as explicit resamples:
+      pytest tests/test_tools.py::test_bootstrap
+    """
+    rs = np.random.RandomState(0)
+    stack = rs.rand(40, 5, 5)
+    stack[rs.rand(40, 5, 5)<0.1] = np.nan
+    labels = np.array([np.zeros(40, dtype=np.int64), rs.randint(1, 4, size=40)])
+    labels[1, 0] = -1
+    strata = rs.randint(0, 2, size=40)
+
+    weights = bootstrap_weights(labels, 20, strata=strata, seed=0)
+    assert weights.shape==(2, 20, 40)
+    np.testing.assert_array_equal(weights[0][:, strata==1].sum(axis=1), np.sum(strata==1))
+    for group in range(1, 4):
+        np.testing.assert_array_equal(weights[1][:, labels[1]==group].sum(axis=1), np.sum(labels[1]==group))
+    assert np.all(weights[1][:, 0]==0)
+    np.testing.assert_array_equal(weights, bootstrap_weights(labels, 20, strata=strata, seed=0))
+
+    accumulator = BootstrapAccumulator(weights, labels, 4, (5, 5))
+    for bgn in range(0, 40, 15):
+        accumulator.add_stack(stack[bgn:bgn+15], np.arange(bgn, min(bgn+15, 40)))
+    for group, grouping in [(0, 0), (2, 1)]:
+        for k in [0, 7]:
+            resample = stack[np.repeat(np.arange(40), weights[grouping][k] * (labels[grouping]==group))]
+            np.testing.assert_allclose(accumulator.result('mean')[group, k], np.nanmean(resample, axis=0))
+            np.testing.assert_allclose(accumulator.result('std')[group, k], np.nanstd(resample, axis=0, ddof=1))
+    lower, upper = accumulator.percentiles('mean', (5, 95))
+    assert lower.shape==(4, 5, 5) and np.all(lower<=upper)
+
+def test_pileup_segmentation():
+    """
+    Fused pileup gives the same grouped averages as snipping followed by averaging:
+      pytest tests/test_tools.py::test_pileup_segmentation
+    """
+    from avTAD.pipeline import group_labels, group_modes, pileup_segmentation, add_shuffled_segmentations
+    rs = np.random.RandomState(0)
+    dataset = {ch: rs.rand(100, 100)+0.1 for ch in ['chr1', 'chr2']}
+    bgns = np.tile(np.arange(10, 80, 10), 2)
+    df = pd.DataFrame({'ch': np.repeat(['chr1', 'chr2'], 7), 'bgn_bin': bgns, 'end_bin': bgns+rs.randint(3, 10, size=14)})
+    df = add_shuffled_segmentations(df, 2, seed=0)
+
+    groupings, offsets, labels = group_labels(df, split_by=['ch'], total=True)
+    assert [mode for _, mode, _, _ in group_modes(groupings, offsets)]==['', '.ch:chr1', '.ch:chr2']
+    accumulators = pileup_segmentation(df, dataset, labels, offsets[-1], niter=2, finalShape=(15, 15))
+    assert list(accumulators)==['', '_shuf0', '_shuf1']
+    for mod, accumulator in accumulators.items():
+        snips = snipper(df, dataset, key_bgn=f'bgn_bin{mod}', key_end=f'end_bin{mod}')
+        expected, counts = average_snips_grouped(snips, labels, offsets[-1], finalShape=(15, 15))
+        np.testing.assert_allclose(accumulator.result('mean'), expected)
+        np.testing.assert_array_equal(accumulator.n, [14, 7, 7])
+
+def test_map_with_memory_budget():
+    """
+    Concurrent jobs yield results in order and keep the estimated memory of running jobs within the budget:
+      pytest tests/test_tools.py::test_map_with_memory_budget
+    """
+    import time
+    import threading
+    lock, running, peaks = threading.Lock(), [], []
+
+    def job(k, memory):
+        with lock:
+            running.append(memory)
+            peaks.append(sum(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(memory)
+        return k
+
+    memory = [3, 1, 1, 2, 5, 1, 1]
+    jobs = [(k, m) for k, m in enumerate(memory)]
+    assert list(map_with_memory_budget(job, jobs, memory))==list(range(len(jobs)))
+    assert list(map_with_memory_budget(job, jobs, memory, threads=4, max_memory=4))==list(range(len(jobs)))
+    assert max(peaks)<=5
+    assert max(peaks[len(jobs):])>1
+
+def test_cooler_diagonal_sums():
+    """
+    Diagonal sums streamed from the pixel table are the same as for dense blocks of the matrix:
+      pytest tests/test_tools.py::test_cooler_diagonal_sums
+    """
+    import os
+    infile = os.path.join(os.path.dirname(__file__), 'data', 'Kc167_dm3.cool')
+    for balance in [True, False]:
+        lazy, chrms, _ = read_cooler(infile, balance=balance, lazy=True)
+        for ch in ['chr2L', 'chrX']:
+            sums, counts = lazy[ch].diagonal_sums(50, chunksize=1000)
+            expected_sums, expected_counts = diagonal_sums(lazy[ch], min(50, len(lazy[ch])-1))
+            np.testing.assert_allclose(sums, expected_sums)
+            np.testing.assert_array_equal(counts, expected_counts)
+
+def test_metadata_columns(tmp_path):
+    """
+    TAD metadata read from TSV and columnar HDF5 files with columns selection and query:
+      pytest tests/test_tools.py::test_metadata_columns
+    """
+    from avTAD.pipeline import write_metadata, read_metadata
+    rs = np.random.RandomState(0)
+    df = pd.DataFrame({'ch': np.repeat(['chr1', 'chr2'], 50), 'bgn': np.arange(100)*10, 'end': np.arange(100)*10+5,
+                       'TAD_size': rs.randint(3, 30, size=100), 'bgn_bin': np.arange(100), 'end_bin': np.arange(100)+1,
+                       'sum': rs.rand(100), 'mean': rs.rand(100), 'median': np.nan, 'nelements': rs.randint(1, 10, size=100)})
+    write_metadata(df, tmp_path/'m.tsv')
+    write_metadata(df, tmp_path/'m.hdf5', format='hdf5')
+    with pytest.raises(ValueError):
+        write_metadata(df, tmp_path/'m.csv', format='csv')
+
+    query = "TAD_size>10 and ch=='chr2'"
+    for fname in [tmp_path/'m.tsv', tmp_path/'m.hdf5']:
+        pd.testing.assert_frame_equal(read_metadata(str(fname)), df, check_dtype=False)
+        selected = read_metadata(str(fname), columns=['mean'], query=query, chunksize=7)
+        assert list(selected.columns)==['ch', 'TAD_size', 'mean']
+        pd.testing.assert_frame_equal(selected, df.query(query)[['ch', 'TAD_size', 'mean']], check_dtype=False)
+        with pytest.raises(ValueError):
+            read_metadata(str(fname), columns=['size_class'])
+
+def test_sequential_pvalues():
+    """
+    Sequential p-values stop TADs after the given number of exceedances and separate the enriched TAD:
+      pytest tests/test_tools.py::test_sequential_pvalues
+    """
+    from avTAD.pipeline import add_pvalues
+    rs = np.random.RandomState(0)
+    mtx = rs.rand(800, 800)+0.5
+    sizes = rs.randint(5, 15, size=30)
+    ends = np.cumsum(sizes+rs.randint(0, 10, size=30))
+    segmentation = np.stack([ends-sizes, ends], axis=1)
+    bgn, end = segmentation[10]
+    mtx[bgn:end, bgn:end] *= 4 # strongly enriched TAD
+    observed = tad_enrichment(mtx, segmentation[:, 0], segmentation[:, 1])[:, 1]
+    observed[-1] = np.nan
+
+    pvalues = sequential_pvalues(mtx, segmentation, observed, 300, hits=5, batch=64, seed=0)
+    assert pvalues[10, 0]<0.05
+    stopped = pvalues[:-1, 3]<300
+    assert stopped.sum()>=15
+    np.testing.assert_allclose(pvalues[:-1][stopped, 0], 5/pvalues[:-1][stopped, 3])
+    assert np.all(np.isnan(pvalues[-1, :3])) and pvalues[-1, 3]==0
+    np.testing.assert_array_equal(pvalues, sequential_pvalues(mtx, segmentation, observed, 300, hits=5, batch=64, seed=0))
+
+    # Without early stopping, p-values and null moments are those of all shuffles drawn at once:
+    full = sequential_pvalues(mtx, segmentation, observed, 300, hits=301, batch=300, seed=0)
+    null = tad_enrichment(mtx, *np.moveaxis(shuffle_segmentations(segmentation, 300, seed=0), 2, 0))[..., 1][:, :-1]
+    np.testing.assert_allclose(full[:-1, 0], ((null>=observed[:-1]).sum(axis=0)+1)/301)
+    np.testing.assert_allclose(full[:-1, 1], null.mean(axis=0))
+    np.testing.assert_allclose(full[:-1, 2], null.std(axis=0, ddof=1))
+
+    df = pd.DataFrame({'ch': 'chr1', 'bgn_bin': segmentation[:, 0], 'end_bin': segmentation[:, 1], 'mean': observed})
+    df = add_pvalues(df, {'chr1': mtx}, 200, hits=5, seed=0)
+    assert list(df.columns[-4:])==['pvalue', 'null_mean', 'null_std', 'null_niter'] and df.null_niter.max()<=200
+
+def test_pileup_api():
+    """
+    In-process pipeline reuses opened maps and gives the same averages and enrichment as its steps:
+      pytest tests/test_tools.py::test_pileup_api
+    """
+    import os
+    from avTAD.api import Pileup, MapCache
+    from avTAD.pipeline import read_segmentation
+    infile = os.path.join(os.path.dirname(__file__), 'data', 'Kc167_dm3.cool')
+    df_tads, _ = read_segmentation(os.path.join(os.path.dirname(__file__), 'data', 'Kc167_TADS.bed'))
+    df_tads = df_tads[df_tads.ch.isin(['chr2L', 'chrX'])]
+
+    maps = MapCache()
+    p = Pileup(infile, diagonals_to_remove=2, maps=maps)
+    df, accumulators, modes = p.pileup(df_tads, niter=1, seed=0, split_by=['ch'], total=True, rescaled_size=20)
+    assert [mode for _, mode, _, _ in modes]==['', '.ch:chr2L', '.ch:chrX'] and list(accumulators)==['', '_shuf0']
+    assert maps.memory()>0 and Pileup(infile, diagonals_to_remove=2, maps=maps).hic_map is p.hic_map
+    assert Pileup(infile, diagonals_to_remove=2).maps is not Pileup(infile, diagonals_to_remove=2).maps
+
+    pd.testing.assert_frame_equal(p.enrichment(df_tads, niter=1, seed=0), df)
+    df_average, averages = p.average(df_tads, niter=1, seed=0, split_by=['ch'], total=True, rescaled_size=20, query="ch=='chr2L'")
+    np.testing.assert_allclose(averages['']['.ch:chr2L'], accumulators[''].result('mean')[1])
+    assert list(averages['_shuf0'])==['', '.ch:chr2L']
+
+    # Least recently used maps are dropped when the memory is over the limit:
+    maps.max_memory = 0
+    Pileup(infile, diagonals_to_remove=1, maps=maps)
+    assert len(maps.maps)==1